@@ -0,0 +1,93 @@
+"""
+    Analyzers turn text into terms. The same analyzer is used to index a model and to
+    parse the search strings used to search it, so that both agree on what a term is.
+
+    A model can choose its analyzer in its Search class:
+
+    class Search:
+        fields = ["field1"]
+        analyzer = Analyzer(stopwords=ENGLISH_STOPWORDS, min_length=2)
+"""
+
+import re
+
+from django.utils.encoding import smart_unicode
+
+ENGLISH_STOPWORDS = frozenset([
+    u"a", u"an", u"and", u"are", u"as", u"at", u"be", u"but", u"by", u"for", u"if", u"in",
+    u"into", u"is", u"it", u"no", u"not", u"of", u"on", u"or", u"such", u"that", u"the",
+    u"their", u"then", u"there", u"these", u"they", u"this", u"to", u"was", u"will", u"with",
+])
+
+# Quoted phrases, "field:value" lookups and everything else, in a search string. A lookup's
+# value stops at a quote, so that it can't swallow half of a phrase
+QUERY_RE = re.compile(r'"([^"]*)"|(\w+:[^\s"]+)|([^\s"]+)', re.UNICODE)
+
+
+class Analyzer(object):
+    """
+        Splits text into lowercase words with a regular expression, dropping stopwords
+        and words shorter than min_length, and builds terms from each run of up to
+        max_shingle_size adjacent words.
+    """
+    def __init__(self, pattern=r"\w+", stopwords=(), min_length=1, max_shingle_size=4):
+        self.word_re = re.compile(pattern, re.UNICODE)
+        self.stopwords = frozenset(stopwords)
+        self.min_length = min_length
+        self.max_shingle_size = max_shingle_size
+
+    def tokenize(self, text):
+        return [
+            word for word in self.word_re.findall(smart_unicode(text).lower())
+            if len(word) >= self.min_length and word not in self.stopwords
+        ]
+
+    def get_term_occurances(self, text):
+        """ Returns {term: occurances} of the terms of the text, in a single pass """
+        words = self.tokenize(text)
+
+        term_occurances = {}
+        for i in xrange(len(words)):
+            for j in xrange(i + 1, min(i + self.max_shingle_size, len(words)) + 1):
+                term = u" ".join(words[i:j])
+                term_occurances[term] = term_occurances.get(term, 0) + 1
+        return term_occurances
+
+    def get_term_positions(self, text, offset=0):
+        """
+            Returns {word: [positions]} of the words of the text, for positional indexing.
+            Positions start at offset.
+        """
+        term_positions = {}
+        for position, word in enumerate(self.tokenize(text), offset):
+            term_positions.setdefault(word, []).append(position)
+        return term_positions
+
+    def parse_query(self, search_string):
+        """
+            Returns the distinct terms of a search string. Quoted phrases become a single term,
+            "field:value" lookups are kept as they are (lowercased) for search() to deal with.
+        """
+        terms = []
+        for phrase, lookup, words in QUERY_RE.findall(smart_unicode(search_string)):
+            if lookup:
+                terms.append(lookup.lower())
+            elif phrase:
+                phrase = u" ".join(self.tokenize(phrase))
+                if phrase:
+                    terms.append(phrase)
+            else:
+                terms.extend(self.tokenize(words))
+
+        distinct = []
+        for term in terms:
+            if term not in distinct:
+                distinct.append(term)
+        return distinct
+
+
+DEFAULT_ANALYZER = Analyzer()
+
+
+def get_analyzer(model_class):
+    return getattr(getattr(model_class, "Search", None), "analyzer", None) or DEFAULT_ANALYZER
@@ -0,0 +1,534 @@
+"""
+    Storage backends for the index. The backend is chosen with SEARCH_INDEX_BACKEND:
+
+    "rows": one Index entity per (term, table, instance). The default.
+    "postings": one posting list per (term, table), split into PostingBlocks which hold
+        packed arrays of instance pks and occurances. Reading a term reads a handful
+        of blocks rather than an entity per matching instance.
+
+    Backends only store the index, keeping the GlobalOccuranceCounts up to date is
+    left to the caller using the deltas returned when writing.
+"""
+
+import bisect
+import functools
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError
+
+from .models import (
+    MAX_BATCH_SIZE,
+    MAX_GROUPS_PER_TRANSACTION,
+    MAX_IN_FILTER_SIZE,
+    POSTING_LOOKUP_RATIO,
+    Index,
+    InstanceTerms,
+    PostingBlock,
+    _run_concurrently,
+    _run_in_transaction,
+    _term_range_filters,
+)
+
+# Whether the "postings" backend also reads Index rows which haven't been moved to
+# posting lists yet. Only needed while migrating from the "rows" backend.
+READ_LEGACY_INDEX = getattr(settings, "SEARCH_READ_LEGACY_INDEX", False)
+
+
+def _diff_terms(stored, term_occurances):
+    """ Returns {term: delta} between the stored and new occurances of the terms of an instance """
+    deltas = {}
+    for term, count in stored.items():
+        if term not in term_occurances:
+            deltas[term] = -count
+
+    for term, count in term_occurances.items():
+        if count != stored.get(term, 0):
+            deltas[term] = count - stored.get(term, 0)
+
+    return deltas
+
+
+class RowBackend(object):
+    def _get_indexes(self, db_table, pk):
+        return list(Index.objects.filter(instance_db_table=db_table, instance_pk=pk))
+
+    def _create_indexes(self, new_indexes):
+        """ Bulk creates the given Index instances, returning the ones which were created """
+        created = []
+        for i in xrange(0, len(new_indexes), MAX_BATCH_SIZE):
+            batch = new_indexes[i:i + MAX_BATCH_SIZE]
+            try:
+                Index.objects.bulk_create(batch)
+                created.extend(batch)
+            except IntegrityError:
+                # Someone else indexed some of these terms at the same time, fall back to
+                # creating them one by one so we only count the ones we created
+                for index in batch:
+                    try:
+                        index.save()
+                        created.append(index)
+                    except IntegrityError:
+                        pass
+        return created
+
+    def _delete_indexes(self, indexes):
+        pks = [ index.pk for index in indexes ]
+        for i in xrange(0, len(pks), MAX_BATCH_SIZE):
+            Index.objects.filter(pk__in=pks[i:i + MAX_BATCH_SIZE]).delete()
+
+    def get_instance_terms(self, db_table, pk):
+        return dict((index.iexact, index.occurances) for index in self._get_indexes(db_table, pk))
+
+    def update_instance(self, db_table, pk, term_occurances, term_positions=None, before_write=None):
+        """
+            Diffs the terms of an instance against the stored ones and only writes added,
+            removed and changed terms. Returns the {term: delta} of the changed terms, the
+            delta of a word which has only moved being 0.
+
+            term_positions: {word: [positions]} if the instance is indexed positionally
+            before_write: called with the {term: delta} about to be applied before anything
+                is written. The applied deltas only differ if someone else wrote some of the
+                same Index rows at the same time.
+        """
+        term_positions = term_positions or {}
+        stored = dict((index.iexact, index) for index in self._get_indexes(db_table, pk))
+
+        deltas = {}
+
+        removed = [ index for term, index in stored.items() if term not in term_occurances ]
+        for index in removed:
+            deltas[index.iexact] = -index.occurances
+
+        changed = []
+        new_indexes = []
+        for term, count in term_occurances.items():
+            positions = term_positions.get(term, [])
+            index = stored.get(term)
+            if index is None:
+                index = Index(iexact=term, instance_db_table=db_table, instance_pk=pk, occurances=count)
+                index.set_positions(positions)
+                new_indexes.append(index)
+            elif index.occurances != count or index.get_positions() != positions:
+                # Moved words are changes too (with a delta of 0), as they change phrase matches
+                deltas[term] = count - index.occurances
+                index.occurances = count
+                index.set_positions(positions)
+                changed.append(index)
+
+        logging.info(
+            "Indexing %s:%s, %s new, %s changed and %s removed terms",
+            db_table, pk, len(new_indexes), len(changed), len(removed)
+        )
+
+        if before_write:
+            planned = dict(deltas)
+            planned.update((index.iexact, index.occurances) for index in new_indexes)
+            before_write(planned)
+
+        self._delete_indexes(removed)
+
+        for index in changed:
+            index.save()
+
+        for index in self._create_indexes(new_indexes):
+            deltas[index.iexact] = index.occurances
+
+        return deltas
+
+    def remove_instance(self, db_table, pk, before_write=None):
+        indexes = self._get_indexes(db_table, pk)
+
+        deltas = {}
+        for index in indexes:
+            deltas[index.iexact] = deltas.get(index.iexact, 0) - index.occurances
+
+        if before_write:
+            before_write(deltas)
+        self._delete_indexes(indexes)
+        return deltas
+
+    def _get_indexes_for(self, term, db_table, pks):
+        """ Returns the Index rows of the term for the given pks, looking the chunks up concurrently """
+        pks = list(pks)
+        chunks = _run_concurrently([
+            functools.partial(self._get_indexes_chunk, term, db_table, pks[i:i + MAX_IN_FILTER_SIZE])
+            for i in xrange(0, len(pks), MAX_IN_FILTER_SIZE)
+        ])
+        return [ index for chunk in chunks for index in chunk ]
+
+    def _get_indexes_chunk(self, term, db_table, pks):
+        return list(Index.objects.filter(iexact=term, instance_db_table=db_table, instance_pk__in=pks))
+
+    def get_positions(self, db_table, terms, pks):
+        """ Returns {pk: {word: [positions]}} of the given words for the given pks """
+        positions = {}
+        for term in terms:
+            for index in self._get_indexes_for(term, db_table, pks):
+                positions.setdefault(index.instance_pk, {})[term] = index.get_positions()
+        return positions
+
+    def get_table_postings(self, db_table):
+        """ Returns {term: {pk: occurances}} of the whole table, for snapshotting small tables """
+        postings = {}
+        for index in Index.objects.filter(instance_db_table=db_table):
+            postings.setdefault(index.iexact, {})[index.instance_pk] = index.occurances
+        return postings
+
+    def get_indexed_instances(self, after=None, limit=MAX_BATCH_SIZE):
+        """
+            Returns ([(db_table, pk)], cursor) of the instances of up to limit Index rows
+            after the cursor, walking the rows in key order. The cursor is None at the end.
+        """
+        queryset = Index.objects.order_by("pk")
+        if after is not None:
+            queryset = queryset.filter(pk__gt=int(after))
+        rows = list(queryset.values_list("pk", "instance_db_table", "instance_pk")[:limit])
+        cursor = rows[-1][0] if len(rows) == limit else None
+        return [ (db_table, pk) for key, db_table, pk in rows ], cursor
+
+    def get_term_occurances(self, start=None, end=None, after=None, limit=MAX_BATCH_SIZE):
+        """
+            Returns ([(term, occurances)], more) of up to limit Index rows of the terms in
+            [start, end) after `after`, in term order. If more is True the rows of the last
+            term may carry on past the limit.
+        """
+        rows = list(
+            Index.objects.filter(**_term_range_filters("iexact", start, end, after)).order_by(
+                "iexact"
+            ).values_list("iexact", "occurances")[:limit]
+        )
+        return rows, len(rows) == limit
+
+    def get_term_total(self, term):
+        """ Returns the total occurances of the term in every table, streaming its rows """
+        return sum(Index.objects.filter(iexact=term).values_list("occurances", flat=True))
+
+    def get_term_total_batch(self, term, after=None, limit=MAX_BATCH_SIZE):
+        """
+            Returns (total, cursor) of the occurances in up to limit rows of the term after
+            the cursor, walking the rows in key order. The cursor is None once the term is done.
+        """
+        queryset = Index.objects.filter(iexact=term).order_by("pk")
+        if after is not None:
+            queryset = queryset.filter(pk__gt=int(after))
+        rows = list(queryset.values_list("pk", "occurances")[:limit])
+        cursor = rows[-1][0] if len(rows) == limit else None
+        return sum(occurances for key, occurances in rows), cursor
+
+    def get_postings(self, term, db_table):
+        """ Returns {pk: occurances} of the instances of the table containing the term """
+        return dict(
+            (index.instance_pk, index.occurances) for index in Index.objects.filter(iexact=term, instance_db_table=db_table)
+        )
+
+    def get_postings_multi(self, term, db_tables):
+        """ Returns {db_table: {pk: occurances}} of the term for each of the tables, in one query """
+        postings = dict((db_table, {}) for db_table in db_tables)
+        for index in Index.objects.filter(iexact=term, instance_db_table__in=list(db_tables)):
+            postings[index.instance_db_table][index.instance_pk] = index.occurances
+        return postings
+
+    def get_postings_for(self, term, db_table, pks, term_count):
+        """ Like get_postings, but only for the given pks """
+
+        # Looking up each pk is only worth it if the term is much more common
+        if term_count < len(pks) * POSTING_LOOKUP_RATIO:
+            return dict((pk, occurances) for pk, occurances in self.get_postings(term, db_table).items() if pk in pks)
+
+        return dict((index.instance_pk, index.occurances) for index in self._get_indexes_for(term, db_table, pks))
+
+
+class PostingListBackend(object):
+    """
+        Each instance is hashed into one of SEARCH_POSTING_BLOCKS blocks of the posting
+        list of a term, so writes to common terms are spread over the blocks and a term
+        is read with a single batch get of its blocks. Blocks which outgrow
+        SEARCH_POSTING_BLOCK_SIZE are split by pk range, which costs a second batch get.
+
+        The terms of each instance are also stored in an InstanceTerms, so that it can
+        be diffed and unindexed without querying.
+    """
+    rows = RowBackend()
+
+    def _get_stored(self, db_table, pk):
+        """
+            Returns (InstanceTerms or None, {term: occurances}, legacy Index rows). Instances
+            which were indexed by the rows backend are read from their Index rows.
+        """
+        record = InstanceTerms.objects.filter(pk=InstanceTerms.key_for(db_table, pk)).first()
+        if record:
+            return record, record.get_terms(), []
+
+        indexes = self.rows._get_indexes(db_table, pk)
+        return None, dict((index.iexact, index.occurances) for index in indexes), indexes
+
+    def _get_blocks(self, keys, pks=None):
+        """
+            Returns the blocks at the given (head) keys, or the blocks they were split into.
+            If {head key: pks} is given only the splits which can hold the pks are read.
+        """
+        blocks = []
+        split_keys = set()
+        for i in xrange(0, len(keys), MAX_BATCH_SIZE):
+            for posting_block in PostingBlock.objects.filter(pk__in=keys[i:i + MAX_BATCH_SIZE]):
+                splits = posting_block.get_splits()
+                if not splits:
+                    blocks.append(posting_block)
+                elif pks is None:
+                    split_keys.update(posting_block.key_for_split(lower) for lower in splits)
+                else:
+                    split_keys.update(posting_block.split_for(pk) for pk in pks[posting_block.pk])
+
+        split_keys = list(split_keys)
+        for i in xrange(0, len(split_keys), MAX_BATCH_SIZE):
+            blocks.extend(PostingBlock.objects.filter(pk__in=split_keys[i:i + MAX_BATCH_SIZE]))
+        return blocks
+
+    def _split_block(self, head, posting_block, postings):
+        """ Splits the postings of a full block in two by pk, and records the split in the head """
+        pks = sorted(postings)
+        middle = pks[len(pks) // 2]
+
+        splits = head.get_splits()
+        if not splits:
+            # The head itself is full, from now on it only holds the splits
+            splits = [ PostingBlock.FIRST_SPLIT ]
+            posting_block = PostingBlock(
+                pk=head.key_for_split(PostingBlock.FIRST_SPLIT), term=head.term, instance_db_table=head.instance_db_table
+            )
+            head.set_postings({})
+
+        upper = PostingBlock(pk=head.key_for_split(middle), term=head.term, instance_db_table=head.instance_db_table)
+        posting_block.set_postings(dict((pk, postings[pk]) for pk in pks if pk < middle))
+        upper.set_postings(dict((pk, postings[pk]) for pk in pks if pk >= middle))
+
+        bisect.insort(splits, middle)
+        head.set_splits(splits)
+        for changed in (head, posting_block, upper):
+            changed.save()
+
+    def _write_postings(self, db_table, pk, changes):
+        """ Applies {term: occurances} for the instance to the blocks, 0 removes the instance """
+        block = PostingBlock.block_for(pk)
+
+        def update_group(terms):
+            keys = dict((PostingBlock.key_for(db_table, term, block), term) for term in terms)
+            heads = PostingBlock.objects.in_bulk(keys.keys())
+            split_keys = [ head.split_for(pk) for head in heads.values() if head.get_splits() ]
+            splits = PostingBlock.objects.in_bulk(split_keys) if split_keys else {}
+
+            for key, term in keys.items():
+                head = heads.get(key) or PostingBlock(pk=key, term=term, instance_db_table=db_table)
+                posting_block = head
+                if head.get_splits():
+                    split_key = head.split_for(pk)
+                    posting_block = splits.get(split_key) or PostingBlock(pk=split_key, term=term, instance_db_table=db_table)
+
+                postings = posting_block.get_postings()
+                if changes[term]:
+                    postings[pk] = changes[term]
+                else:
+                    postings.pop(pk, None)
+
+                if len(postings) > PostingBlock.block_size():
+                    self._split_block(head, posting_block, postings)
+                elif postings:
+                    posting_block.set_postings(postings)
+                    posting_block.save()
+                elif posting_block.pk in heads and not head.get_splits():
+                    posting_block.delete()
+                elif posting_block.pk in splits:
+                    # Emptied splits stay recorded in the head, only the block goes
+                    posting_block.delete()
+
+        # A term can write its head and both halves of a split block
+        group_size = max(1, MAX_GROUPS_PER_TRANSACTION // 3)
+        terms = sorted(changes)
+        for i in xrange(0, len(terms), group_size):
+            _run_in_transaction(update_group, terms[i:i + group_size])
+
+    def get_instance_terms(self, db_table, pk):
+        return self._get_stored(db_table, pk)[1]
+
+    def update_instance(self, db_table, pk, term_occurances, term_positions=None, before_write=None):
+        record, stored, legacy_indexes = self._get_stored(db_table, pk)
+        deltas = _diff_terms(stored, term_occurances)
+
+        if legacy_indexes:
+            # Nothing is in the posting lists yet, so every term has to be written, but the
+            # counters already include the legacy rows so the deltas stay the same
+            changes = dict(term_occurances)
+        else:
+            changes = dict((term, term_occurances.get(term, 0)) for term in deltas)
+
+        # Words which have only moved don't touch the posting lists, but are still changes
+        if record and term_positions is not None:
+            stored_positions = record.get_positions()
+            for word, positions in term_positions.items():
+                if word not in deltas and stored_positions.get(word) != positions:
+                    deltas[word] = 0
+
+        logging.info("Indexing %s:%s, %s changed terms", db_table, pk, len(changes))
+
+        if before_write:
+            before_write(deltas)
+        self._write_postings(db_table, pk, changes)
+
+        if term_occurances:
+            record = record or InstanceTerms(pk=InstanceTerms.key_for(db_table, pk), instance_db_table=db_table, instance_pk=pk)
+            record.set_terms(term_occurances)
+            record.set_positions(term_positions)
+            record.save()
+        elif record:
+            record.delete()
+
+        self.rows._delete_indexes(legacy_indexes)
+        return deltas
+
+    def remove_instance(self, db_table, pk, before_write=None):
+        record, stored, legacy_indexes = self._get_stored(db_table, pk)
+        deltas = dict((term, -count) for term, count in stored.items())
+
+        if before_write:
+            before_write(deltas)
+        self._write_postings(db_table, pk, dict((term, 0) for term in stored))
+
+        if record:
+            record.delete()
+        self.rows._delete_indexes(legacy_indexes)
+
+        return deltas
+
+    def get_positions(self, db_table, terms, pks):
+        keys = [ InstanceTerms.key_for(db_table, pk) for pk in pks ]
+
+        positions = {}
+        for i in xrange(0, len(keys), MAX_BATCH_SIZE):
+            for record in InstanceTerms.objects.filter(pk__in=keys[i:i + MAX_BATCH_SIZE]):
+                record_positions = record.get_positions()
+                positions[record.instance_pk] = dict(
+                    (term, record_positions[term]) for term in terms if term in record_positions
+                )
+
+        if READ_LEGACY_INDEX:
+            missing = set(pks) - set(positions)
+            if missing:
+                positions.update(self.rows.get_positions(db_table, terms, missing))
+
+        return positions
+
+    def get_table_postings(self, db_table):
+        postings = {}
+        for posting_block in PostingBlock.objects.filter(instance_db_table=db_table):
+            postings.setdefault(posting_block.term, {}).update(posting_block.get_postings())
+
+        if READ_LEGACY_INDEX:
+            for term, legacy_postings in self.rows.get_table_postings(db_table).items():
+                for pk, occurances in legacy_postings.items():
+                    postings.setdefault(term, {}).setdefault(pk, occurances)
+
+        return postings
+
+    def get_indexed_instances(self, after=None, limit=MAX_BATCH_SIZE):
+        # Every instance has an InstanceTerms, legacy Index rows are left to the rows backend
+        queryset = InstanceTerms.objects.order_by("pk")
+        if after is not None:
+            queryset = queryset.filter(pk__gt=after)
+        records = list(queryset.values_list("pk", "instance_db_table", "instance_pk")[:limit])
+        cursor = records[-1][0] if len(records) == limit else None
+        return [ (db_table, pk) for key, db_table, pk in records ], cursor
+
+    def get_term_occurances(self, start=None, end=None, after=None, limit=MAX_BATCH_SIZE):
+        posting_blocks = PostingBlock.objects.filter(**_term_range_filters("term", start, end, after)).order_by("term")
+        entries = [ (posting_block.term, sum(posting_block.get_postings().values())) for posting_block in posting_blocks[:limit] ]
+        more = len(entries) == limit
+
+        if READ_LEGACY_INDEX:
+            legacy, legacy_more = self.rows.get_term_occurances(start, end, after, limit)
+
+            # Only the terms up to where the shorter of the two got to are complete
+            ends = [ found[-1][0] for found, full in ((entries, more), (legacy, legacy_more)) if full ]
+            entries = sorted(entries + legacy)
+            if ends:
+                entries = [ entry for entry in entries if entry[0] <= min(ends) ]
+            more = more or legacy_more
+
+        return entries, more
+
+    def get_term_total(self, term):
+        total = sum(
+            sum(posting_block.get_postings().values()) for posting_block in PostingBlock.objects.filter(term=term)
+        )
+        if READ_LEGACY_INDEX:
+            total += self.rows.get_term_total(term)
+        return total
+
+    def get_term_total_batch(self, term, after=None, limit=MAX_BATCH_SIZE):
+        # The cursor is "blocks:<key>" while reading the posting blocks, then "rows:<pk>" for legacy rows
+        source, _, key = (after or u"blocks:").partition(u":")
+        if source == u"rows":
+            total, cursor = self.rows.get_term_total_batch(term, key or None, limit)
+            return total, None if cursor is None else u"rows:%s" % cursor
+
+        queryset = PostingBlock.objects.filter(term=term).order_by("pk")
+        if key:
+            queryset = queryset.filter(pk__gt=key)
+        posting_blocks = list(queryset[:limit])
+        total = sum(sum(posting_block.get_postings().values()) for posting_block in posting_blocks)
+
+        if len(posting_blocks) == limit:
+            return total, u"blocks:%s" % posting_blocks[-1].pk
+        return total, u"rows:" if READ_LEGACY_INDEX else None
+
+    def get_postings(self, term, db_table):
+        keys = [ PostingBlock.key_for(db_table, term, block) for block in xrange(PostingBlock.blocks()) ]
+
+        postings = {}
+        for posting_block in self._get_blocks(keys):
+            postings.update(posting_block.get_postings())
+
+        if READ_LEGACY_INDEX:
+            for pk, occurances in self.rows.get_postings(term, db_table).items():
+                postings.setdefault(pk, occurances)
+
+        return postings
+
+    def get_postings_multi(self, term, db_tables):
+        keys = [
+            PostingBlock.key_for(db_table, term, block) for db_table in db_tables for block in xrange(PostingBlock.blocks())
+        ]
+
+        postings = dict((db_table, {}) for db_table in db_tables)
+        for posting_block in self._get_blocks(keys):
+            postings[posting_block.instance_db_table].update(posting_block.get_postings())
+
+        if READ_LEGACY_INDEX:
+            for db_table, legacy_postings in self.rows.get_postings_multi(term, db_tables).items():
+                for pk, occurances in legacy_postings.items():
+                    postings[db_table].setdefault(pk, occurances)
+
+        return postings
+
+    def get_postings_for(self, term, db_table, pks, term_count):
+        block_pks = {}
+        for pk in pks:
+            block_pks.setdefault(PostingBlock.key_for(db_table, term, PostingBlock.block_for(pk)), []).append(pk)
+
+        postings = {}
+        for posting_block in self._get_blocks(block_pks.keys(), block_pks):
+            postings.update(
+                (pk, occurances) for pk, occurances in posting_block.get_postings().items() if pk in pks
+            )
+
+        if READ_LEGACY_INDEX:
+            for pk, occurances in self.rows.get_postings_for(term, db_table, pks, term_count).items():
+                postings.setdefault(pk, occurances)
+
+        return postings
+
+
+BACKENDS = {
+    "rows": RowBackend,
+    "postings": PostingListBackend,
+}
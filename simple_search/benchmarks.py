@@ -0,0 +1,268 @@
+"""
+    Benchmarks of indexing throughput and search latency, run with:
+
+        manage.py search_benchmark --documents 1000 --output results.json
+
+    against the djangae test datastore stub, e.g. with djangae's --sandbox=test (it refuses to
+    run against any other datastore, and deletes its corpus afterwards). Documents
+    are generated with Zipfian word frequencies, so a few words are very common and most
+    are rare, like real text. The same seed generates the same corpus and queries, so the
+    JSON results of different runs (or revisions) can be compared.
+"""
+
+import bisect
+import json
+import platform
+import random
+import resource
+import time
+
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+from google.appengine.api import apiproxy_stub_map, datastore_file_stub
+from google.appengine.datastore import datastore_sqlite_stub
+
+from .models import (
+    COUNTER_SHARDS,
+    INDEX_BACKEND,
+    index_instance,
+    search,
+    unindex_instance,
+)
+
+RESULTS_VERSION = 1
+
+
+_benchmark_model = None
+
+def _get_benchmark_model():
+    """
+        The model of the generated documents. It's only built (and so registered with
+        its table and signals) once a benchmark runs, rather than whenever this module is imported.
+    """
+    global _benchmark_model
+    if _benchmark_model is None:
+        class Search:
+            fields = [
+                "title",
+                "body"
+            ]
+
+        class Meta:
+            app_label = "simple_search"
+
+        _benchmark_model = type("BenchmarkDocument", (models.Model, ), {
+            "__module__": __name__,
+            "title": models.CharField(max_length=500),
+            "body": models.TextField(),
+            "Search": Search,
+            "Meta": Meta,
+        })
+    return _benchmark_model
+
+
+# Counts the RPCs made while a counter is active, the hook can't be removed once added
+_rpc_counts = None
+
+def _count_rpc(service, call, request, response):
+    if _rpc_counts is not None:
+        key = "%s.%s" % (service, call)
+        _rpc_counts[key] = _rpc_counts.get(key, 0) + 1
+
+_hook_installed = False
+
+def _install_rpc_hook():
+    global _hook_installed
+    if not _hook_installed:
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append("simple_search_benchmark", _count_rpc)
+        _hook_installed = True
+
+
+class RpcCounter(object):
+    """ Counts RPCs by "service.call" within a with block """
+    def __enter__(self):
+        global _rpc_counts
+        _install_rpc_hook()
+        self.counts = _rpc_counts = {}
+        return self
+
+    def __exit__(self, *args):
+        global _rpc_counts
+        _rpc_counts = None
+
+    def total(self, service=None):
+        return sum(
+            count for key, count in self.counts.items() if service is None or key.startswith(service + ".")
+        )
+
+
+def _using_test_datastore():
+    """ Whether the datastore is an in-memory stub, as in the test sandbox, rather than one holding real data """
+    stub = apiproxy_stub_map.apiproxy.GetStub("datastore_v3")
+    if isinstance(stub, datastore_file_stub.DatastoreFileStub):
+        datastore_file = getattr(stub, "_DatastoreFileStub__datastore_file", None)
+    elif isinstance(stub, datastore_sqlite_stub.DatastoreSqliteStub):
+        datastore_file = getattr(stub, "_DatastoreSqliteStub__datastore_file", None)
+    else:
+        return False
+    return datastore_file in (None, "", ":memory:")
+
+
+def _peak_memory_kb():
+    # ru_maxrss is in kilobytes on Linux, but bytes on OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if platform.system() == "Darwin" else peak
+
+
+def _percentile(timings, percentile):
+    timings = sorted(timings)
+    if not timings:
+        return None
+    return timings[min(len(timings) - 1, int(len(timings) * percentile / 100.0))]
+
+
+class ZipfianCorpus(object):
+    """
+        Generates documents whose words follow Zipf's law: the nth most common word of
+        the vocabulary occurs with a frequency proportional to 1 / n ** exponent
+    """
+    def __init__(self, vocabulary_size=10000, exponent=1.1, seed=0):
+        self.random = random.Random(seed)
+        self.vocabulary = [ self._make_word(i) for i in xrange(vocabulary_size) ]
+
+        self.cumulative = []
+        total = 0.0
+        for rank in xrange(1, vocabulary_size + 1):
+            total += 1.0 / rank ** exponent
+            self.cumulative.append(total)
+
+    def _make_word(self, i):
+        # Distinct, pronounceable-ish words of varying length
+        consonants, vowels = "bcdfghjklmnprstvwz", "aeiou"
+        word = []
+        i += 1
+        while i:
+            i, remainder = divmod(i, len(consonants) * len(vowels))
+            word.append(consonants[remainder % len(consonants)] + vowels[remainder // len(consonants)])
+        return "".join(word)
+
+    def word(self):
+        position = bisect.bisect_left(self.cumulative, self.random.random() * self.cumulative[-1])
+        return self.vocabulary[min(position, len(self.vocabulary) - 1)]
+
+    def text(self, length):
+        return " ".join(self.word() for i in xrange(length))
+
+    def documents(self, count, title_length=5, body_length=100):
+        for i in xrange(count):
+            yield self.text(title_length), self.text(body_length)
+
+    def queries(self, documents, count):
+        """ Returns {query type: [search string]}, phrases are taken from the documents """
+        rare = self.vocabulary[len(self.vocabulary) // 2:]
+        common = self.vocabulary[:20]
+        queries = {
+            "rare": [ self.random.choice(rare) for i in xrange(count) ],
+            "common": [ self.random.choice(common) for i in xrange(count) ],
+            "multi_term": [ " ".join(self.word() for j in xrange(self.random.randint(2, 3))) for i in xrange(count) ],
+            "phrase": [],
+        }
+        for i in xrange(count):
+            words = self.random.choice(documents)[1].split(" ")
+            start = self.random.randint(0, max(len(words) - 3, 0))
+            queries["phrase"].append('"%s"' % " ".join(words[start:start + 3]))
+        return queries
+
+
+def run_benchmark(documents=1000, title_length=5, body_length=100, vocabulary_size=10000,
+                  exponent=1.1, queries=50, seed=0, progress=None):
+    """
+        Indexes a generated corpus one instance at a time then runs each type of query
+        against it, returning the results as a dict which can be dumped as JSON.
+        The corpus is unindexed and deleted again afterwards.
+    """
+    if not _using_test_datastore():
+        raise RuntimeError("The benchmark writes a generated corpus, only run it against the test datastore stub")
+
+    BenchmarkDocument = _get_benchmark_model()
+    corpus = ZipfianCorpus(vocabulary_size, exponent, seed)
+    texts = list(corpus.documents(documents, title_length, body_length))
+
+    instances = BenchmarkDocument.objects.bulk_create([
+        BenchmarkDocument(title=title, body=body) for title, body in texts
+    ])
+    if not all(instance.pk for instance in instances):
+        instances = list(BenchmarkDocument.objects.all())
+
+    try:
+        return _run_benchmark(corpus, texts, instances, queries, progress, {
+            "documents": documents,
+            "title_length": title_length,
+            "body_length": body_length,
+            "vocabulary_size": vocabulary_size,
+            "exponent": exponent,
+            "queries": queries,
+            "seed": seed,
+        })
+    finally:
+        for instance in instances:
+            unindex_instance(instance)
+        # Deleted without signals, they've been unindexed already so there's nothing to tombstone
+        corpus_queryset = BenchmarkDocument.objects.all()
+        corpus_queryset._raw_delete(corpus_queryset.db)
+
+
+def _run_benchmark(corpus, texts, instances, queries, progress, config):
+    BenchmarkDocument = _get_benchmark_model()
+    fields_to_index = BenchmarkDocument.Search.fields
+
+    with RpcCounter() as rpcs:
+        start = time.time()
+        for i, instance in enumerate(instances):
+            index_instance(instance, fields_to_index, defer_index=False)
+            if progress and (i + 1) % 100 == 0:
+                progress("Indexed %s of %s" % (i + 1, len(instances)))
+        indexing_seconds = time.time() - start
+
+    results = {
+        "version": RESULTS_VERSION,
+        "timestamp": timezone.now().isoformat(),
+        "config": config,
+        "settings": {
+            "index_backend": INDEX_BACKEND,
+            "counter_shards": COUNTER_SHARDS,
+            "result_cache_timeout": getattr(settings, "SEARCH_RESULT_CACHE_TIMEOUT", 0),
+        },
+        "indexing": {
+            "seconds": indexing_seconds,
+            "instances_per_second": len(instances) / max(indexing_seconds, 1e-6),
+            "datastore_rpcs_per_instance": rpcs.total("datastore_v3") / float(max(len(instances), 1)),
+            "rpcs": rpcs.counts,
+        },
+        "search": {},
+    }
+
+    for query_type, search_strings in sorted(corpus.queries(texts, queries).items()):
+        timings = []
+        with RpcCounter() as rpcs:
+            for search_string in search_strings:
+                start = time.time()
+                search(BenchmarkDocument, search_string)
+                timings.append(time.time() - start)
+
+        results["search"][query_type] = {
+            "p50_ms": _percentile(timings, 50) * 1000,
+            "p99_ms": _percentile(timings, 99) * 1000,
+            "datastore_rpcs_per_search": rpcs.total("datastore_v3") / float(max(len(search_strings), 1)),
+        }
+        if progress:
+            progress("Searched %s %s queries" % (len(search_strings), query_type))
+
+    results["peak_memory_kb"] = _peak_memory_kb()
+    return results
+
+
+def dump_results(results, fileobj):
+    json.dump(results, fileobj, indent=2, sort_keys=True)
@@ -1,31 +1,212 @@
+import collections
 import copy
+import cPickle
+import hashlib
 import logging
+import threading
 import time
+import uuid
 
+from django.conf import settings
 from django.core.cache import cache
+from django.utils.encoding import smart_str
 from django.db.models.query import QuerySet
 from django.db import models
 
 from google.appengine.api.datastore import IsInTransaction
 
-#Adds basic caching on unique_together and PK fields
-# TODO: add unique=True caching
+#Adds basic caching on unique_together, unique and PK fields. Instances are cached in a
+#per-process LRU in front of memcache, so the local tier can be up to LOCAL_CACHE_TTL seconds stale
+
+LOCAL_CACHE_SIZE = getattr(settings, "SEARCH_LOCAL_CACHE_SIZE", 1000) #0 disables the local tier
+LOCAL_CACHE_TTL = getattr(settings, "SEARCH_LOCAL_CACHE_TTL", 5)
+
+class LocalCache(object):
+    """
+        A per-process LRU cache holding at most max_size entries for at most ttl seconds.
+        Values are pickled, so callers get their own copy like they would from memcache.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry is None:
+                    continue
+
+                expires, value = entry
+                if expires > now:
+                    self._entries[key] = entry #Most recently used
+                    found[key] = value
+
+        return dict((key, cPickle.loads(value)) for key, value in found.items())
+
+    def set_many(self, mapping, timeout=None):
+        if not self.max_size:
+            return
+
+        expires = time.time() + min(self.ttl, timeout or self.ttl)
+        entries = [ (key, cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)) for key, value in mapping.items() ]
+        with self._lock:
+            for key, value in entries:
+                self._entries.pop(key, None)
+                self._entries[key] = (expires, value)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+local_cache = LocalCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+
+#Stands in the local tier for a marker memcache doesn't have
+_ABSENT = "simple_search:absent"
+
+def tiered_get_many(keys, markers=()):
+    """
+        Gets the keys from the local tier, then memcache. Markers (keys which are read far
+        more often than they are set) are also remembered locally when memcache doesn't
+        have them, so that checking them doesn't cost a memcache round trip each time.
+    """
+    found = local_cache.get_many(keys + list(markers))
+    missing = [ key for key in keys + list(markers) if key not in found ]
+    if missing:
+        from_memcache = cache.get_many(missing)
+        local_cache.set_many(from_memcache)
+        local_cache.set_many(dict((key, _ABSENT) for key in markers if key in missing and key not in from_memcache))
+        found.update(from_memcache)
+    return dict((key, value) for key, value in found.items() if value != _ABSENT)
+
+def tiered_set_many(mapping, timeout=None):
+    if timeout is None:
+        cache.set_many(mapping) #The default timeout
+    else:
+        cache.set_many(mapping, timeout)
+    local_cache.set_many(mapping, timeout)
+
+def tiered_add_many(mapping, timeout=None):
+    """
+        Like tiered_set_many, but only stores the values memcache doesn't have yet. For
+        filling the cache on a read, which mustn't overwrite what a concurrent save stored.
+    """
+    added = {}
+    for key, value in mapping.items():
+        if cache.add(key, value) if timeout is None else cache.add(key, value, timeout):
+            added[key] = value
+    local_cache.set_many(added, timeout)
+
+def tiered_delete_many(keys):
+    local_cache.delete_many(keys)
+    cache.delete_many(keys)
+
+def _deleted_key(pk):
+    return "DELETED_%s" % pk
+
+def _get_unique_combinations(model):
+    """ The sets of fields which identify an instance, and so can be cached on """
+    return (
+        [ tuple(unique_together) for unique_together in model._meta.unique_together ] +
+        [ (field.attname, ) for field in model._meta.local_fields if field.unique and not field.primary_key ] +
+        [ ("pk", ), ("id", ) ]
+    )
 
 class BasicCachingQueryset(QuerySet):
+    def _clone(self, *args, **kwargs):
+        clone = super(BasicCachingQueryset, self)._clone(*args, **kwargs)
+        clone._cached_pks = getattr(self, "_cached_pks", None)
+        return clone
+
+    def filter(self, *args, **kwargs):
+        lookups = set(kwargs.keys())
+        cacheable = (
+            not args and len(lookups) == 1 and lookups.issubset(["pk__in", "id__in"]) and
+            not self.query.where.children and getattr(self, "_cached_pks", None) is None
+        )
+
+        if cacheable:
+            #The pks may be a generator, which the filter would use up
+            kwargs = { kwargs.keys()[0]: list(kwargs.values()[0]) }
+
+        clone = super(BasicCachingQueryset, self).filter(*args, **kwargs)
+        #Only a lone pk__in lookup can be served from the cache
+        clone._cached_pks = kwargs.values()[0] if cacheable else None
+        return clone
+
+    def _can_use_cache(self):
+        query = self.query
+        return (
+            getattr(self, "_cached_pks", None) is not None and
+            not IsInTransaction() and
+            len(query.where.children) == 1 and not self.ordered and
+            query.low_mark == 0 and query.high_mark is None and
+            not query.select_related and not query.deferred_loading[0]
+        )
+
+    def iterator(self):
+        if not self._can_use_cache():
+            for instance in super(BasicCachingQueryset, self).iterator():
+                yield instance
+            return
+
+        #Serve what we can from the cache, and the rest with one query
+        keys_seen = set()
+        pks = []
+        for pk in map(self.model._meta.pk.to_python, self._cached_pks):
+            if pk not in keys_seen:
+                keys_seen.add(pk)
+                pks.append(pk)
+
+        keys = dict((pk, self.model._make_key(("pk", ), { "pk": pk })) for pk in pks)
+        cached = tiered_get_many(keys.values(), [ _deleted_key(pk) for pk in pks ])
+
+        instances = dict((pk, cached[key]) for pk, key in keys.items() if key in cached)
+        missing = [ pk for pk in pks if pk not in instances ]
+        if missing:
+            fetched = list(QuerySet(self.model, using=self.db).filter(pk__in=missing))
+            tiered_add_many(dict((key, instance) for instance in fetched for key in instance._get_cache_keys()))
+            instances.update((instance.pk, instance) for instance in fetched)
+
+        for pk in pks:
+            if pk in instances and not cached.get(_deleted_key(pk)):
+                yield instances[pk]
+
     def get(self, *args, **kwargs):
         if not IsInTransaction():
-            for unique_together in self.model._meta.unique_together + [ ("pk", ), ("id",)]:
+            for unique_together in _get_unique_combinations(self.model):
                 if set(unique_together).issubset(set(kwargs.keys())):
                     #We can hit the cache
                     key = self.model._make_key(unique_together, kwargs)
-                    instance = cache.get(key)
+                    if unique_together in (("pk", ), ("id", )):
+                        #The deleted marker is fetched along with the instance
+                        deleted_key = _deleted_key(self.model._meta.pk.to_python(kwargs[unique_together[0]]))
+                        cached = tiered_get_many([ key ], [ deleted_key ])
+                        instance = None if deleted_key in cached else cached.get(key)
+                    else:
+                        instance = tiered_get_many([ key ]).get(key)
+                        if instance and tiered_get_many([], [ _deleted_key(instance.pk) ]):
+                            instance = None
+
                     if instance:
                         #FIXME: Check against any other arguments
                         return instance
 
         instance = super(BasicCachingQueryset, self).get(*args, **kwargs)
 
-        if cache.get("DELETED_%s" % instance.pk):
+        if tiered_get_many([], [ _deleted_key(instance.pk) ]):
             #WORKAROUND FOR WHEN HRD LIES
             raise self.model.DoesNotExist()
 
@@ -59,23 +240,23 @@ class BasicCachedModel(models.Model):
 
     def _get_original_keys(self):
         keys = []
-        for unique_together in self._meta.unique_together + [ ("pk",), ("id",)]:
+        for unique_together in _get_unique_combinations(self):
             keys.append(self._make_key(unique_together, self._original_state))
         return keys
 
     def _get_cache_keys(self):
         keys = []
-        for unique_together in self._meta.unique_together + [ ("pk",), ("id",)]:
+        for unique_together in _get_unique_combinations(self):
             keys.append(self._make_key(unique_together, self._as_dict()))
         return keys
 
     def _cache(self):
         logging.info("Caching with keys: %s", self._get_cache_keys())
-        cache.set_many( { key:self for key in self._get_cache_keys()} )
+        tiered_set_many( { key:self for key in self._get_cache_keys()} )
 
     def _uncache(self):
         logging.info("Uncaching with keys: %s", self._get_cache_keys())
-        cache.delete_many(self._get_original_keys())
+        tiered_delete_many(self._get_original_keys())
 
     def save(self, *args, **kwargs):
         if not self._state.adding:
@@ -90,9 +271,119 @@ class BasicCachedModel(models.Model):
         self._uncache()
         super(BasicCachedModel, self).delete(*args, **kwargs)
 
-        #Mark for 10 seconds that this instance has been deleted
-        #as HRD sometimes still returns it
-        cache.set("DELETED_%s" % self.pk, True, 10)
+        #Mark for 10 seconds (or as long as other processes' local tiers may hold it) that
+        #this instance has been deleted as HRD sometimes still returns it
+        tiered_set_many({ _deleted_key(self.pk): True }, max(10, LOCAL_CACHE_TTL))
 
     class Meta:
         abstract = True
+
+
+#Caches the ranked results of search(), invalidated by per-term generations.
+#Every (un)indexing of a term gives the term a new generation, and the generations of
+#the terms are part of the key of a cached result, so only results using the term are invalidated
+
+RESULT_CACHE_TIMEOUT = getattr(settings, "SEARCH_RESULT_CACHE_TIMEOUT", 0) #Disabled by default
+
+def _term_generation_key(term):
+    return "simple_search:generation:%s" % hashlib.md5(smart_str(term)).hexdigest()
+
+def _new_generation():
+    # Generations only need to change, so unique values mean an evicted generation
+    # can never come back and resurrect a stale result
+    return uuid.uuid4().hex
+
+def get_term_generations(terms):
+    keys = dict((_term_generation_key(term), term) for term in terms)
+    generations = cache.get_many(keys.keys())
+
+    missing = dict((key, _new_generation()) for key in keys if key not in generations)
+    if missing:
+        cache.set_many(missing, RESULT_CACHE_TIMEOUT)
+        generations.update(missing)
+
+    return dict((term, generations[key]) for key, term in keys.items())
+
+def bump_term_generations(terms):
+    if not RESULT_CACHE_TIMEOUT or not terms:
+        return
+
+    cache.set_many(
+        dict((_term_generation_key(term), _new_generation()) for term in terms), RESULT_CACHE_TIMEOUT
+    )
+
+def get_results_cache_key(db_table, terms, filters, limit):
+    generations = get_term_generations(set(terms))
+    key = repr((
+        db_table,
+        sorted(generations.items()),
+        sorted(filters.items()),
+        limit
+    ))
+    return "simple_search:results:%s" % hashlib.md5(smart_str(key)).hexdigest()
+
+def get_cached_results(db_table, terms, filters, limit):
+    """
+        Returns (key, ranked pks) for a search. The pks are None if they aren't cached,
+        and the key is None if result caching is disabled.
+    """
+    if not RESULT_CACHE_TIMEOUT:
+        return None, None
+
+    key = get_results_cache_key(db_table, terms, filters, limit)
+    return key, cache.get(key)
+
+def cache_results(key, ranked_pks):
+    if key:
+        cache.set(key, ranked_pks, RESULT_CACHE_TIMEOUT)
+
+
+#Snapshots of ranked results which search_with_cursor() pages through, so deep pages are
+#cheap and results don't shift between pages when the index changes
+
+CURSOR_TIMEOUT = getattr(settings, "SEARCH_CURSOR_TIMEOUT", 60 * 60)
+
+def store_snapshot(ranked_pks):
+    snapshot_id = uuid.uuid4().hex
+    cache.set("simple_search:snapshot:%s" % snapshot_id, ranked_pks, CURSOR_TIMEOUT)
+    return snapshot_id
+
+def get_snapshot(snapshot_id):
+    return cache.get("simple_search:snapshot:%s" % snapshot_id)
+
+
+#The pks of the deleted instances of each table which haven't been unindexed yet, so
+#searches don't query the IndexTombstones every time. Like the term generations above,
+#each table's generation is replaced whenever it gets a tombstone.
+
+TOMBSTONE_CACHE_TIMEOUT = getattr(settings, "SEARCH_TOMBSTONE_CACHE_TIMEOUT", 5 * 60)
+
+def _tombstone_generation_key(db_table):
+    return "simple_search:tombstone_generation:%s" % db_table
+
+def get_cached_tombstones(db_tables):
+    """
+        Returns ({db_table: key}, {db_table: tombstoned pks}) for the tables, the pks
+        only being included if they are cached
+    """
+    generation_keys = dict((_tombstone_generation_key(db_table), db_table) for db_table in db_tables)
+    generations = cache.get_many(generation_keys.keys())
+
+    missing = dict((key, _new_generation()) for key in generation_keys if key not in generations)
+    if missing:
+        cache.set_many(missing)
+        generations.update(missing)
+
+    keys = dict(
+        (db_table, "simple_search:tombstones:%s" % generations[key]) for key, db_table in generation_keys.items()
+    )
+    cached = cache.get_many(keys.values())
+    return keys, dict((db_table, cached[key]) for db_table, key in keys.items() if key in cached)
+
+def cache_tombstones(keys, tombstoned):
+    cache.set_many(
+        dict((keys[db_table], list(pks)) for db_table, pks in tombstoned.items()), TOMBSTONE_CACHE_TIMEOUT
+    )
+
+def bump_tombstone_generation(db_table):
+    cache.set(_tombstone_generation_key(db_table), _new_generation())
@@ -0,0 +1,435 @@
+"""
+    Long running jobs which walk whole tables. Each job records its progress in a
+    JobCheckpoint, so that a job which dies can be resumed where it stopped.
+"""
+
+import functools
+import logging
+import multiprocessing
+import time
+
+from django.db import models
+from django.utils import timezone
+
+from google.appengine.ext import deferred
+
+from . import stats
+from .models import (
+    COUNTER_SHARDS,
+    MAX_BATCH_SIZE,
+    MAX_IN_FILTER_SIZE,
+    QUEUE_FOR_INDEXING,
+    GlobalOccuranceCount,
+    GlobalOccuranceCountShard,
+    JobCheckpoint,
+    _clear_tombstones,
+    _get_model,
+    _index_loaded_instance,
+    _model_label,
+    _prefetch_related,
+    _run_concurrently,
+    _run_in_transaction,
+    _set_occurance_counts,
+    _term_range_filters,
+    get_index_backend,
+    unindex_instance,
+)
+
+DEFAULT_CHUNK_SIZE = 100
+
+# How long a task keeps walking a table before handing over to a new task,
+# comfortably inside the 10 minute deadline of task queue requests
+TASK_TIME_BUDGET = 5 * 60
+
+DEFAULT_RECOUNT_SHARDS = 8
+
+SWEEP_JOB_ID = "sweep"
+
+# The terms of a recount are split between its shards by their first character
+RECOUNT_BOUNDARIES = u"0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def get_checkpoint(job_id, restart=False):
+    if restart:
+        JobCheckpoint.objects.filter(pk=job_id).delete()
+
+    checkpoint, created = JobCheckpoint.objects.get_or_create(pk=job_id)
+    return checkpoint
+
+
+def record_progress(job_id, instances=0, terms=0, cursor=None, pending=0, walked=False, corrected=0, term=None):
+    """ term: the (term, cursor, total) a recount is part way through, (None, None, 0) when done with it """
+    def update():
+        checkpoint = JobCheckpoint.objects.get(pk=job_id)
+        checkpoint.instances += instances
+        checkpoint.terms += terms
+        checkpoint.corrected += corrected
+        checkpoint.pending += pending
+        if cursor is not None:
+            checkpoint.cursor = unicode(cursor)
+        if term is not None:
+            checkpoint.term, checkpoint.term_cursor, checkpoint.term_total = term
+            if checkpoint.term_cursor is not None:
+                checkpoint.term_cursor = unicode(checkpoint.term_cursor)
+        if walked:
+            checkpoint.walked = True
+        if checkpoint.walked and checkpoint.pending <= 0 and not checkpoint.finished:
+            checkpoint.finished = timezone.now()
+        checkpoint.save()
+        return checkpoint
+
+    return _run_in_transaction(update)
+
+
+def _next_chunk(model_class, cursor, chunk_size):
+    queryset = model_class.objects.order_by("pk")
+    if cursor is not None:
+        queryset = queryset.filter(pk__gt=model_class._meta.pk.to_python(cursor))
+    return list(queryset.values_list("pk", flat=True)[:chunk_size])
+
+
+def reindex_job_id(model_class):
+    return "reindex:%s" % model_class._meta.db_table
+
+
+@stats.instrument("index_chunk")
+def index_chunk(model_label, pks):
+    """
+        Indexes the given instances with a single batch fetch (and one per relation they
+        index fields of), returns (instances, terms)
+    """
+    model_class = _get_model(model_label)
+    fields_to_index = model_class.Search.fields
+
+    with stats.current().phase("fetch"):
+        loaded = list(model_class.objects.filter(pk__in=pks))
+        _prefetch_related(loaded, fields_to_index)
+
+    instances = terms = 0
+    for instance in loaded:
+        terms += _index_loaded_instance(instance, fields_to_index)
+        instances += 1
+
+    return instances, terms
+
+
+def _index_chunk_in_pool(args):
+    model_label, pks = args
+    instances, terms = index_chunk(model_label, pks)
+    return pks[-1], instances, terms
+
+
+def _deferred_index_chunk(model_label, pks, job_id):
+    instances, terms = index_chunk(model_label, pks)
+    record_progress(job_id, instances=instances, terms=terms, pending=-1)
+
+
+def _deferred_walk(model_label, job_id, chunk_size):
+    """
+        Walks the table from the checkpoint, deferring a task for each chunk. Hands over
+        to a new task before the deadline.
+    """
+    model_class = _get_model(model_label)
+    cursor = JobCheckpoint.objects.get(pk=job_id).cursor
+    deadline = time.time() + TASK_TIME_BUDGET
+
+    while time.time() < deadline:
+        pks = _next_chunk(model_class, cursor, chunk_size)
+        if not pks:
+            record_progress(job_id, walked=True)
+            logging.info("Finished walking %s for %s", model_label, job_id)
+            return
+
+        deferred.defer(_deferred_index_chunk, model_label, pks, job_id, _queue=QUEUE_FOR_INDEXING)
+        cursor = pks[-1]
+        record_progress(job_id, cursor=cursor, pending=1)
+
+    deferred.defer(_deferred_walk, model_label, job_id, chunk_size, _queue=QUEUE_FOR_INDEXING)
+
+
+def reindex_model(model_class, chunk_size=DEFAULT_CHUNK_SIZE, defer=True, processes=None, restart=False, progress=None):
+    """
+        Indexes every instance of model_class, walking the table in pk order in chunks.
+
+        defer: fan the chunks out as deferred tasks and return straight away
+        processes: when not deferring, the number of local processes to index with
+        restart: ignore the checkpoint of a previous run rather than resuming it
+        progress: called with the JobCheckpoint after each chunk when not deferring
+
+        Returns the JobCheckpoint of the job.
+    """
+    model_label = _model_label(model_class)
+    job_id = reindex_job_id(model_class)
+    checkpoint = get_checkpoint(job_id, restart=restart)
+
+    if checkpoint.finished:
+        logging.info("%s has already finished, pass restart=True to run it again", job_id)
+        return checkpoint
+
+    if defer:
+        deferred.defer(_deferred_walk, model_label, job_id, chunk_size, _queue=QUEUE_FOR_INDEXING)
+        return checkpoint
+
+    def chunks():
+        cursor = checkpoint.cursor
+        while True:
+            pks = _next_chunk(model_class, cursor, chunk_size)
+            if not pks:
+                return
+            yield model_label, pks
+            cursor = pks[-1]
+
+    if processes:
+        pool = multiprocessing.Pool(processes)
+        # imap returns the chunks in order, so the cursor never skips an unfinished chunk
+        results = pool.imap(_index_chunk_in_pool, chunks())
+    else:
+        pool = None
+        results = (_index_chunk_in_pool(chunk) for chunk in chunks())
+
+    try:
+        for cursor, instances, terms in results:
+            checkpoint = record_progress(job_id, instances=instances, terms=terms, cursor=cursor)
+            if progress:
+                progress(checkpoint)
+    finally:
+        if pool:
+            pool.terminate()
+
+    return record_progress(job_id, walked=True)
+
+
+def recount_job_id(shard, shards):
+    return "recount:%s/%s" % (shard, shards)
+
+
+def _recount_range(shard, shards):
+    """ Returns the [start, end) of the terms recounted by a shard, None being unbounded """
+    bounds = [ RECOUNT_BOUNDARIES[len(RECOUNT_BOUNDARIES) * i // shards] for i in xrange(1, shards) ]
+    bounds = [ None ] + bounds + [ None ]
+    return bounds[shard], bounds[shard + 1]
+
+
+def recount_batch(start, end, after, batch_size):
+    """
+        Recounts the terms of the next batch_size postings in [start, end) after `after`,
+        reading the index in term order, and corrects their GlobalOccuranceCounts. Counters
+        in the same range whose terms are no longer indexed are zeroed.
+
+        The postings of the last term may carry on past the batch, so if the batch is full
+        the last term is left to recount_term_batch.
+
+        Returns (the last term or None once the range is done, terms, corrected)
+    """
+    entries, more = get_index_backend().get_term_occurances(start, end, after, batch_size)
+    last = entries[-1][0] if more else None
+
+    counts = {}
+    for term, occurances in entries:
+        if term != last:
+            counts[term] = counts.get(term, 0) + occurances
+
+    def stale_filters(field):
+        filters = _term_range_filters(field, start, end, after)
+        if last is not None:
+            filters[field + "__lt"] = last
+        return filters
+
+    stale = set(GlobalOccuranceCount.objects.filter(**stale_filters("pk")).values_list("pk", flat=True))
+    if COUNTER_SHARDS > 1:
+        stale.update(GlobalOccuranceCountShard.objects.filter(**stale_filters("term")).values_list("term", flat=True))
+
+    for term in stale - set(counts):
+        counts[term] = 0
+
+    return last, len(counts), _set_occurance_counts(counts)
+
+
+def recount_term_batch(term, cursor, total, batch_size):
+    """
+        Adds up the next batch_size postings (or posting blocks) of a single term to the
+        total so far, and corrects its GlobalOccuranceCount once all of them have been read.
+
+        Returns (the cursor within the term or None once it's done, total, corrected)
+    """
+    partial, cursor = get_index_backend().get_term_total_batch(term, cursor, batch_size)
+    total += partial
+    corrected = _set_occurance_counts({term: total}) if cursor is None else 0
+    return cursor, total, corrected
+
+
+def _recount_shard(shard, shards, batch_size, job_id, deadline=None, progress=None):
+    """ Recounts the terms of the shard from its checkpoint, returns True once it is done """
+    start, end = _recount_range(shard, shards)
+    checkpoint = JobCheckpoint.objects.get(pk=job_id)
+
+    while deadline is None or time.time() < deadline:
+        if checkpoint.term is not None:
+            # Part way through a term, whose partial total is checkpointed after each batch
+            term = checkpoint.term
+            cursor, total, corrected = recount_term_batch(term, checkpoint.term_cursor, checkpoint.term_total, batch_size)
+            if cursor is None:
+                checkpoint = record_progress(job_id, terms=1, corrected=corrected, cursor=term, term=(None, None, 0))
+            else:
+                checkpoint = record_progress(job_id, term=(term, cursor, total))
+        else:
+            last, terms, corrected = recount_batch(start, end, checkpoint.cursor, batch_size)
+            checkpoint = record_progress(
+                job_id, terms=terms, corrected=corrected, walked=last is None,
+                term=None if last is None else (last, None, 0)
+            )
+
+        if progress:
+            progress(checkpoint)
+        if checkpoint.walked:
+            logging.info("Finished recounting for %s, corrected %s terms", job_id, checkpoint.corrected)
+            return True
+
+    return False
+
+
+def _deferred_recount(shard, shards, batch_size, job_id):
+    if not _recount_shard(shard, shards, batch_size, job_id, deadline=time.time() + TASK_TIME_BUDGET):
+        deferred.defer(_deferred_recount, shard, shards, batch_size, job_id, _queue=QUEUE_FOR_INDEXING)
+
+
+def recount_occurances(shards=DEFAULT_RECOUNT_SHARDS, batch_size=MAX_BATCH_SIZE, defer=True, restart=False, progress=None):
+    """
+        Corrects any GlobalOccuranceCounts which have drifted from the index. The terms
+        are split by their first character into shards, each shard reads its part of the
+        index in term order and sums up batch_size postings (or posting blocks) at a time.
+        A term with more postings than that is summed over several batches.
+
+        The recount doesn't lock out indexing: if a term is (un)indexed between its postings
+        being read and its counter being written, that change is lost from the counter. Run
+        it while nothing is being indexed, or run it again afterwards.
+
+        defer: run each shard as a chain of deferred tasks and return straight away
+        restart: ignore the checkpoints of a previous run rather than resuming them
+        progress: called with the JobCheckpoint of a shard after each batch when not deferring
+
+        Returns the JobCheckpoints of the shards.
+    """
+    if not 1 <= shards <= len(RECOUNT_BOUNDARIES):
+        raise ValueError("A recount can be split into 1 to %s shards" % len(RECOUNT_BOUNDARIES))
+
+    checkpoints = []
+    for shard in xrange(shards):
+        job_id = recount_job_id(shard, shards)
+        checkpoint = get_checkpoint(job_id, restart=restart)
+
+        if checkpoint.finished:
+            logging.info("%s has already finished, pass restart=True to run it again", job_id)
+        elif defer:
+            deferred.defer(_deferred_recount, shard, shards, batch_size, job_id, _queue=QUEUE_FOR_INDEXING)
+        else:
+            _recount_shard(shard, shards, batch_size, job_id, progress=progress)
+            checkpoint = JobCheckpoint.objects.get(pk=job_id)
+
+        checkpoints.append(checkpoint)
+
+    return checkpoints
+
+
+def _get_model_for_table(db_table):
+    for model_class in models.get_models():
+        if model_class._meta.db_table == db_table:
+            return model_class
+    return None
+
+
+def _existing_pks(model_class, pks):
+    return list(model_class.objects.filter(pk__in=pks).values_list("pk", flat=True))
+
+
+def sweep_batch(after, batch_size):
+    """
+        Unindexes the instances of the next batch_size index entries after the cursor
+        which no longer exist, e.g. because they were deleted without signals being
+        sent or their cleanup task was lost.
+
+        Returns (the cursor of the next batch or None once done, instances checked, orphans)
+    """
+    entries, cursor = get_index_backend().get_indexed_instances(after, batch_size)
+
+    table_pks = {}
+    for db_table, pk in entries:
+        table_pks.setdefault(db_table, set()).add(pk)
+
+    instances = orphans = 0
+    for db_table, pks in table_pks.items():
+        model_class = _get_model_for_table(db_table)
+        if model_class is None:
+            logging.warning("Not sweeping the index of %s, it has no model", db_table)
+            continue
+
+        pks = sorted(pks)
+        existing = set(
+            pk for chunk in _run_concurrently([
+                functools.partial(_existing_pks, model_class, pks[i:i + MAX_IN_FILTER_SIZE])
+                for i in xrange(0, len(pks), MAX_IN_FILTER_SIZE)
+            ]) for pk in chunk
+        )
+
+        missing = [ pk for pk in pks if pk not in existing ]
+        for pk in missing:
+            logging.info("Unindexing orphaned %s:%s", db_table, pk)
+            unindex_instance(model_class(pk=pk))
+
+        if missing:
+            _clear_tombstones(db_table, missing)
+
+        instances += len(pks)
+        orphans += len(missing)
+
+    return cursor, instances, orphans
+
+
+def _sweep(batch_size, deadline=None, progress=None):
+    """ Sweeps from the checkpoint, returns True once the whole index has been swept """
+    after = JobCheckpoint.objects.get(pk=SWEEP_JOB_ID).cursor
+
+    while deadline is None or time.time() < deadline:
+        after, instances, orphans = sweep_batch(after, batch_size)
+        checkpoint = record_progress(
+            SWEEP_JOB_ID, instances=instances, corrected=orphans, cursor=after, walked=after is None
+        )
+        if progress:
+            progress(checkpoint)
+        if after is None:
+            logging.info("Finished sweeping the index, unindexed %s orphans", checkpoint.corrected)
+            return True
+
+    return False
+
+
+def _deferred_sweep(batch_size):
+    if not _sweep(batch_size, deadline=time.time() + TASK_TIME_BUDGET):
+        deferred.defer(_deferred_sweep, batch_size, _queue=QUEUE_FOR_INDEXING)
+
+
+def sweep_orphans(batch_size=MAX_BATCH_SIZE, defer=True, restart=False, progress=None):
+    """
+        Walks the whole index unindexing instances which no longer exist. Meant to be
+        run periodically (e.g. from a cron handler): a finished sweep is started again,
+        an unfinished one is resumed unless it's still running.
+
+        defer: sweep in a chain of deferred tasks and return straight away
+        restart: ignore the checkpoint of an unfinished sweep
+        progress: called with the JobCheckpoint after each batch when not deferring
+
+        Returns the JobCheckpoint of the sweep.
+    """
+    checkpoint = get_checkpoint(SWEEP_JOB_ID, restart=restart)
+    if checkpoint.finished:
+        checkpoint = get_checkpoint(SWEEP_JOB_ID, restart=True)
+    elif defer and checkpoint.cursor and (timezone.now() - checkpoint.updated).total_seconds() < TASK_TIME_BUDGET * 2:
+        logging.info("The index is already being swept")
+        return checkpoint
+
+    if defer:
+        deferred.defer(_deferred_sweep, batch_size, _queue=QUEUE_FOR_INDEXING)
+        return checkpoint
+
+    _sweep(batch_size, progress=progress)
+    return JobCheckpoint.objects.get(pk=SWEEP_JOB_ID)
@@ -0,0 +1,53 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from simple_search.benchmarks import dump_results, run_benchmark
+
+
+class Command(BaseCommand):
+    help = "Benchmarks indexing and searching a generated corpus, run it against the test datastore stub"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--documents", dest="documents", type="int", default=1000,
+            help="The number of documents to index"),
+        make_option("--title-length", dest="title_length", type="int", default=5,
+            help="The number of words in the title of each document"),
+        make_option("--body-length", dest="body_length", type="int", default=100,
+            help="The number of words in the body of each document"),
+        make_option("--vocabulary", dest="vocabulary_size", type="int", default=10000,
+            help="The number of distinct words"),
+        make_option("--exponent", dest="exponent", type="float", default=1.1,
+            help="The exponent of the Zipfian word frequencies"),
+        make_option("--queries", dest="queries", type="int", default=50,
+            help="The number of queries of each type to time"),
+        make_option("--seed", dest="seed", type="int", default=0,
+            help="The seed of the generated corpus and queries"),
+        make_option("--output", dest="output", default=None,
+            help="Write the JSON results to this file rather than stdout"),
+    )
+
+    def handle(self, *args, **options):
+        if options["documents"] < 1 or options["queries"] < 1:
+            raise CommandError("--documents and --queries must be at least 1")
+
+        try:
+            results = run_benchmark(
+                documents=options["documents"],
+                title_length=options["title_length"],
+                body_length=options["body_length"],
+                vocabulary_size=options["vocabulary_size"],
+                exponent=options["exponent"],
+                queries=options["queries"],
+                seed=options["seed"],
+                progress=lambda message: sys.stderr.write(message + "\n"),
+            )
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                dump_results(results, f)
+        else:
+            dump_results(results, self.stdout)
@@ -0,0 +1,65 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from simple_search.jobs import (
+    DEFAULT_RECOUNT_SHARDS,
+    recount_job_id,
+    recount_occurances,
+)
+from simple_search.models import MAX_BATCH_SIZE, JobCheckpoint
+
+
+class Command(BaseCommand):
+    help = "Recounts the GlobalOccuranceCounts from the index, resuming a previous run if there is one"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--shards", dest="shards", type="int", default=DEFAULT_RECOUNT_SHARDS,
+            help="The number of shards the terms are split into"),
+        make_option("--batch-size", dest="batch_size", type="int", default=MAX_BATCH_SIZE,
+            help="The number of postings summed up at a time"),
+        make_option("--defer", dest="defer", action="store_true", default=False,
+            help="Run the shards as deferred tasks rather than recounting here"),
+        make_option("--restart", dest="restart", action="store_true", default=False,
+            help="Start from the beginning rather than resuming"),
+        make_option("--status", dest="status", action="store_true", default=False,
+            help="Only report the progress of the shards"),
+    )
+
+    def report(self, checkpoint):
+        instances_per_second, terms_per_second = checkpoint.throughput()
+        self.stdout.write("%s: %s terms (%.1f/s), %s corrected%s" % (
+            checkpoint.pk, checkpoint.terms, terms_per_second, checkpoint.corrected,
+            ", finished" if checkpoint.finished else ""
+        ))
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError("search_recount takes no arguments")
+
+        if options["status"]:
+            job_ids = [ recount_job_id(shard, options["shards"]) for shard in xrange(options["shards"]) ]
+            checkpoints = JobCheckpoint.objects.in_bulk(job_ids)
+            for job_id in job_ids:
+                if job_id in checkpoints:
+                    self.report(checkpoints[job_id])
+                else:
+                    self.stdout.write("%s has never run" % job_id)
+            return
+
+        try:
+            checkpoints = recount_occurances(
+                shards=options["shards"],
+                batch_size=options["batch_size"],
+                defer=options["defer"],
+                restart=options["restart"],
+                progress=None if options["defer"] else self.report
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options["defer"]:
+            self.stdout.write("Deferred the recount, use --status to follow it")
+        else:
+            for checkpoint in checkpoints:
+                self.report(checkpoint)
@@ -0,0 +1,75 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+
+from simple_search.jobs import (
+    DEFAULT_CHUNK_SIZE,
+    reindex_job_id,
+    reindex_model,
+)
+from simple_search.models import JobCheckpoint
+
+
+class Command(BaseCommand):
+    args = "<app_label.ModelName app_label.ModelName ...>"
+    help = "Indexes every instance of the given models, resuming a previous run if there is one"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--chunk-size", dest="chunk_size", type="int", default=DEFAULT_CHUNK_SIZE,
+            help="The number of instances indexed together"),
+        make_option("--defer", dest="defer", action="store_true", default=False,
+            help="Fan the chunks out as deferred tasks rather than indexing here"),
+        make_option("--processes", dest="processes", type="int", default=0,
+            help="The number of local processes to index with"),
+        make_option("--restart", dest="restart", action="store_true", default=False,
+            help="Start from the beginning rather than resuming"),
+        make_option("--status", dest="status", action="store_true", default=False,
+            help="Only report the progress of the jobs"),
+    )
+
+    def report(self, checkpoint):
+        instances_per_second, terms_per_second = checkpoint.throughput()
+        self.stdout.write("%s: %s instances (%.1f/s), %s terms (%.1f/s)%s" % (
+            checkpoint.pk, checkpoint.instances, instances_per_second, checkpoint.terms, terms_per_second,
+            ", finished" if checkpoint.finished else ""
+        ))
+
+    def handle(self, *labels, **options):
+        if not labels:
+            raise CommandError("Specify at least one model to index")
+
+        for label in labels:
+            try:
+                app_label, model_name = label.split(".")
+            except ValueError:
+                raise CommandError("Models must be given as app_label.ModelName, not %s" % label)
+
+            model_class = models.get_model(app_label, model_name)
+            if model_class is None:
+                raise CommandError("Unknown model %s" % label)
+
+            if not getattr(getattr(model_class, "Search", None), "fields", None):
+                raise CommandError("%s has no Search fields to index" % label)
+
+            if options["status"]:
+                checkpoint = JobCheckpoint.objects.filter(pk=reindex_job_id(model_class)).first()
+                if checkpoint:
+                    self.report(checkpoint)
+                else:
+                    self.stdout.write("%s has never been indexed" % label)
+                continue
+
+            checkpoint = reindex_model(
+                model_class,
+                chunk_size=options["chunk_size"],
+                defer=options["defer"],
+                processes=options["processes"],
+                restart=options["restart"],
+                progress=self.report
+            )
+
+            if options["defer"]:
+                self.stdout.write("Deferred indexing of %s, use --status to follow it" % label)
+            else:
+                self.report(checkpoint)
@@ -0,0 +1,42 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+
+from simple_search.snapshots import export_snapshot, publish_snapshot
+
+
+class Command(BaseCommand):
+    args = "<app_label.ModelName app_label.ModelName ...>"
+    help = "Publishes a new snapshot of the index of the given models"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--output", dest="output", default=None,
+            help="Write the snapshot to this file rather than publishing it (one model only)"),
+    )
+
+    def handle(self, *labels, **options):
+        if not labels:
+            raise CommandError("Specify at least one model to snapshot")
+
+        if options["output"] and len(labels) > 1:
+            raise CommandError("--output can only be used with a single model")
+
+        for label in labels:
+            try:
+                app_label, model_name = label.split(".")
+            except ValueError:
+                raise CommandError("Models must be given as app_label.ModelName, not %s" % label)
+
+            model_class = models.get_model(app_label, model_name)
+            if model_class is None:
+                raise CommandError("Unknown model %s" % label)
+
+            if options["output"]:
+                data = export_snapshot(model_class._meta.db_table)
+                with open(options["output"], "wb") as f:
+                    f.write(data)
+                self.stdout.write("Wrote the snapshot of %s to %s (%s bytes)" % (label, options["output"], len(data)))
+            else:
+                snapshot = publish_snapshot(model_class)
+                self.stdout.write("Published snapshot %s of %s (%s terms)" % (snapshot.generation, label, snapshot.term_count))
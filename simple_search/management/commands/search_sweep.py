@@ -0,0 +1,52 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from simple_search.jobs import SWEEP_JOB_ID, sweep_orphans
+from simple_search.models import MAX_BATCH_SIZE, JobCheckpoint
+
+
+class Command(BaseCommand):
+    help = "Unindexes instances which no longer exist, resuming a previous sweep if there is one"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size", dest="batch_size", type="int", default=MAX_BATCH_SIZE,
+            help="The number of index entries checked at a time"),
+        make_option("--defer", dest="defer", action="store_true", default=False,
+            help="Sweep in deferred tasks rather than here"),
+        make_option("--restart", dest="restart", action="store_true", default=False,
+            help="Start from the beginning rather than resuming"),
+        make_option("--status", dest="status", action="store_true", default=False,
+            help="Only report the progress of the sweep"),
+    )
+
+    def report(self, checkpoint):
+        instances_per_second, terms_per_second = checkpoint.throughput()
+        self.stdout.write("%s: %s instances (%.1f/s), %s orphans unindexed%s" % (
+            checkpoint.pk, checkpoint.instances, instances_per_second, checkpoint.corrected,
+            ", finished" if checkpoint.finished else ""
+        ))
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError("search_sweep takes no arguments")
+
+        if options["status"]:
+            checkpoint = JobCheckpoint.objects.filter(pk=SWEEP_JOB_ID).first()
+            if checkpoint:
+                self.report(checkpoint)
+            else:
+                self.stdout.write("The index has never been swept")
+            return
+
+        checkpoint = sweep_orphans(
+            batch_size=options["batch_size"],
+            defer=options["defer"],
+            restart=options["restart"],
+            progress=None if options["defer"] else self.report
+        )
+
+        if options["defer"]:
+            self.stdout.write("Deferred the sweep, use --status to follow it")
+        else:
+            self.report(checkpoint)
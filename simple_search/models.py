@@ -1,241 +1,1566 @@
+import base64
+import bisect
+import collections
+import copy
+import functools
+import hashlib
+import json
 import logging
-import shlex
+import random
+import struct
+import sys
+import threading
 import time
+import uuid
+import zlib
 
 from django.db import models
+from django.db.models.fields import FieldDoesNotExist
 from django.utils.encoding import smart_str, smart_unicode
 from django.conf import settings
-from django.db import IntegrityError
 from djangae.db import transaction
 
+from . import ranking
+from . import stats
+from .analysis import DEFAULT_ANALYZER, get_analyzer
+from .cache import (
+    bump_term_generations,
+    bump_tombstone_generation,
+    cache_results,
+    cache_tombstones,
+    get_cached_results,
+    get_cached_tombstones,
+    get_snapshot,
+    store_snapshot,
+)
+
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 from google.appengine.ext import deferred
 
-"""
-    REMAINING TO DO!
+QUEUE_FOR_INDEXING = getattr(settings, "QUEUE_FOR_INDEXING", "default")
 
-    1. Partial matches. These should be recorded as new Index instances, with an FK to the full term being indexes.
-       Partials should only be recorded for between 4, and len(original_term) - 1 characters. Partial matches should be much more highly scored,
-       the lower the match, the more the score should be
-    2. Cross-join indexing  e.g. book__title on an Author.
-    3. Field matches. e.g "id:1234 field1:banana". This should match any other words using indexes, but only return matches that match the field lookups
-"""
+# Deferred indexing of an instance waits until the end of a window of this many seconds,
+# and the task is named after the instance and the window, so an instance which is saved
+# many times is only indexed once per window (with its latest state). 0 indexes every save.
+INDEX_DEBOUNCE = getattr(settings, "SEARCH_INDEX_DEBOUNCE", 5)
 
-QUEUE_FOR_INDEXING = getattr(settings, "QUEUE_FOR_INDEXING", "default")
+# The number of shards each GlobalOccuranceCount is split into. Writes go to a random
+# shard so that common terms don't serialize indexing. Only ever increase this, shards
+# above the configured number are not read.
+COUNTER_SHARDS = getattr(settings, "SEARCH_COUNTER_SHARDS", 1)
 
-def _do_index(instance, fields_to_index):
-    def get_data_from_field(field_, instance_):
-        lookups = field_.split("__")
-        value = instance
-        for lookup in lookups:
-            if value is None:
-                continue
-            value = getattr(value, lookup)
+# How many times a colliding transaction is retried before giving up, and the bounds
+# of the (jittered, exponential) delay between attempts in seconds
+TRANSACTION_MAX_RETRIES = getattr(settings, "SEARCH_TRANSACTION_MAX_RETRIES", 10)
+TRANSACTION_RETRY_DELAY = getattr(settings, "SEARCH_TRANSACTION_RETRY_DELAY", 0.05)
+TRANSACTION_MAX_RETRY_DELAY = getattr(settings, "SEARCH_TRANSACTION_MAX_RETRY_DELAY", 2.0)
 
-            if "RelatedManager" in value.__class__.__name__:
-                if lookup == lookups[-2]:
-                    return [ getattr(x, lookups[-1]) for x in value.all() ]
-                else:
-                    raise TypeError("You can only index one level of related object")
+# Cross-group transactions can only touch 25 entity groups
+MAX_GROUPS_PER_TRANSACTION = 25
+
+# The maximum number of entities the datastore will write in a single batch
+MAX_BATCH_SIZE = 500
+
+# The datastore runs a separate query for each value of an __in filter, and allows 30
+MAX_IN_FILTER_SIZE = 30
+
+# How the index is stored, see backends.py
+INDEX_BACKEND = getattr(settings, "SEARCH_INDEX_BACKEND", "rows")
+
+# The number of blocks the posting list of each term is split into by the "postings"
+# backend. The blocks of a term are read with one batch get, and writes to a term are
+# spread over them. Changing this requires rebuilding the posting lists.
+POSTING_BLOCKS = getattr(settings, "SEARCH_POSTING_BLOCKS", 16)
+
+# The most postings a block holds before it's split in two by pk
+POSTING_BLOCK_SIZE = getattr(settings, "SEARCH_POSTING_BLOCK_SIZE", 20000)
+
+# Whether search terms also match the words they are a prefix of. Prefixes of between
+# PARTIAL_MIN_LENGTH and len(word) - 1 characters are recorded per word (not per instance),
+# and each search term expands to at most PARTIAL_EXPANSION_LIMIT words
+PARTIAL_MATCHES = getattr(settings, "SEARCH_PARTIAL_MATCHES", False)
+PARTIAL_MIN_LENGTH = 4
+PARTIAL_EXPANSION_LIMIT = getattr(settings, "SEARCH_PARTIAL_EXPANSION_LIMIT", 10)
+
+# How much worse a partial match scores than an exact one, this is multiplied by how
+# much of the word is missing, so the shorter the partial match the worse it scores
+PARTIAL_MATCH_PENALTY = getattr(settings, "SEARCH_PARTIAL_MATCH_PENALTY", 10)
+
+# Fields listed in the filters of a model's Search class are indexed as "field:value" terms,
+# so that search() can apply filters on them (or "field:value" in the search string) using the index
+FILTER_TERM_SEPARATOR = u":"
+
+# When search() has filters, ranked candidates are run through the filtered queryset until
+# the page is full. If the candidates run out, up to this many more are ranked.
+MAX_FILTERED_CANDIDATES = getattr(settings, "SEARCH_MAX_FILTERED_CANDIDATES", 10000)
+
+# The number of ranked results search_with_cursor() can page through
+CURSOR_MAX_RESULTS = getattr(settings, "SEARCH_CURSOR_MAX_RESULTS", 1000)
+
+# The number of datastore reads a search makes at the same time (in threads), 1 makes them
+# one after the other. Ranked instances are fetched in batches of FETCH_BATCH_SIZE.
+MAX_CONCURRENT_FETCHES = getattr(settings, "SEARCH_MAX_CONCURRENT_FETCHES", 8)
+FETCH_BATCH_SIZE = getattr(settings, "SEARCH_FETCH_BATCH_SIZE", MAX_IN_FILTER_SIZE)
+
+# When ranking, the common terms are checked against the remaining candidates one by one
+# rather than read in full, if the term occurs this many times more often than there are candidates
+POSTING_LOOKUP_RATIO = getattr(settings, "SEARCH_POSTING_LOOKUP_RATIO", 50)
+
+# Deletes are cleaned up from the index this long after they happen (then checked again
+# with a growing delay, up to TOMBSTONE_MAX_CHECKS times, while the instance still exists)
+TOMBSTONE_CHECK_DELAY = getattr(settings, "SEARCH_TOMBSTONE_CHECK_DELAY", 10)
+TOMBSTONE_MAX_CHECKS = 5
+
+# The most tombstones of a table searches leave out, any others are dropped when fetched
+MAX_TOMBSTONES = getattr(settings, "SEARCH_MAX_TOMBSTONES", 1000)
+
+
+def _model_label(model_class):
+    return "%s.%s" % (model_class._meta.app_label, model_class._meta.object_name)
 
-            elif hasattr(value, "__iter__"):
-                if lookup == lookups[-1]:
-                    return value
-                else:
-                    raise TypeError("You can only index one level of iterable")
 
-        return [ value ]
+def _get_model(model_label):
+    app_label, model_name = model_label.split(".")
+    return models.get_model(app_label, model_name)
 
-    instance = instance.__class__.objects.get(pk=instance.pk)
 
+def _get_relation(model_class, name):
+    """
+        Returns (related model, foreign key, forward) for a relation of model_class whose
+        objects can be prefetched, forward being True if the foreign key is on model_class
+        (e.g. author on a Book) and False if it points at model_class (e.g. book on an Author).
+        Returns None for anything else, e.g. a many to many or a property.
+    """
+    try:
+        field, model, direct, m2m = model_class._meta.get_field_by_name(name)
+    except FieldDoesNotExist:
+        return None
+
+    if m2m:
+        return None
+
+    if direct:
+        if isinstance(field, models.ForeignKey):
+            return field.rel.to, field, True
+        return None
+
+    return field.model, field.field, False
+
+
+def _get_related_lookups(fields_to_index):
+    """ Returns {relation: [field]} of the "relation__field" lookups """
+    relations = {}
     for field in fields_to_index:
-        texts = get_data_from_field(field, instance)
+        lookups = field.split("__")
+        if len(lookups) == 2:
+            relations.setdefault(lookups[0], []).append(lookups[1])
+    return relations
+
+
+def _prefetch_related(instances, fields_to_index):
+    """
+        Fetches the related objects needed to index the "relation__field" lookups of the
+        instances with batched queries per relation, rather than a query per instance.
+        They are kept in instance._search_related, where _get_data_from_field finds them.
+    """
+    instances = list(instances)
+    if not instances:
+        return
+
+    for instance in instances:
+        instance._search_related = {}
+
+    model_class = instances[0].__class__
+    for name in _get_related_lookups(fields_to_index):
+        relation = _get_relation(model_class, name)
+        if relation is None:
+            continue
+
+        related_model, fk, forward = relation
+        if forward:
+            related_pks = list(set(getattr(instance, fk.attname) for instance in instances) - set([None]))
+            related = {}
+            for i in xrange(0, len(related_pks), MAX_BATCH_SIZE):
+                related.update(related_model.objects.in_bulk(related_pks[i:i + MAX_BATCH_SIZE]))
+
+            for instance in instances:
+                obj = related.get(getattr(instance, fk.attname))
+                instance._search_related[name] = [ obj ] if obj is not None else []
+        else:
+            pks = [ instance.pk for instance in instances ]
+            related = {}
+            for i in xrange(0, len(pks), MAX_IN_FILTER_SIZE):
+                for obj in related_model.objects.filter(**{ "%s__in" % fk.name: pks[i:i + MAX_IN_FILTER_SIZE] }):
+                    related.setdefault(getattr(obj, fk.attname), []).append(obj)
+
+            for instance in instances:
+                instance._search_related[name] = related.get(instance.pk, [])
+
+
+def _run_concurrently(calls):
+    """
+        Returns [call() for call in calls], running up to MAX_CONCURRENT_FETCHES of the
+        calls at a time in threads. The first exception raised by a call is re-raised.
+    """
+    if MAX_CONCURRENT_FETCHES <= 1 or len(calls) <= 1:
+        return [ call() for call in calls ]
+
+    results = [ None ] * len(calls)
+    errors = []
+    pending = collections.deque(enumerate(calls))
+    collecting = stats.capture()
+
+    def worker():
+        stats.attach(collecting)
+        while not errors:
+            try:
+                i, call = pending.popleft()
+            except IndexError:
+                return
+
+            try:
+                results[i] = call()
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [ threading.Thread(target=worker) for i in xrange(min(MAX_CONCURRENT_FETCHES, len(calls))) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+def _get_data_from_field(field, instance):
+    lookups = field.split("__")
+
+    # Prefetched by _prefetch_related
+    related = getattr(instance, "_search_related", {})
+    if len(lookups) == 2 and lookups[0] in related:
+        return [ getattr(x, lookups[1]) for x in related[lookups[0]] ]
+
+    value = instance
+    for lookup in lookups:
+        if value is None:
+            continue
+        value = getattr(value, lookup)
+
+        if "RelatedManager" in value.__class__.__name__:
+            if lookup == lookups[-2]:
+                return [ getattr(x, lookups[-1]) for x in value.all() ]
+            else:
+                raise TypeError("You can only index one level of related object")
+
+        elif hasattr(value, "__iter__"):
+            if lookup == lookups[-1]:
+                return value
+            else:
+                raise TypeError("You can only index one level of iterable")
+
+    return [ value ]
+
+
+def _get_term_occurances(instance, fields_to_index):
+    """
+        Builds the full {term: occurances} map for an instance in memory,
+        so that it can be written to the datastore in as few batches as possible.
+    """
+    analyzer = get_analyzer(instance.__class__)
+    term_occurances = {}
+
+    for field in fields_to_index:
+        texts = _get_data_from_field(field, instance)
         for text in texts:
             if text is None:
                 continue
 
-            text = smart_unicode(text)
-            text = text.lower() #Normalize
+            for term, count in analyzer.get_term_occurances(text).items():
+                term_occurances[term] = term_occurances.get(term, 0) + count
+
+    return term_occurances
 
-            words = text.split(" ") #Split on whitespace
 
-            #Build up combinations of adjacent words
-            for i in xrange(0, len(words)):
-                for j in xrange(1, 5):
-                    term_words = words[i:i+j]
+def _is_positional(model_class):
+    return getattr(getattr(model_class, "Search", None), "positional", False)
+
+
+def _uses_snapshot(model_class):
+    return getattr(getattr(model_class, "Search", None), "snapshot", False)
+
+
+def _get_boost(model_class):
+    return float(getattr(getattr(model_class, "Search", None), "boost", 1.0))
+
+
+def _get_term_positions(instance, fields_to_index):
+    """
+        Returns {word: [positions]} for an instance indexed positionally. Each text starts
+        after a gap, so phrases can't span two texts.
+    """
+    analyzer = get_analyzer(instance.__class__)
+    term_positions = {}
+    offset = 0
+
+    for field in fields_to_index:
+        for text in _get_data_from_field(field, instance):
+            if text is None:
+                continue
+
+            text_positions = analyzer.get_term_positions(text, offset)
+            for term, positions in text_positions.items():
+                term_positions.setdefault(term, []).extend(positions)
+                offset = max(offset, positions[-1] + 2)
 
-                    if len(term_words) != j:
-                        break
+    return term_positions
 
-                    term = u" ".join(term_words)
 
-                    if not term.strip(): continue
+def _get_search_filters(model_class):
+    return list(getattr(getattr(model_class, "Search", None), "filters", []))
 
-                    while True:
-                        try:
-                            filter_args = dict(
-                                iexact=term,
-                                instance_db_table=instance._meta.db_table,
-                                instance_pk=instance.pk
-                            )
 
-                            if Index.objects.filter(**filter_args).exists():
-                                # Don't reindex if the index already exists
-                                break
+def _make_filter_term(field, value):
+    if isinstance(value, models.Model):
+        value = value.pk
+    return u"%s%s%s" % (field, FILTER_TERM_SEPARATOR, smart_unicode(value).lower())
 
-                            with transaction.atomic(xg=True):
-                                logging.info("Indexing: '%s', %s", term, type(term))
-                                term_count = text.count(term)
 
-                                try:
-                                    filter_args["occurances"] = term_count
-                                    Index.objects.create(
-                                        **filter_args
-                                    )
+def _get_filter_terms(instance):
+    """ Returns the "field:value" terms of the indexable filters of the instance """
+    terms = {}
+    for field_name in _get_search_filters(instance.__class__):
+        field = instance._meta.get_field(field_name)
+        terms[_make_filter_term(field_name, getattr(instance, field.attname))] = 1
+    return terms
 
-                                    counter, created = GlobalOccuranceCount.objects.get_or_create(pk=term)
-                                    counter.count += term_count
-                                    counter.save()
-                                except IntegrityError:
-                                    # If we already created this index for this instance, then ignore
-                                    pass
-                                break
-                        except transaction.TransactionFailedError:
-                            logging.warning("Transaction collision, retrying!")
-                            time.sleep(1)
-                            continue
 
-def _unindex_then_reindex(instance, fields_to_index):
-    unindex_instance(instance)
-    _do_index(instance, fields_to_index)
+def _split_filters(model_class, terms, filters, lookups=True):
+    """
+        Moves "field:value" search terms, and any filters on the fields in the Search
+        filters of the model, into filter terms which are matched using the index.
+        The index is lowercased, so the filters are also kept to check the candidates.
+        Without lookups "field:value" terms are searched for as words.
+
+        Returns (terms, filter terms, filters for the queryset)
+    """
+    indexable = set(_get_search_filters(model_class)) if lookups else set()
+
+    filter_terms = []
+    remaining_terms = []
+    for term in terms:
+        field = term.split(FILTER_TERM_SEPARATOR, 1)[0]
+        if FILTER_TERM_SEPARATOR in term and field in indexable:
+            filter_terms.append(term)
+        elif FILTER_TERM_SEPARATOR in term:
+            # Not a field we can look up, so just search for the words
+            remaining_terms.extend(get_analyzer(model_class).tokenize(term))
+        else:
+            remaining_terms.append(term)
+
+    remaining_filters = {}
+    for lookup, value in filters.items():
+        field = lookup[:-len("__exact")] if lookup.endswith("__exact") else lookup
+        if field in indexable:
+            filter_terms.append(_make_filter_term(field, value))
+        remaining_filters[lookup] = value
+
+    return remaining_terms, filter_terms, remaining_filters
+
+
+def _backoff(attempt):
+    """ Sleeps for a random ("full jitter") delay which grows exponentially with the attempt """
+    delay = min(TRANSACTION_MAX_RETRY_DELAY, TRANSACTION_RETRY_DELAY * (2 ** attempt))
+    time.sleep(random.uniform(0, delay))
+
+
+def _run_in_transaction(func, *args, **kwargs):
+    attempt = 0
+    while True:
+        try:
+            with transaction.atomic(xg=True):
+                return func(*args, **kwargs)
+        except transaction.TransactionFailedError:
+            attempt += 1
+            stats.current().incr("transaction_retries")
+            if attempt > TRANSACTION_MAX_RETRIES:
+                raise
+
+            logging.warning("Transaction collision, retrying!")
+            _backoff(attempt)
+
+
+def _save_many(instances):
+    """
+        Saves model instances through the ORM. New instances are created with a bulk
+        create per model, existing ones are saved one by one.
+    """
+    new = collections.OrderedDict()
+    for instance in instances:
+        if instance._state.adding:
+            new.setdefault(type(instance), []).append(instance)
+        else:
+            instance.save()
+
+    for model_class, created in new.items():
+        for i in xrange(0, len(created), MAX_BATCH_SIZE):
+            model_class.objects.bulk_create(created[i:i + MAX_BATCH_SIZE])
+
+
+def _update_occurance_counts(deltas, pending_key=None):
+    """
+        Applies {term: delta} to the GlobalOccuranceCounts. Counters are fetched
+        and written in groups, one cross-group transaction per group.
+
+        pending_key: the PendingCounts the deltas are stored in. Each group removes its
+            terms from it in the same transaction, and only applies the terms which are
+            still in it, so applying the deltas again only applies what's left.
+    """
+    def update_group(terms):
+        pending = None
+        group_deltas = deltas
+        if pending_key:
+            pending = PendingCounts.objects.filter(pk=pending_key).first()
+            group_deltas = pending.get_deltas() if pending else {}
+            terms = [ term for term in terms if term in group_deltas ]
+
+        # Each write goes to a random shard, shard 0 being the GlobalOccuranceCount itself
+        shards = dict((term, random.randrange(COUNTER_SHARDS)) for term in terms)
+
+        counters = GlobalOccuranceCount.objects.in_bulk([ term for term in terms if not shards[term] ])
+        shard_keys = dict(
+            (term, GlobalOccuranceCountShard.key_for(term, shards[term])) for term in terms if shards[term]
+        )
+        if shard_keys:
+            sharded_counters = GlobalOccuranceCountShard.objects.in_bulk(shard_keys.values())
+            for term, key in shard_keys.items():
+                if key in sharded_counters:
+                    counters[term] = sharded_counters[key]
+
+        changed = []
+        for term in terms:
+            counter = counters.get(term)
+            if counter is None:
+                if shards[term]:
+                    counter = GlobalOccuranceCountShard(pk=shard_keys[term], term=term)
+                elif group_deltas[term] < 0 and COUNTER_SHARDS == 1:
+                    logging.warning("A GlobalOccuranceCount for '%s' does not exist, ignoring", term)
+                    continue
+                else:
+                    counter = GlobalOccuranceCount(pk=term)
+
+            counter.count += group_deltas[term]
+            changed.append(counter)
+
+            # Individual shards can legitimately go negative, only their sum can't
+            if counter.count < 0 and COUNTER_SHARDS == 1:
+                logging.error("The GOC of %s was negative (%s) while unindexing", counter.pk, counter.count)
+
+        _save_many(changed)
+
+        if pending:
+            remaining = dict((term, delta) for term, delta in group_deltas.items() if term not in terms)
+            if remaining:
+                pending.set_deltas(remaining)
+                pending.save()
+            else:
+                pending.delete()
+
+    # The PendingCounts is an entity group of its own
+    group_size = MAX_GROUPS_PER_TRANSACTION - 1 if pending_key else MAX_GROUPS_PER_TRANSACTION
+    terms = sorted(term for term, delta in deltas.items() if delta)
+    for i in xrange(0, len(terms), group_size):
+        _run_in_transaction(update_group, terms[i:i + group_size])
+
+
+def _adjust_pending_counts(pending_key, db_table, pk, adjustments):
+    """ Adds {term: delta} to what's left of a PendingCounts, returns what's left """
+    def adjust():
+        pending = PendingCounts.objects.filter(pk=pending_key).first()
+        remaining = pending.get_deltas() if pending else {}
+        for term, delta in adjustments.items():
+            remaining[term] = remaining.get(term, 0) + delta
+        remaining = dict((term, delta) for term, delta in remaining.items() if delta)
+
+        if remaining:
+            pending = pending or PendingCounts(pk=pending_key, instance_db_table=db_table, instance_pk=pk)
+            pending.set_deltas(remaining)
+            pending.save()
+        elif pending:
+            pending.delete()
+        return remaining
+
+    return _run_in_transaction(adjust)
+
+
+def _write_index(instance, write):
+    """
+        Runs write(before_write), a write of the index backend for the instance which
+        calls before_write with the {term: delta} it is about to apply and returns the
+        ones it applied, then applies the deltas to the counters.
+
+        The deltas are stored in a PendingCounts of their own before the index is touched,
+        so that if the counters fail part way (and a retry finds nothing left to diff) the
+        next write of the instance finishes them first. Returns the deltas.
+    """
+    instance_stats = stats.current()
+    db_table, pk = instance._meta.db_table, instance.pk
+    pending_key = PendingCounts.key_for(db_table, pk, uuid.uuid4().hex)
+
+    for pending in PendingCounts.objects.filter(instance_db_table=db_table, instance_pk=pk):
+        # Each group takes its terms out of the record as it applies them, so finishing
+        # a write which is still running elsewhere doesn't count anything twice
+        logging.warning("Applying the counts left over from a previous write of %s:%s", db_table, pk)
+        leftover = pending.get_deltas()
+        with instance_stats.phase("counts"):
+            _update_occurance_counts(leftover, pending.pk)
+        _bump_generations(leftover.keys())
+
+    def store(deltas):
+        planned.update((term, delta) for term, delta in deltas.items() if delta)
+        if planned:
+            pending = PendingCounts(pk=pending_key, instance_db_table=db_table, instance_pk=pk)
+            pending.set_deltas(planned)
+            pending.save()
+
+    planned = {}
+    with instance_stats.phase("index_write"):
+        deltas = write(store)
+
+    applied = dict((term, delta) for term, delta in deltas.items() if delta)
+    if applied != planned:
+        # Someone else wrote some of the same Index rows at the same time. Adjusting what's
+        # left of the record (rather than replacing it) keeps what may already have been applied
+        applied = _adjust_pending_counts(pending_key, db_table, pk, dict(
+            (term, applied.get(term, 0) - planned.get(term, 0)) for term in set(applied) | set(planned)
+        ))
+
+    with instance_stats.phase("counts"):
+        _update_occurance_counts(applied, pending_key)
+    return deltas
+
+
+def _set_occurance_counts(counts):
+    """
+        Sets the GlobalOccuranceCounts of {term: count}, only writing the counters which
+        are wrong. Returns the number of terms which were corrected.
+    """
+    def set_group(terms):
+        counters = GlobalOccuranceCount.objects.in_bulk(terms)
+
+        shard_counts = {}
+        if COUNTER_SHARDS > 1:
+            shard_keys = [
+                GlobalOccuranceCountShard.key_for(term, shard) for term in terms for shard in xrange(1, COUNTER_SHARDS)
+            ]
+            for shard in GlobalOccuranceCountShard.objects.in_bulk(shard_keys).values():
+                shard_counts[shard.term] = shard_counts.get(shard.term, 0) + shard.count
+
+        changed = []
+        for term in terms:
+            # The GlobalOccuranceCount is shard 0, so it makes up the difference
+            count = counts[term] - shard_counts.get(term, 0)
+            counter = counters.get(term)
+            if counter is None:
+                if not count:
+                    continue
+                counter = GlobalOccuranceCount(pk=term)
+            elif counter.count == count:
+                continue
+
+            logging.warning("Correcting the GOC of %s from %s to %s", term, counter.count, count)
+            counter.count = count
+            changed.append(counter)
+
+        _save_many(changed)
+        return len(changed)
+
+    # Every shard of a term is its own entity group
+    group_size = max(1, MAX_GROUPS_PER_TRANSACTION // COUNTER_SHARDS)
+    terms = sorted(counts)
+    return sum(_run_concurrently([
+        functools.partial(_run_in_transaction, set_group, terms[i:i + group_size])
+        for i in xrange(0, len(terms), group_size)
+    ]))
+
+
+def _term_range_filters(field, start=None, end=None, after=None):
+    """ Returns the filters on field for the terms in [start, end) which come after `after` """
+    filters = {}
+    if start is not None:
+        filters[field + "__gte"] = start
+    if end is not None:
+        filters[field + "__lt"] = end
+    if after is not None:
+        filters[field + "__gt"] = after
+    return filters
+
+
+def _get_partials(term):
+    if " " in term or FILTER_TERM_SEPARATOR in term:
+        return []
+    return [ term[:i] for i in xrange(PARTIAL_MIN_LENGTH, len(term)) ]
+
+
+def _record_partials(terms):
+    """
+        Records the partials of any of the terms which haven't been seen before. The
+        longest partial of a term doubles as the marker that the term has been recorded.
+    """
+    terms = [ term for term in terms if _get_partials(term) ]
+    if not terms:
+        return
+
+    markers = dict((PartialTerm.key_for(term[:-1], term), term) for term in terms)
+    recorded = set(PartialTerm.objects.filter(pk__in=markers.keys()).values_list("pk", flat=True))
+
+    new_partials = [
+        PartialTerm(pk=PartialTerm.key_for(partial, term), partial=partial, term=term)
+        for key, term in markers.items() if key not in recorded
+        for partial in _get_partials(term)
+    ]
+    for i in xrange(0, len(new_partials), MAX_BATCH_SIZE):
+        PartialTerm.objects.bulk_create(new_partials[i:i + MAX_BATCH_SIZE])
+
+
+def _bump_generations(terms):
+    # Cached searches for a partial depend on the words it expands to
+    if PARTIAL_MATCHES:
+        terms = set(terms)
+        terms.update(partial for term in list(terms) for partial in _get_partials(term))
+    bump_term_generations(terms)
+
+
+def _expand_partials(terms, snapshot=None):
+    """ Returns {word: partial} of the words the terms are partials of """
+    def get_words(term):
+        if snapshot:
+            # The term dictionary of a snapshot is sorted, so words are found by prefix
+            return snapshot.get_words_with_prefix(term, PARTIAL_EXPANSION_LIMIT)
+        return [ partial_term.term for partial_term in PartialTerm.objects.filter(partial=term)[:PARTIAL_EXPANSION_LIMIT] ]
+
+    terms = [ term for term in set(terms) if " " not in term and len(term) >= PARTIAL_MIN_LENGTH ]
+    if snapshot:
+        term_words = [ get_words(term) for term in terms ]
+    else:
+        term_words = _run_concurrently([ functools.partial(get_words, term) for term in terms ])
+
+    expansions = {}
+    for term, words in zip(terms, term_words):
+        for word in words:
+            if word not in expansions or len(term) > len(expansions[word]):
+                expansions[word] = term
+    return expansions
+
+
+_index_backend = None
+
+def get_index_backend():
+    global _index_backend
+    if _index_backend is None:
+        from .backends import BACKENDS
+        _index_backend = BACKENDS[INDEX_BACKEND]()
+    return _index_backend
+
+
+@stats.instrument("index")
+def _do_index(instance, fields_to_index):
+    try:
+        with stats.current().phase("fetch"):
+            instance = instance.__class__.objects.get(pk=instance.pk)
+    except instance.__class__.DoesNotExist:
+        # Deleted before we got to it
+        unindex_instance(instance)
+        return 0
+
+    return _index_loaded_instance(instance, fields_to_index)
+
+
+def _index_loaded_instance(instance, fields_to_index):
+    """
+        Brings the Index for an instance up to date. The new terms are diffed against
+        the stored ones, so only added, removed and changed terms are written and only
+        their counters are adjusted.
+
+        Returns the number of terms the instance has.
+    """
+    instance_stats = stats.current()
+
+    if not hasattr(instance, "_search_related"):
+        with instance_stats.phase("fetch"):
+            _prefetch_related([ instance ], fields_to_index)
+
+    with instance_stats.phase("analysis"):
+        if _is_positional(instance.__class__):
+            # Only single words are stored, phrases are matched using their positions
+            term_positions = _get_term_positions(instance, fields_to_index)
+            term_occurances = dict((term, len(positions)) for term, positions in term_positions.items())
+        else:
+            term_positions = None
+            term_occurances = _get_term_occurances(instance, fields_to_index)
+
+        term_occurances.update(_get_filter_terms(instance))
+
+    deltas = _write_index(instance, lambda before_write: get_index_backend().update_instance(
+        instance._meta.db_table, instance.pk, term_occurances, term_positions, before_write
+    ))
+    _bump_generations(deltas.keys())
+
+    instance_stats.incr("terms", len(term_occurances))
+    instance_stats.incr("changed_terms", len(deltas))
+
+    if deltas and _uses_snapshot(instance.__class__):
+        from .snapshots import record_change
+        record_change(instance._meta.db_table, instance.pk)
+
+    if PARTIAL_MATCHES:
+        _record_partials([ term for term, delta in deltas.items() if delta > 0 ])
+
+    return len(term_occurances)
+
+
+# Kept so that tasks deferred before indexing became incremental still run
+_unindex_then_reindex = _do_index
+
+
+def _index_by_key(model_label, pk, fields_to_index=None):
+    """ The deferred indexing task, which indexes whatever the instance looks like when it runs """
+    model_class = _get_model(model_label)
+    if model_class is None:
+        logging.warning("Not indexing %s:%s, the model no longer exists", model_label, pk)
+        return
+
+    _do_index(model_class(pk=pk), fields_to_index or model_class.Search.fields)
+
+
+def _index_task_name(task_key, window):
+    return "search-index-%s-%d" % (hashlib.md5(smart_str(task_key)).hexdigest(), window)
+
+
+def _defer_debounced(task_key, func, *args):
+    """
+        Defers func(*args) to the end of the current SEARCH_INDEX_DEBOUNCE window. Only
+        the first task deferred with the same task_key in a window is queued, and as it
+        reads the datastore when it runs it picks up whatever the others would have.
+    """
+    options = { "_queue": QUEUE_FOR_INDEXING }
+    if INDEX_DEBOUNCE:
+        now = time.time()
+        window = int(now // INDEX_DEBOUNCE)
+        options["_name"] = _index_task_name(task_key, window)
+        options["_countdown"] = (window + 1) * INDEX_DEBOUNCE - now
+
+    try:
+        deferred.defer(func, *args, **options)
+    except taskqueue.TaskAlreadyExistsError:
+        # Already queued for this window
+        pass
+    except taskqueue.TombstonedTaskError:
+        # The task of this window has already run (e.g. our clock is behind the one which
+        # queued it), so it may have missed this change
+        deferred.defer(func, *args, _queue=QUEUE_FOR_INDEXING)
+
+
+def _instance_task_key(model_label, pk):
+    return u"%s|%s" % (model_label, pk)
 
 
 @db.non_transactional
 def index_instance(instance, fields_to_index, defer_index=True):
-    if defer_index:
-        deferred.defer(_unindex_then_reindex, instance, fields_to_index, _queue=QUEUE_FOR_INDEXING)
-    else:
-        _unindex_then_reindex(instance, fields_to_index)
+    if not defer_index:
+        _do_index(instance, fields_to_index)
+        return
+
+    # Only the fields are passed if they aren't the ones in the Search class
+    if list(fields_to_index) == list(getattr(getattr(instance, "Search", None), "fields", [])):
+        fields_to_index = None
+
+    model_label = _model_label(instance.__class__)
+    _defer_debounced(
+        _instance_task_key(model_label, instance.pk), _index_by_key, model_label, instance.pk, fields_to_index
+    )
 
 
+@stats.instrument("unindex")
 def unindex_instance(instance):
-    indexes = Index.objects.filter(instance_db_table=instance._meta.db_table, instance_pk=instance.pk).all()
-    for index in indexes:
-        try:
-            while True:
-                try:
-                    with transaction.atomic(xg=True):
-                        try:
-                            index = Index.objects.get(pk=index.pk)
-                        except Index.DoesNotExist:
-                            return
-
-                        count = GlobalOccuranceCount.objects.get(pk=index.iexact)
-                        count.count -= index.occurances
-                        count.save()
-                        index.delete()
-
-                        if count.count < 0:
-                            logging.error("The GOC of {} was negative ({}) while unindexing {}", count.pk, count.count, index.pk)
-                        break
-
-                except transaction.TransactionFailedError:
-                    logging.warning("Transaction collision, retrying!")
-                    time.sleep(1)
-                    continue
-        except GlobalOccuranceCount.DoesNotExist:
-            logging.warning("A GlobalOccuranceCount for Index: %s does not exist, ignoring", index.pk)
-            continue
+    deltas = _write_index(instance, lambda before_write: get_index_backend().remove_instance(
+        instance._meta.db_table, instance.pk, before_write
+    ))
+    _bump_generations(deltas.keys())
 
+    if deltas and _uses_snapshot(instance.__class__):
+        from .snapshots import record_change
+        record_change(instance._meta.db_table, instance.pk)
 
 
-def parse_terms(search_string):
-    terms = shlex.split(smart_str(search_string.lower()))
+def _get_tombstoned_pks(db_tables):
+    """
+        Returns {db_table: set(pks)} of the deleted instances of the tables which are
+        still indexed, through memcache
+    """
+    keys, tombstoned = get_cached_tombstones(db_tables)
 
-    # The split requires the unicode string to be encoded to a bytestring, but
-    # we need the terms to be decoded back to utf-8 for use in the datastore queries.
-    return [smart_unicode(term) for term in terms]
+    missing = [ db_table for db_table in db_tables if db_table not in tombstoned ]
+    if missing:
+        # MAX_TOMBSTONES is per table, so each table gets a query of its own
+        def fetch(db_table):
+            return list(
+                IndexTombstone.objects.filter(instance_db_table=db_table).values_list("instance_pk", flat=True)[:MAX_TOMBSTONES]
+            )
 
-def search(model_class, search_string, per_page=50, current_page=1, total_pages=10, **filters):
-    terms = parse_terms(search_string)
+        found = dict(zip(missing, _run_concurrently([ functools.partial(fetch, db_table) for db_table in missing ])))
+        cache_tombstones(keys, found)
+        tombstoned.update(found)
+
+    return dict((db_table, set(pks)) for db_table, pks in tombstoned.items())
+
+
+def _clear_tombstones(db_table, pks):
+    keys = [ IndexTombstone.key_for(db_table, pk) for pk in pks ]
+    for i in xrange(0, len(keys), MAX_BATCH_SIZE):
+        IndexTombstone.objects.filter(pk__in=keys[i:i + MAX_BATCH_SIZE]).delete()
+    bump_tombstone_generation(db_table)
+
+
+def _unindex_by_key(model_label, pk, checks=1):
+    """ The deferred task which cleans up the index after a delete, see post_delete_unindex """
+    model_class = _get_model(model_label)
+    if model_class is None:
+        logging.warning("Not unindexing %s:%s, the model no longer exists", model_label, pk)
+        return
+
+    if model_class.objects.filter(pk=pk).exists():
+        if checks < TOMBSTONE_MAX_CHECKS:
+            # The delete may not have been committed yet
+            deferred.defer(
+                _unindex_by_key, model_label, pk, checks + 1,
+                _queue=QUEUE_FOR_INDEXING, _countdown=TOMBSTONE_CHECK_DELAY * checks
+            )
+            return
+
+        # The delete was rolled back (or the pk reused), and the index was never touched
+        logging.warning("%s:%s still exists after being deleted, leaving it indexed", model_label, pk)
+    else:
+        unindex_instance(model_class(pk=pk))
+
+    _clear_tombstones(model_class._meta.db_table, [ pk ])
+
+
+@db.non_transactional
+def tombstone_instance(instance):
+    """
+        Hides a deleted instance from searches straight away, and defers removing it
+        from the index
+    """
+    db_table = instance._meta.db_table
+    IndexTombstone(
+        pk=IndexTombstone.key_for(db_table, instance.pk), instance_db_table=db_table, instance_pk=instance.pk
+    ).save()
+    bump_tombstone_generation(db_table)
+
+    if _uses_snapshot(instance.__class__):
+        # Snapshot readers pick the tombstone up with the rest of their delta
+        from .snapshots import record_change
+        record_change(db_table, instance.pk)
+
+    deferred.defer(
+        _unindex_by_key, _model_label(instance.__class__), instance.pk,
+        _queue=QUEUE_FOR_INDEXING, _countdown=TOMBSTONE_CHECK_DELAY
+    )
+
+
+def get_occurance_counts(terms):
+    """
+        Returns {term: count} for the given terms, summing the counter shards. Terms
+        which have never been indexed are omitted.
+    """
+    terms = list(set(terms))
+    if not terms:
+        return {}
+
+    def get_counts():
+        return GlobalOccuranceCount.objects.filter(pk__in=terms).values_list('pk', 'count')
+
+    def get_shard_counts():
+        shard_keys = [
+            GlobalOccuranceCountShard.key_for(term, shard) for term in terms for shard in xrange(1, COUNTER_SHARDS)
+        ]
+        return GlobalOccuranceCountShard.objects.filter(pk__in=shard_keys).values_list('term', 'count')
+
+    if COUNTER_SHARDS > 1:
+        # The shards are separate entities, so they are read at the same time
+        counts, shard_counts = _run_concurrently([ lambda: list(get_counts()), lambda: list(get_shard_counts()) ])
+    else:
+        counts, shard_counts = get_counts(), []
+
+    counts = dict(counts)
+    for term, count in shard_counts:
+        counts[term] = counts.get(term, 0) + count
+
+    return counts
+
+
+def parse_terms(search_string, analyzer=DEFAULT_ANALYZER):
+    return analyzer.parse_query(search_string)
+
+def _match_phrase(backend, db_table, phrase, matching_terms, allowed):
+    """
+        Returns {pk: occurances} of a phrase in a positional index, by intersecting the
+        postings of its words and then checking their positions
+    """
+    words = phrase.split(" ")
+    if not all(matching_terms.get(word) for word in words):
+        return {}
+
+    candidates = allowed
+    for word in sorted(set(words), key=lambda x: matching_terms[x]):
+        if candidates is None:
+            candidates = set(backend.get_postings(word, db_table))
+        else:
+            candidates = set(backend.get_postings_for(word, db_table, candidates, matching_terms[word]))
+
+        if not candidates:
+            return {}
+
+    postings = {}
+    for pk, term_positions in backend.get_positions(db_table, set(words), candidates).items():
+        starts = set(term_positions.get(words[0], []))
+        for offset, word in enumerate(words[1:], 1):
+            starts &= set(position - offset for position in term_positions.get(word, []))
+
+        if starts:
+            postings[pk] = len(starts)
+    return postings
+
+
+def _get_phrase_words(terms):
+    return [ word for term in terms if " " in term for word in term.split(" ") ]
+
+
+def _rank(db_table, terms, limit, filter_terms=(), positional=False, snapshot=None, checked_filter_terms=()):
+    """
+        Returns the best [(score, pk)] of the given table for the terms, only including
+        instances which have all of the filter terms. If a SnapshotIndex is given, the
+        terms are looked up in it rather than the datastore.
+
+        checked_filter_terms: filter terms which the caller checks the results against
+            itself, so they are skipped rather than matching nothing while they aren't indexed
+    """
+    expansions = _expand_partials(terms, snapshot) if PARTIAL_MATCHES else {}
+    phrase_words = _get_phrase_words(terms) if positional else []
 
     #Get all matching terms
-    matching_terms = dict(GlobalOccuranceCount.objects.filter(pk__in=terms).values_list('pk', 'count'))
-    matches = Index.objects.filter(iexact__in=terms, instance_db_table=model_class._meta.db_table).all()
+    all_terms = list(terms) + list(filter_terms) + expansions.keys() + phrase_words
+    rank_stats = stats.current()
+    rank_stats.incr("terms", len(set(all_terms)))
 
-    instance_weights = {}
+    backend = snapshot or get_index_backend()
 
-    for match in matches:
-        instance_weights.setdefault(match.instance_pk, []).append(matching_terms[match.iexact])
+    prefetched = {}
+    with rank_stats.phase("counts"):
+        if snapshot:
+            # Tombstoned instances are left out of the snapshot's delta
+            matching_terms, tombstoned = snapshot.get_occurance_counts(all_terms), set()
+        else:
+            calls = [ lambda: get_occurance_counts(all_terms), lambda: _get_tombstoned_pks([ db_table ])[db_table] ]
 
-    final_weights = []
-    for k, v in instance_weights.items():
-        """
-            This is where we rank the results. Lower scores are better. Scores are based
-            on the commonality of the word. More matches are rewarded, but not too much so
-            that rarer terms still have a chance.
+            # A lone term is always read in full, so there's no need to wait for its count first
+            if len(set(all_terms)) == 1:
+                term = all_terms[0]
+                calls.append(lambda: backend.get_postings(term, db_table))
 
-            Examples for n matches:
+            results = _run_concurrently(calls)
+            matching_terms, tombstoned = results[:2]
+            if len(results) > 2:
+                prefetched[term] = results[2]
 
-            1 = 1 + (0 * 0.5) = 1    -> scores / 1
-            2 = 2 + (1 * 0.5) = 2.5  -> scores / 2.5 (rather than 2)
-            3 = 3 + (2 * 0.5) = 4    -> scores / 4 (rather than 3)
-        """
+    term_weights = dict((term, matching_terms[term]) for term in terms if term in matching_terms)
+    for word, partial in expansions.items():
+        if matching_terms.get(word) and word not in term_weights:
+            term_weights[word] = matching_terms[word] * PARTIAL_MATCH_PENALTY * len(word) / float(len(partial))
 
-        n = float(len(v))
-        final_weights.append((sum(v) / (n + ((n-1) * 0.5)), k))
+    allowed = None
+    filter_terms = [
+        filter_term for filter_term in filter_terms
+        if matching_terms.get(filter_term) or filter_term not in checked_filter_terms
+    ]
+    if filter_terms:
+        if not all(matching_terms.get(term) for term in filter_terms):
+            return []
 
-    final_weights.sort()
+        # Intersect the filter terms rarest first, so the rest can be looked up for the few remaining pks
+        for term in sorted(set(filter_terms), key=lambda x: matching_terms[x]):
+            if allowed is None:
+                allowed = set(backend.get_postings(term, db_table))
+            else:
+                allowed = set(backend.get_postings_for(term, db_table, allowed, matching_terms[term]))
 
-    #Restrict to the max possible
-    final_weights = final_weights[:total_pages*per_page]
+            if not allowed:
+                return []
+
+    # Phrases aren't stored in a positional index, so they are matched up front. They
+    # are at most as common as their rarest word.
+    phrase_postings = {}
+    if positional:
+        for phrase in set(term for term in terms if " " in term):
+            postings = _match_phrase(backend, db_table, phrase, matching_terms, allowed)
+            if postings:
+                phrase_postings[phrase] = postings
+                term_weights[phrase] = matching_terms[phrase] = min(matching_terms[word] for word in phrase.split(" "))
+
+    def fetch_postings(term):
+        if term in phrase_postings:
+            return phrase_postings[term]
+
+        if term in prefetched:
+            rank_stats.incr("candidates", len(prefetched[term]))
+            return prefetched.pop(term)
+
+        with rank_stats.phase("postings"):
+            if allowed is not None:
+                postings = backend.get_postings_for(term, db_table, allowed, matching_terms[term])
+            else:
+                postings = backend.get_postings(term, db_table)
+        rank_stats.incr("candidates", len(postings))
+        return postings
+
+    def fetch_postings_for(term, pks):
+        if term in phrase_postings:
+            return [ pk for pk in phrase_postings[term] if pk in pks ]
+
+        with rank_stats.phase("postings"):
+            postings = backend.get_postings_for(term, db_table, pks, matching_terms[term])
+        rank_stats.incr("candidates", len(postings))
+        return postings
+
+    with rank_stats.phase("ranking"):
+        return ranking.rank(
+            term_weights, fetch_postings, fetch_postings_for, limit=limit, allowed=allowed, excluded=tombstoned
+        )
+
+
+def _get_ranked_pks(db_table, terms, filter_terms, filters, limit, positional=False, use_snapshot=False):
+    # The words of phrases are included as a positional index only invalidates the words
+    cache_terms = list(terms) + list(filter_terms) + _get_phrase_words(terms)
+    cache_key, ranked_pks = get_cached_results(db_table, cache_terms, filters, limit)
+    if ranked_pks is None:
+        snapshot = None
+        if use_snapshot:
+            from .snapshots import get_snapshot_index
+            snapshot = get_snapshot_index(db_table)
+
+        # The queryset checks the filters too, so instances which were indexed before a
+        # field was added to Search.filters (and so lack its terms) aren't left out
+        checked_filter_terms = set(
+            _make_filter_term(lookup[:-len("__exact")] if lookup.endswith("__exact") else lookup, value)
+            for lookup, value in filters.items()
+        )
+        ranked_pks = [
+            pk for score, pk in _rank(db_table, terms, limit, filter_terms, positional, snapshot, checked_filter_terms)
+        ]
+        cache_results(cache_key, ranked_pks)
+    else:
+        stats.current().incr("cached_results")
+    return ranked_pks
+
+
+def _fetch_in_order(queryset, pks):
+    """
+        Returns the instances of the queryset with the given pks, in the order of the pks.
+        The pks are fetched in concurrent batches.
+    """
+    def fetch(batch):
+        return list(queryset.filter(pk__in=batch))
+
+    batches = [ pks[i:i + FETCH_BATCH_SIZE] for i in xrange(0, len(pks), FETCH_BATCH_SIZE) ]
+    with stats.current().phase("fetch"):
+        instances = dict(
+            (instance.pk, instance)
+            for batch in _run_concurrently([ functools.partial(fetch, batch) for batch in batches ])
+            for instance in batch
+        )
+    return [ instances[pk] for pk in pks if pk in instances ]
+
+
+def _rank_models(model_terms, limit):
+    """
+        Ranks the instances of several models together, model_terms being {model: terms}.
+        The counts of the terms are read once, and each term's postings are read for every
+        table searching for it at the same time.
+
+        Returns the best [(score, (db_table, pk))], scores being divided by the boost of the model.
+    """
+    tables = dict((model_class._meta.db_table, model_class) for model_class in model_terms)
+    table_terms = dict((model_class._meta.db_table, set(terms)) for model_class, terms in model_terms.items())
+    positional_tables = [ db_table for db_table, model_class in tables.items() if _is_positional(model_class) ]
+
+    terms = set(term for terms in table_terms.values() for term in terms)
+    expansions = _expand_partials(terms) if PARTIAL_MATCHES else {}
+    phrase_words = [ word for db_table in positional_tables for word in _get_phrase_words(table_terms[db_table]) ]
+
+    all_terms = list(terms) + expansions.keys() + phrase_words
+    rank_stats = stats.current()
+    rank_stats.incr("terms", len(set(all_terms)))
+    with rank_stats.phase("counts"):
+        matching_terms, tombstoned = _run_concurrently([
+            lambda: get_occurance_counts(all_terms), lambda: _get_tombstoned_pks(tables.keys())
+        ])
+
+    term_weights = dict((term, matching_terms[term]) for term in terms if term in matching_terms)
+    for word, partial in expansions.items():
+        if matching_terms.get(word):
+            if word not in term_weights:
+                term_weights[word] = matching_terms[word] * PARTIAL_MATCH_PENALTY * len(word) / float(len(partial))
+            for searched in table_terms.values():
+                if partial in searched:
+                    searched.add(word)
+
+    backend = get_index_backend()
+
+    # Phrases aren't stored in a positional index, so they are matched up front, see _rank()
+    phrase_postings = {}
+    for db_table in positional_tables:
+        for phrase in set(term for term in table_terms[db_table] if " " in term):
+            postings = _match_phrase(backend, db_table, phrase, matching_terms, None)
+            if postings:
+                phrase_postings.setdefault(phrase, {}).update(((db_table, pk), count) for pk, count in postings.items())
+                term_weights[phrase] = matching_terms[phrase] = min(matching_terms[word] for word in phrase.split(" "))
+
+    def get_tables(term):
+        # Positional tables only find phrases through their positions
+        return [
+            db_table for db_table, searched in table_terms.items()
+            if term in searched and not (" " in term and db_table in positional_tables)
+        ]
+
+    def fetch_postings(term):
+        documents = list(phrase_postings.get(term, {}))
+        db_tables = get_tables(term)
+        if db_tables:
+            with rank_stats.phase("postings"):
+                for db_table, postings in backend.get_postings_multi(term, db_tables).items():
+                    documents.extend((db_table, pk) for pk in postings)
+        rank_stats.incr("candidates", len(documents))
+        return documents
+
+    def fetch_postings_for(term, documents):
+        documents = set(documents)
+        found = [ document for document in phrase_postings.get(term, {}) if document in documents ]
+        with rank_stats.phase("postings"):
+            for db_table in get_tables(term):
+                pks = set(pk for document_table, pk in documents if document_table == db_table)
+                if pks:
+                    found.extend(
+                        (db_table, pk) for pk in backend.get_postings_for(term, db_table, pks, matching_terms[term])
+                    )
+        rank_stats.incr("candidates", len(found))
+        return found
+
+    boosts = dict((db_table, _get_boost(model_class)) for db_table, model_class in tables.items())
+    with rank_stats.phase("ranking"):
+        return ranking.rank(
+            term_weights, fetch_postings, fetch_postings_for, limit=limit,
+            excluded=set((db_table, pk) for db_table, pks in tombstoned.items() for pk in pks),
+            boost=lambda document: boosts[document[0]], max_boost=max(boosts.values())
+        )
+
+
+def _search_models(model_classes, search_string, per_page, current_page, total_pages):
+    """
+        search() across several models, returning a single page of their instances ranked
+        together. Each model's terms come from its own analyzer, and Search.boost of a
+        model scales its scores (2 makes its instances rank as if their terms were twice as rare).
+    """
+    model_terms = {}
+    for model_class in model_classes:
+        # Lookups can't apply to all of the models, so "field:value" is searched for as words
+        terms, filter_terms, filters = _split_filters(
+            model_class, parse_terms(search_string, get_analyzer(model_class)), {}, lookups=False
+        )
+        model_terms[model_class] = terms
+
+    tables = dict((model_class._meta.db_table, model_class) for model_class in model_classes)
+
+    offset = ((current_page - 1) * per_page)
+    limit = total_pages * per_page
+    if offset >= limit:
+        return []
+
+    cache_key, ranked = get_cached_results(
+        tuple(sorted((db_table, _get_boost(model_class)) for db_table, model_class in tables.items())),
+        [ term for searched in model_terms.values() for term in searched ], {}, limit
+    )
+    if ranked is None:
+        ranked = [ document for score, document in _rank_models(model_terms, limit) ]
+        cache_results(cache_key, ranked)
+
+    def fetch(db_table, pks):
+        return _fetch_in_order(tables[db_table].objects.all(), pks)
+
+    # Like search(), candidates are fetched until the page is full in case some have been deleted
+    results = []
+    position = offset
+    while position < len(ranked) and len(results) < per_page:
+        batch = ranked[position:position + per_page - len(results)]
+        position += len(batch)
+
+        batch_pks = {}
+        for db_table, pk in batch:
+            batch_pks.setdefault(db_table, []).append(pk)
+
+        db_tables = batch_pks.keys()
+        fetched = _run_concurrently([ functools.partial(fetch, db_table, batch_pks[db_table]) for db_table in db_tables ])
+        instances = dict(
+            ((db_table, instance.pk), instance) for db_table, table_instances in zip(db_tables, fetched)
+            for instance in table_instances
+        )
+        results.extend(instances[document] for document in batch if document in instances)
+
+    stats.current().incr("results", len(results))
+    return results
+
+
+@stats.instrument("search")
+def search(model_class, search_string, per_page=50, current_page=1, total_pages=10, **filters):
+    """
+        Returns a page of the instances of model_class which best match the search string.
+
+        model_class can also be a list of models, in which case their instances are ranked
+        together and the page can contain instances of any of them (filters can't be used).
+    """
+    if isinstance(model_class, (list, tuple)):
+        if len(model_class) > 1:
+            if filters:
+                raise ValueError("Filters can't be used when searching multiple models")
+            return _search_models(model_class, search_string, per_page, current_page, total_pages)
+        model_class = model_class[0]
+
+    db_table = model_class._meta.db_table
+    terms, filter_terms, filters = _split_filters(model_class, parse_terms(search_string, get_analyzer(model_class)), filters)
+
+    queryset = model_class.objects.all()
+    if filters:
+        queryset = queryset.filter(**filters)
 
     #Restrict to the page
     offset = ((current_page - 1) * per_page)
-    final_weights = final_weights[offset:offset + per_page]
+    wanted = offset + per_page
+
+    #Restrict to the max possible
+    limit = total_pages * per_page
+    if offset >= limit:
+        return []
+
+    # Candidates are streamed through the queryset in batches until the page is full,
+    # so that filters (or instances which have been deleted) don't leave it short.
+    # Without filters every candidate before the page is assumed to match.
+    matched = 0 if filters else offset
+    position = matched
+    results = []
+
+    while True:
+        ranked_pks = _get_ranked_pks(
+            db_table, terms, filter_terms, filters, limit, _is_positional(model_class), _uses_snapshot(model_class)
+        )
+
+        while position < len(ranked_pks) and matched < wanted:
+            batch = ranked_pks[position:position + per_page]
+            position += len(batch)
+
+            for instance in _fetch_in_order(queryset, batch):
+                if offset <= matched < wanted:
+                    results.append(instance)
+                matched += 1
+
+        if matched >= wanted or len(ranked_pks) < limit or limit >= MAX_FILTERED_CANDIDATES:
+            stats.current().incr("results", len(results))
+            return results
 
-    order = {}
-    for index, (score, pk) in enumerate(final_weights):
-        order[pk] = index
+        # Ran out of candidates, rank some more
+        limit = min(limit * 4, MAX_FILTERED_CANDIDATES)
 
-    sorted_results = [None] * len(order.keys())
+def _encode_cursor(snapshot_id, query_hash, position):
+    return base64.urlsafe_b64encode(json.dumps([snapshot_id, query_hash, position]))
+
+
+def _decode_cursor(cursor):
+    try:
+        snapshot_id, query_hash, position = json.loads(base64.urlsafe_b64decode(smart_str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid search cursor")
+    return snapshot_id, query_hash, position
+
+
+@stats.instrument("search_with_cursor")
+def search_with_cursor(model_class, search_string, per_page=50, cursor=None, **filters):
+    """
+        Like search(), but pages through a snapshot of the ranking using cursors rather
+        than page numbers. Returns (results, cursor for the next page or None).
+
+        Later pages only fetch their instances, and don't shift when the index changes.
+        If a snapshot has expired (see SEARCH_CURSOR_TIMEOUT) the search is ranked again
+        and continues from the same position.
+    """
+    db_table = model_class._meta.db_table
+    terms, filter_terms, filters = _split_filters(model_class, parse_terms(search_string, get_analyzer(model_class)), filters)
+    query_hash = hashlib.md5(smart_str(repr((db_table, terms, filter_terms, sorted(filters.items()))))).hexdigest()
+
+    ranked_pks = None
+    snapshot_id, position = None, 0
+    if cursor:
+        snapshot_id, cursor_query_hash, position = _decode_cursor(cursor)
+        if cursor_query_hash != query_hash:
+            raise ValueError("The search cursor belongs to a different search")
+        ranked_pks = get_snapshot(snapshot_id)
+
+    if ranked_pks is None:
+        ranked_pks = _get_ranked_pks(
+            db_table, terms, filter_terms, filters, CURSOR_MAX_RESULTS, _is_positional(model_class), _uses_snapshot(model_class)
+        )
+        snapshot_id = store_snapshot(ranked_pks)
 
     queryset = model_class.objects.all()
     if filters:
         queryset = queryset.filter(**filters)
 
-    results = queryset.filter(pk__in=order.keys())
-    for result in results:
-        position = order[result.pk]
-        sorted_results[position] = result
+    results = []
+    while position < len(ranked_pks) and len(results) < per_page:
+        batch = ranked_pks[position:position + per_page - len(results)]
+        position += len(batch)
+        results.extend(_fetch_in_order(queryset, batch))
+
+    next_cursor = _encode_cursor(snapshot_id, query_hash, position) if position < len(ranked_pks) else None
+    stats.current().incr("results", len(results))
+    return results, next_cursor
 
-    return [x for x in sorted_results if x ]
 
 class GlobalOccuranceCount(models.Model):
     id = models.CharField(max_length=1024, primary_key=True)
     count = models.PositiveIntegerField(default=0)
 
     def update(self):
-        while True:
-            try:
-                count = 0
-                for index in Index.objects.filter(iexact=self.id):
-                    count += Index.objects.get(pk=index.pk).occurances
+        """ Recounts the term from the index, correcting the counter if it has drifted """
+        _set_occurance_counts({self.id: get_index_backend().get_term_total(self.id)})
+        counter = GlobalOccuranceCount.objects.filter(pk=self.id).first()
+        self.count = counter.count if counter else 0
 
-                with transaction.atomic():
-                    goc = GlobalOccuranceCount.objects.get(pk=self.id)
-                    goc.count = count
-                    goc.save()
+class GlobalOccuranceCountShard(models.Model):
+    """
+        An additional counter shard for a term, used when SEARCH_COUNTER_SHARDS > 1.
+        The GlobalOccuranceCount of the term is shard 0.
+    """
+    id = models.CharField(max_length=1024, primary_key=True)
+    term = models.CharField(max_length=1024)
+    count = models.IntegerField(default=0)
 
-            except transaction.TransactionFailedError:
-                time.sleep(1)
-                continue
+    @classmethod
+    def key_for(cls, term, shard):
+        return u"%d|%s" % (shard, term)
+
+class JobCheckpoint(models.Model):
+    """
+        The progress of a long running job which walks a table, so that it can be
+        resumed if it dies
+    """
+    id = models.CharField(max_length=500, primary_key=True)
+    cursor = models.CharField(max_length=1024, null=True)
+    instances = models.PositiveIntegerField(default=0)
+    terms = models.PositiveIntegerField(default=0)
+    corrected = models.PositiveIntegerField(default=0) #Counters fixed by a recount
+    pending = models.IntegerField(default=0) #Chunks handed to other tasks which haven't finished
+    term = models.CharField(max_length=1024, null=True) #The term a recount is part way through summing
+    term_cursor = models.CharField(max_length=1500, null=True)
+    term_total = models.PositiveIntegerField(default=0) #What the postings of the term read so far add up to
+    walked = models.BooleanField(default=False)
+    started = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True)
+
+    def throughput(self):
+        """ Returns (instances per second, terms per second) """
+        end = self.finished or self.updated
+        seconds = max((end - self.started).total_seconds(), 1)
+        return self.instances / seconds, self.terms / seconds
+
+class PostingBlock(models.Model):
+    """
+        A block of the posting list of a term for the "postings" index backend. Holds
+        the pks of the instances hashed into the block, in order, and their occurances
+        as packed arrays.
+
+        Once a block outgrows POSTING_BLOCK_SIZE it's split by pk range. The block at the
+        hashed key (the head) then holds no postings, only the lower bounds of the blocks
+        it was split into.
+    """
+    FIRST_SPLIT = -2 ** 63
+
+    id = models.CharField(max_length=1500, primary_key=True)
+    term = models.CharField(max_length=1024)
+    instance_db_table = models.CharField(max_length=1024)
+    pks = models.BinaryField()
+    occurances = models.BinaryField()
+    splits = models.BinaryField()
+
+    @classmethod
+    def key_for(cls, db_table, term, block):
+        return u"%s|%d|%s" % (db_table, block, term)
+
+    @classmethod
+    def blocks(cls):
+        return POSTING_BLOCKS
+
+    @classmethod
+    def block_size(cls):
+        return POSTING_BLOCK_SIZE
+
+    @classmethod
+    def block_for(cls, pk):
+        return (zlib.crc32(str(pk)) & 0xffffffff) % POSTING_BLOCKS
+
+    def key_for_split(self, lower):
+        db_table, block, term = self.pk.split(u"|", 2)
+        return u"%s|%s>%d|%s" % (db_table, block, lower, term)
+
+    def get_splits(self):
+        if not self.splits:
+            return []
+        return list(struct.unpack("<%dq" % (len(self.splits) // 8), self.splits))
+
+    def set_splits(self, splits):
+        self.splits = struct.pack("<%dq" % len(splits), *splits)
+
+    def split_for(self, pk):
+        """ Returns the key of the block this head was split into which holds the pk """
+        splits = self.get_splits()
+        return self.key_for_split(splits[bisect.bisect_right(splits, pk) - 1])
+
+    def get_postings(self):
+        if not self.pks:
+            return {}
+
+        pks = struct.unpack("<%dq" % (len(self.pks) // 8), self.pks)
+        occurances = struct.unpack("<%dI" % len(pks), self.occurances)
+        return dict(zip(pks, occurances))
+
+    def set_postings(self, postings):
+        pks = sorted(postings)
+        self.pks = struct.pack("<%dq" % len(pks), *pks)
+        self.occurances = struct.pack("<%dI" % len(pks), *[ postings[pk] for pk in pks ])
+
+class InstanceTerms(models.Model):
+    """
+        The {term: occurances} (and word positions, for positional indexes) of an
+        indexed instance, so that the "postings" index backend can diff and unindex it
+        without querying the posting lists
+    """
+    id = models.CharField(max_length=1500, primary_key=True)
+    instance_db_table = models.CharField(max_length=1024)
+    instance_pk = models.PositiveIntegerField(default=0)
+    terms = models.BinaryField()
+    positions = models.BinaryField()
+
+    @classmethod
+    def key_for(cls, db_table, pk):
+        return u"%s|%s" % (db_table, pk)
+
+    def get_terms(self):
+        return json.loads(zlib.decompress(self.terms)) if self.terms else {}
+
+    def set_terms(self, term_occurances):
+        self.terms = zlib.compress(json.dumps(term_occurances))
+
+    def get_positions(self):
+        """ Returns {word: [positions]} if the instance was indexed positionally """
+        return json.loads(zlib.decompress(self.positions)) if self.positions else {}
+
+    def set_positions(self, term_positions):
+        self.positions = zlib.compress(json.dumps(term_positions)) if term_positions else ""
+
+class PendingCounts(models.Model):
+    """
+        The counter deltas of a write to the index of an instance which haven't been
+        applied yet, one per write, see _write_index()
+    """
+    id = models.CharField(max_length=1500, primary_key=True)
+    instance_db_table = models.CharField(max_length=1024)
+    instance_pk = models.PositiveIntegerField(default=0)
+    deltas = models.BinaryField()
+
+    @classmethod
+    def key_for(cls, db_table, pk, write_id):
+        return u"%s|%s|%s" % (db_table, pk, write_id)
+
+    def get_deltas(self):
+        return json.loads(zlib.decompress(self.deltas)) if self.deltas else {}
+
+    def set_deltas(self, deltas):
+        self.deltas = zlib.compress(json.dumps(deltas))
+
+class IndexChange(models.Model):
+    """ Records when an instance of a model which uses snapshots was last (un)indexed """
+    id = models.CharField(max_length=1500, primary_key=True)
+    instance_db_table = models.CharField(max_length=1024)
+    instance_pk = models.PositiveIntegerField(default=0)
+    changed = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def key_for(cls, db_table, pk):
+        return u"%s|%s" % (db_table, pk)
+
+class IndexTombstone(models.Model):
+    """
+        Marks a deleted instance whose index entries haven't been cleaned up yet, so
+        that searches can leave it out in the meantime
+    """
+    id = models.CharField(max_length=1500, primary_key=True)
+    instance_db_table = models.CharField(max_length=1024)
+    instance_pk = models.PositiveIntegerField(default=0)
+    deleted = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def key_for(cls, db_table, pk):
+        return u"%s|%s" % (db_table, pk)
+
+class IndexSnapshot(models.Model):
+    """ The current snapshot generation of a table, see snapshots.py """
+    id = models.CharField(max_length=1024, primary_key=True) #The db_table
+    generation = models.CharField(max_length=32)
+    taken = models.DateTimeField()
+    chunks = models.PositiveIntegerField(default=0)
+    size = models.PositiveIntegerField(default=0)
+
+class IndexSnapshotChunk(models.Model):
+    id = models.CharField(max_length=1500, primary_key=True)
+    data = models.BinaryField()
+
+    @classmethod
+    def key_for(cls, db_table, generation, chunk):
+        return u"%s|%s|%d" % (db_table, generation, chunk)
+
+class PartialTerm(models.Model):
+    """ Maps a partial (a prefix) to a word it is a partial of """
+    id = models.CharField(max_length=1500, primary_key=True)
+    partial = models.CharField(max_length=1024)
+    term = models.CharField(max_length=1024)
+
+    @classmethod
+    def key_for(cls, partial, term):
+        return u"%s|%s" % (partial, term)
 
 class Index(models.Model):
     iexact = models.CharField(max_length=1024)
     instance_db_table = models.CharField(max_length=1024)
     instance_pk = models.PositiveIntegerField(default=0)
     occurances = models.PositiveIntegerField(default=0)
+    positions = models.BinaryField() #Packed word positions, for positional indexes
+
+    def get_positions(self):
+        return list(struct.unpack("<%dI" % (len(self.positions) // 4), self.positions)) if self.positions else []
+
+    def set_positions(self, positions):
+        self.positions = struct.pack("<%dI" % len(positions), *positions)
 
     class Meta:
         unique_together = [
@@ -243,16 +1568,205 @@ class Index(models.Model):
         ]
 
 from django.dispatch import receiver
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import class_prepared, post_init, pre_save, post_save, pre_delete, post_delete
+
+_NOT_TRACKABLE = object()
+
+def _get_indexed_state(instance, fields_to_index):
+    """
+        Returns a copy of the local field values that are indexed, or _NOT_TRACKABLE
+        if the indexed data can't be determined without hitting the datastore (e.g.
+        a lookup which spans a relation, a property or a deferred field)
+    """
+    state = []
+    for field_name in fields_to_index:
+        if "__" in field_name:
+            relation = _get_relation(instance.__class__, field_name.split("__")[0])
+            if relation is None or len(field_name.split("__")) > 2:
+                return _NOT_TRACKABLE
+
+            related_model, fk, forward = relation
+            if not forward:
+                # Changes to the related objects are picked up by their own signals
+                continue
+            field_name = fk.name
+
+        try:
+            field = instance._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            return _NOT_TRACKABLE
+
+        if field.attname not in instance.__dict__:
+            return _NOT_TRACKABLE
+
+        state.append(copy.deepcopy(instance.__dict__[field.attname]))
+    return state
+
+
+def _indexed_fields_changed(instance, fields_to_index, update_fields=None, state_attr="_search_indexed_state"):
+    if update_fields is not None:
+        if not set(field.split("__")[0] for field in fields_to_index) & set(update_fields):
+            return False
+
+    original = getattr(instance, state_attr, _NOT_TRACKABLE)
+    if original is _NOT_TRACKABLE:
+        return True
+
+    current = _get_indexed_state(instance, fields_to_index)
+    return current is _NOT_TRACKABLE or current != original
+
+
+_dependencies = None
+
+def _get_dependencies(model_class):
+    """
+        Returns [(dependent model, related fields, foreign key, forward)] of the models which
+        index fields of model_class through a relation, e.g. an Author which indexes
+        book__title depends on Book
+    """
+    global _dependencies
+    if _dependencies is None:
+        dependencies = {}
+        for dependent in models.get_models():
+            fields_to_index = getattr(getattr(dependent, "Search", None), "fields", None) or []
+            for name, related_fields in _get_related_lookups(fields_to_index).items():
+                relation = _get_relation(dependent, name)
+                if relation:
+                    related_model, fk, forward = relation
+                    dependencies.setdefault(related_model, []).append((dependent, related_fields, fk, forward))
+        _dependencies = dependencies
+
+    return _dependencies.get(model_class._meta.concrete_model, [])
+
+
+def _get_dependency_fields(dependencies):
+    """ The fields of a related object which its dependents index, or use to find it """
+    fields = set()
+    for dependent, related_fields, fk, forward in dependencies:
+        fields.update(related_fields)
+        if not forward:
+            fields.add(fk.name)
+    return sorted(fields)
+
+
+def _get_dependent_pks(instance, dependencies):
+    """ Returns {dependent model: set(pks)} of the instances which index fields of the instance """
+    dependent_pks = {}
+    for dependent, related_fields, fk, forward in dependencies:
+        if forward:
+            pks = dependent.objects.filter(**{ fk.name: instance.pk }).values_list("pk", flat=True)
+        else:
+            pks = [ getattr(instance, fk.attname) ]
+        dependent_pks.setdefault(dependent, set()).update(pk for pk in pks if pk is not None)
+    return dependent_pks
+
+
+@db.non_transactional
+def _reindex_dependents(dependent_pks, defer_index=True):
+    """
+        Reindexes the given {model: pks}, deferring a single debounced task per chunk of
+        pks, so that a burst of changes to related objects reindexes each chunk once
+    """
+    from .jobs import DEFAULT_CHUNK_SIZE, index_chunk
+
+    for model_class, pks in dependent_pks.items():
+        model_label = _model_label(model_class)
+        pks = sorted(pks)
+        for i in xrange(0, len(pks), DEFAULT_CHUNK_SIZE):
+            chunk = pks[i:i + DEFAULT_CHUNK_SIZE]
+            if not defer_index:
+                index_chunk(model_label, chunk)
+            elif len(chunk) == 1:
+                # Coalesced with the instance's own saves, and the other changes which affect it
+                _defer_debounced(_instance_task_key(model_label, chunk[0]), _index_by_key, model_label, chunk[0])
+            else:
+                _defer_debounced(
+                    u"%s|%s" % (model_label, ",".join(unicode(pk) for pk in chunk)), index_chunk, model_label, chunk
+                )
+
+
+@receiver(class_prepared)
+def class_prepared_forget_dependencies(sender, *args, **kwargs):
+    global _dependencies
+    _dependencies = None
+
+@receiver(post_init)
+def post_init_store_indexed_state(sender, instance, *args, **kwargs):
+    if getattr(instance, "Search", None):
+        fields_to_index = getattr(instance.Search, "fields", [])
+        if fields_to_index and instance.pk is not None:
+            tracked_fields = fields_to_index + _get_search_filters(sender)
+            instance._search_indexed_state = _get_indexed_state(instance, tracked_fields)
+
+@receiver(pre_save)
+def pre_save_forget_indexed_state(sender, instance, *args, **kwargs):
+    # An instance which wasn't loaded from the datastore tells us nothing about what was indexed
+    if instance._state.adding and hasattr(instance, "_search_indexed_state"):
+        instance._search_indexed_state = _NOT_TRACKABLE
 
 @receiver(post_save)
-def post_save_index(sender, instance, created, raw, *args, **kwargs):
+def post_save_index(sender, instance, created, raw, update_fields=None, *args, **kwargs):
     if getattr(instance, "Search", None):
         fields_to_index = getattr(instance.Search, "fields", [])
         if fields_to_index:
+            tracked_fields = fields_to_index + _get_search_filters(sender)
+            if not created and not _indexed_fields_changed(instance, tracked_fields, update_fields):
+                return
+
             index_instance(instance, fields_to_index, defer_index=not raw) #Don't defer if we are loading from a fixture
+            instance._search_indexed_state = _get_indexed_state(instance, tracked_fields)
 
-@receiver(pre_delete)
-def pre_delete_unindex(sender, instance, using, *args, **kwarg):
+@receiver(post_delete)
+def post_delete_unindex(sender, instance, using, *args, **kwarg):
     if getattr(instance, "Search", None):
-        unindex_instance(instance)
+        tombstone_instance(instance)
+
+@receiver(post_init)
+def post_init_store_dependency_state(sender, instance, *args, **kwargs):
+    dependencies = _get_dependencies(sender)
+    if dependencies and instance.pk is not None:
+        instance._search_dependency_state = _get_indexed_state(instance, _get_dependency_fields(dependencies))
+        # The dependents this instance belonged to when it was loaded, in case it moves
+        instance._search_dependents = _get_dependent_pks(
+            instance, [ dependency for dependency in dependencies if not dependency[3] ]
+        )
+
+@receiver(pre_save)
+def pre_save_forget_dependency_state(sender, instance, *args, **kwargs):
+    if instance._state.adding and hasattr(instance, "_search_dependency_state"):
+        instance._search_dependency_state = _NOT_TRACKABLE
+        instance._search_dependents = {}
+
+@receiver(post_save)
+def post_save_reindex_dependents(sender, instance, created, raw, update_fields=None, *args, **kwargs):
+    dependencies = _get_dependencies(sender)
+    if not dependencies:
+        return
+
+    dependency_fields = _get_dependency_fields(dependencies)
+    if not created and not _indexed_fields_changed(instance, dependency_fields, update_fields, "_search_dependency_state"):
+        return
+
+    dependent_pks = _get_dependent_pks(instance, dependencies)
+    for dependent, pks in getattr(instance, "_search_dependents", {}).items():
+        dependent_pks.setdefault(dependent, set()).update(pks)
+
+    _reindex_dependents(dependent_pks, defer_index=not raw)
+
+    instance._search_dependency_state = _get_indexed_state(instance, dependency_fields)
+    instance._search_dependents = _get_dependent_pks(
+        instance, [ dependency for dependency in dependencies if not dependency[3] ]
+    )
+
+@receiver(pre_delete)
+def pre_delete_find_dependents(sender, instance, using, *args, **kwargs):
+    # Found before the delete, as it may cascade to (or null the foreign keys of) the dependents
+    dependencies = _get_dependencies(sender)
+    if dependencies:
+        instance._search_dependents = _get_dependent_pks(instance, dependencies)
+
+@receiver(post_delete)
+def post_delete_reindex_dependents(sender, instance, using, *args, **kwargs):
+    dependent_pks = getattr(instance, "_search_dependents", None)
+    if dependent_pks:
+        _reindex_dependents(dependent_pks)
@@ -0,0 +1,108 @@
+"""
+    Top-k ranking of search results.
+
+    Scores are based on the commonality of the matched terms, lower scores are better.
+    More matches are rewarded, but not too much so that rarer terms still have a chance.
+
+    Examples for n matches:
+
+    1 = 1 + (0 * 0.5) = 1    -> scores / 1
+    2 = 2 + (1 * 0.5) = 2.5  -> scores / 2.5 (rather than 2)
+    3 = 3 + (2 * 0.5) = 4    -> scores / 4 (rather than 3)
+
+    Terms are processed rarest first. Once enough candidates have been seen that
+    no document which only contains the remaining (common) terms can make it into
+    the top k, the postings of those terms are no longer read in full, they are only
+    checked for the candidates which could still make it (in the style of MaxScore).
+"""
+
+import heapq
+
+
+def score(weights):
+    n = float(len(weights))
+    return sum(weights) / (n + ((n-1) * 0.5))
+
+
+def _bounds(total, matched, remaining_ascending, remaining_descending):
+    """
+        Returns the (lowest, highest) score a document can end up with, given the
+        sum and number of its weights so far and the weights of the terms it may
+        still match.
+    """
+    lowest = highest = None
+    if matched:
+        lowest = highest = total / (matched + ((matched - 1) * 0.5))
+
+    low_total = high_total = total
+    for i in xrange(len(remaining_ascending)):
+        n = float(matched + i + 1)
+        low_total += remaining_ascending[i]
+        high_total += remaining_descending[i]
+
+        low = low_total / (n + ((n-1) * 0.5))
+        high = high_total / (n + ((n-1) * 0.5))
+        if lowest is None or low < lowest:
+            lowest = low
+        if highest is None or high > highest:
+            highest = high
+
+    return lowest, highest
+
+
+def rank(term_weights, fetch_postings, fetch_postings_for, limit=None, allowed=None, excluded=None, boost=None, max_boost=1.0):
+    """
+        Ranks the documents matching any of the terms.
+
+        term_weights: {term: weight}, usually the GlobalOccuranceCount of the term
+        fetch_postings: callable(term) returning the documents which contain the term
+        fetch_postings_for: callable(term, documents) returning the subset of the
+            documents which contain the term
+        limit: the number of results wanted, None ranks everything
+        allowed: if given, only these documents are ranked
+        excluded: if given, these documents are never ranked
+        boost: if given, callable(document) returning a factor its score is divided by
+        max_boost: the largest factor boost can return
+
+        Returns a sorted list of (score, document) tuples. The ordering is the same as
+        scoring every matching document and sorting.
+    """
+    terms = sorted(term_weights, key=lambda term: (term_weights[term], term))
+    boost = boost or (lambda document: 1.0)
+    excluded = excluded or ()
+
+    matches = {}
+
+    for i, term in enumerate(terms):
+        if limit and len(matches) >= limit:
+            remaining_ascending = [ term_weights[x] for x in terms[i:] ]
+            remaining_descending = remaining_ascending[::-1]
+
+            # Nobody can do better than the k-th best worst case score
+            threshold = heapq.nsmallest(limit, (
+                _bounds(sum(weights), len(weights), remaining_ascending, remaining_descending)[1] / boost(document)
+                for document, weights in matches.iteritems()
+            ))[-1]
+
+            unseen_best = _bounds(0, 0, remaining_ascending, remaining_descending)[0] / max_boost
+            if unseen_best > threshold:
+                candidates = set(
+                    document for document, weights in matches.iteritems()
+                    if _bounds(sum(weights), len(weights), remaining_ascending, remaining_descending)[0] / boost(document) <= threshold
+                )
+                for term in terms[i:]:
+                    for document in fetch_postings_for(term, candidates):
+                        matches[document].append(term_weights[term])
+
+                matches = dict((document, matches[document]) for document in candidates)
+                break
+
+        weight = term_weights[term]
+        for document in fetch_postings(term):
+            if (allowed is None or document in allowed) and document not in excluded:
+                matches.setdefault(document, []).append(weight)
+
+    scores = ((score(weights) / boost(document), document) for document, weights in matches.iteritems())
+    if limit:
+        return heapq.nsmallest(limit, scores)
+    return sorted(scores)
@@ -0,0 +1,404 @@
+"""
+    Read-only snapshots of the index of a model, for small read-heavy models which
+    set snapshot = True in their Search class.
+
+    A snapshot is a single immutable buffer holding a sorted term dictionary and the
+    posting lists of the terms as packed arrays. publish_snapshot() stores it in the
+    datastore as a new generation. Each process loads the current generation once and
+    ranks searches against it in memory, checking for a newer generation (and for
+    instances indexed since the snapshot was taken, which are merged in as a delta)
+    at most every SEARCH_SNAPSHOT_CHECK_INTERVAL seconds.
+
+    Layout, all little endian:
+
+        MAGIC
+        header length (I), JSON header
+        term offsets ((terms + 1) * I) into the term data
+        posting offsets ((terms + 1) * I) into the pks and occurances
+        counts (terms * I), the GlobalOccuranceCount of each term when the snapshot was taken
+        term data, the UTF-8 terms in byte order
+        pks (postings * q), sorted within each term
+        occurances (postings * I)
+"""
+
+import calendar
+import datetime
+import itertools
+import json
+import logging
+import struct
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.encoding import smart_str, smart_unicode
+
+try:
+    import mmap
+except ImportError:
+    # Not available on App Engine, where snapshots are always held in memory
+    mmap = None
+
+from .models import (
+    FILTER_TERM_SEPARATOR,
+    MAX_BATCH_SIZE,
+    IndexChange,
+    IndexSnapshot,
+    IndexSnapshotChunk,
+    IndexTombstone,
+    get_index_backend,
+    get_occurance_counts,
+)
+
+MAGIC = "SSNAP\x00\x00\x01"
+
+# Snapshots are stored in chunks comfortably under the 1MB entity limit
+CHUNK_SIZE = 900 * 1024
+
+# How often a process checks for a new generation, or for newly indexed instances
+CHECK_INTERVAL = getattr(settings, "SEARCH_SNAPSHOT_CHECK_INTERVAL", 10)
+
+# If more instances than this have been indexed since the snapshot was taken, searches
+# go to the datastore until a new snapshot is published
+MAX_DELTA = getattr(settings, "SEARCH_SNAPSHOT_MAX_DELTA", 100)
+
+
+def _generation_key(db_table):
+    return "simple_search:snapshot_generation:%s" % db_table
+
+def _changes_key(db_table):
+    return "simple_search:snapshot_changes:%s" % db_table
+
+
+def _to_timestamp(value):
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+def _from_timestamp(timestamp):
+    value = datetime.datetime.utcfromtimestamp(timestamp)
+    if settings.USE_TZ:
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def build_snapshot(db_table, generation, taken, postings, counts):
+    """
+        Returns the snapshot of postings ({term: {pk: occurances}}) as a string.
+        counts: {term: GlobalOccuranceCount}, taken: when the index was read
+    """
+    terms = sorted((smart_str(term), term) for term in postings if postings[term])
+
+    term_offsets = [ 0 ]
+    posting_offsets = [ 0 ]
+    pks = []
+    occurances = []
+    for encoded, term in terms:
+        term_offsets.append(term_offsets[-1] + len(encoded))
+        for pk in sorted(postings[term]):
+            pks.append(pk)
+            occurances.append(postings[term][pk])
+        posting_offsets.append(len(pks))
+
+    header = json.dumps({
+        "db_table": db_table,
+        "generation": generation,
+        "taken": _to_timestamp(taken),
+        "terms": len(terms),
+        "postings": len(pks),
+        "term_data": term_offsets[-1],
+    })
+
+    return "".join([
+        MAGIC,
+        struct.pack("<I", len(header)),
+        header,
+        struct.pack("<%dI" % len(term_offsets), *term_offsets),
+        struct.pack("<%dI" % len(posting_offsets), *posting_offsets),
+        struct.pack("<%dI" % len(terms), *[ counts.get(term, 0) for encoded, term in terms ]),
+        "".join(encoded for encoded, term in terms),
+        struct.pack("<%dq" % len(pks), *pks),
+        struct.pack("<%dI" % len(occurances), *occurances),
+    ])
+
+
+class Snapshot(object):
+    """ Reads a snapshot from a string or mmap without unpacking it """
+
+    def __init__(self, data):
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a search index snapshot")
+
+        header_length, = struct.unpack_from("<I", data, len(MAGIC))
+        offset = len(MAGIC) + 4
+        header = json.loads(data[offset:offset + header_length])
+        offset += header_length
+
+        self.data = data
+        self.db_table = header["db_table"]
+        self.generation = header["generation"]
+        self.taken = _from_timestamp(header["taken"])
+        self.term_count = header["terms"]
+
+        self._term_offsets = offset
+        self._posting_offsets = self._term_offsets + (self.term_count + 1) * 4
+        self._counts = self._posting_offsets + (self.term_count + 1) * 4
+        self._term_data = self._counts + self.term_count * 4
+        self._pks = self._term_data + header["term_data"]
+        self._occurances = self._pks + header["postings"] * 8
+
+    @classmethod
+    def open(cls, path):
+        """ Memory maps a snapshot file where possible, rather than reading it """
+        with open(path, "rb") as f:
+            if mmap is None:
+                return cls(f.read())
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def _get_term(self, i):
+        start, end = struct.unpack_from("<2I", self.data, self._term_offsets + i * 4)
+        return self.data[self._term_data + start:self._term_data + end]
+
+    def _find(self, term):
+        """ Returns the position of the first term >= term in the dictionary """
+        encoded = smart_str(term)
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_term(mid) < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _lookup(self, term):
+        i = self._find(term)
+        if i < self.term_count and self._get_term(i) == smart_str(term):
+            return i
+        return None
+
+    def get_count(self, term):
+        i = self._lookup(term)
+        if i is None:
+            return 0
+        return struct.unpack_from("<I", self.data, self._counts + i * 4)[0]
+
+    def get_postings(self, term):
+        i = self._lookup(term)
+        if i is None:
+            return {}
+
+        start, end = struct.unpack_from("<2I", self.data, self._posting_offsets + i * 4)
+        pks = struct.unpack_from("<%dq" % (end - start), self.data, self._pks + start * 8)
+        occurances = struct.unpack_from("<%dI" % (end - start), self.data, self._occurances + start * 4)
+        return dict(zip(pks, occurances))
+
+    def iter_terms_with_prefix(self, prefix):
+        encoded = smart_str(prefix)
+        for i in xrange(self._find(prefix), self.term_count):
+            term = self._get_term(i)
+            if not term.startswith(encoded):
+                break
+            yield smart_unicode(term)
+
+
+class SnapshotIndex(object):
+    """
+        Serves a table from a snapshot with the instances indexed since it was taken
+        merged in. Has the read methods of an index backend, so _rank() can use it in
+        place of one.
+
+        delta: {pk: {term: occurances}} of the instances indexed since the snapshot, an
+            instance which has been unindexed has no terms
+    """
+    def __init__(self, snapshot, delta):
+        self.snapshot = snapshot
+        self.delta = delta
+
+    def get_occurance_counts(self, terms):
+        # Counts are as of the snapshot, ranking only needs them to be roughly right
+        counts = {}
+        for term in set(terms):
+            count = self.snapshot.get_count(term)
+            if not count:
+                count = sum(term_occurances.get(term, 0) for term_occurances in self.delta.values())
+            if count:
+                counts[term] = count
+        return counts
+
+    def get_words_with_prefix(self, prefix, limit):
+        """ Like the PartialTerms of the prefix, the words it is a partial of """
+        terms = set(itertools.islice(
+            (term for term in self.snapshot.iter_terms_with_prefix(prefix) if " " not in term), limit + 1
+        ))
+        for term_occurances in self.delta.values():
+            terms.update(term for term in term_occurances if term.startswith(prefix))
+
+        return sorted(
+            term for term in terms if term != prefix and " " not in term and FILTER_TERM_SEPARATOR not in term
+        )[:limit]
+
+    def get_postings(self, term, db_table):
+        postings = dict(
+            (pk, occurances) for pk, occurances in self.snapshot.get_postings(term).items() if pk not in self.delta
+        )
+        for pk, term_occurances in self.delta.items():
+            if term_occurances.get(term):
+                postings[pk] = term_occurances[term]
+        return postings
+
+    def get_postings_for(self, term, db_table, pks, term_count):
+        return dict((pk, occurances) for pk, occurances in self.get_postings(term, db_table).items() if pk in pks)
+
+    def get_positions(self, db_table, terms, pks):
+        # Snapshots don't hold positions
+        return get_index_backend().get_positions(db_table, terms, pks)
+
+
+def export_snapshot(db_table, generation=None):
+    """ Reads the whole index of a table and returns it as a snapshot string """
+    taken = timezone.now()
+    postings = get_index_backend().get_table_postings(db_table)
+
+    terms = list(postings)
+    counts = {}
+    for i in xrange(0, len(terms), MAX_BATCH_SIZE):
+        counts.update(get_occurance_counts(terms[i:i + MAX_BATCH_SIZE]))
+
+    return build_snapshot(db_table, generation or uuid.uuid4().hex, taken, postings, counts)
+
+
+def publish_snapshot(model_class):
+    """
+        Exports the index of the model and makes it the current generation, then
+        cleans up the previous generation and the changes it no longer needs
+    """
+    db_table = model_class._meta.db_table
+    generation = uuid.uuid4().hex
+    data = export_snapshot(db_table, generation)
+    snapshot = Snapshot(data)
+
+    chunks = [
+        IndexSnapshotChunk(pk=IndexSnapshotChunk.key_for(db_table, generation, i), data=data[offset:offset + CHUNK_SIZE])
+        for i, offset in enumerate(xrange(0, len(data), CHUNK_SIZE))
+    ]
+    for chunk in chunks:
+        chunk.save()
+
+    previous = IndexSnapshot.objects.filter(pk=db_table).first()
+    IndexSnapshot(
+        pk=db_table, generation=generation, taken=snapshot.taken, chunks=len(chunks), size=len(data)
+    ).save()
+    cache.set(_generation_key(db_table), generation)
+
+    if previous and previous.generation != generation:
+        IndexSnapshotChunk.objects.filter(pk__in=[
+            IndexSnapshotChunk.key_for(db_table, previous.generation, i) for i in xrange(previous.chunks)
+        ]).delete()
+
+    while True:
+        keys = list(IndexChange.objects.filter(
+            instance_db_table=db_table, changed__lt=snapshot.taken
+        ).values_list("pk", flat=True)[:MAX_BATCH_SIZE])
+        if not keys:
+            break
+        IndexChange.objects.filter(pk__in=keys).delete()
+
+    logging.info("Published snapshot %s of %s, %s terms in %s bytes", generation, db_table, snapshot.term_count, len(data))
+    return snapshot
+
+
+def _load_published(db_table, generation):
+    head = IndexSnapshot.objects.filter(pk=db_table).first()
+    if not head or head.generation != generation:
+        return None
+
+    keys = [ IndexSnapshotChunk.key_for(db_table, generation, i) for i in xrange(head.chunks) ]
+    chunks = IndexSnapshotChunk.objects.in_bulk(keys)
+    if len(chunks) != len(keys):
+        # Replaced while we were loading it
+        return None
+
+    return Snapshot("".join(str(chunks[key].data) for key in keys))
+
+
+def _load_delta(db_table, snapshot):
+    """
+        Returns {pk: {term: occurances}} of the instances (un)indexed or deleted since the
+        snapshot, or None if there are too many
+    """
+    pks = set(change.instance_pk for change in IndexChange.objects.filter(
+        instance_db_table=db_table, changed__gte=snapshot.taken
+    )[:MAX_DELTA + 1])
+
+    if len(pks) > MAX_DELTA:
+        logging.warning("%s has changed too much since its snapshot was taken, publish a new one", db_table)
+        return None
+
+    # Deleted instances which haven't been unindexed yet are left out, as if they had been
+    tombstoned = set(tombstone.instance_pk for tombstone in IndexTombstone.objects.in_bulk([
+        IndexTombstone.key_for(db_table, pk) for pk in pks
+    ]).values())
+
+    backend = get_index_backend()
+    return dict((pk, {} if pk in tombstoned else backend.get_instance_terms(db_table, pk)) for pk in pks)
+
+
+def record_change(db_table, pk):
+    """ Records that an instance was (un)indexed, so snapshot readers merge it in """
+    IndexChange(pk=IndexChange.key_for(db_table, pk), instance_db_table=db_table, instance_pk=pk).save()
+    cache.set(_changes_key(db_table), uuid.uuid4().hex)
+
+
+# {db_table: {"snapshot", "delta", "changes", "checked"}} of the snapshots this process has loaded
+_loaded = {}
+
+def get_snapshot_index(db_table):
+    """
+        Returns a SnapshotIndex of the current generation for the table, or None if no
+        snapshot has been published (or it has fallen too far behind)
+    """
+    state = _loaded.get(db_table)
+    if state and time.time() - state["checked"] < CHECK_INTERVAL:
+        return state["index"]
+
+    generation_key, changes_key = _generation_key(db_table), _changes_key(db_table)
+    tokens = cache.get_many([ generation_key, changes_key ])
+
+    generation = tokens.get(generation_key)
+    if generation is None:
+        head = IndexSnapshot.objects.filter(pk=db_table).first()
+        if not head:
+            _loaded.pop(db_table, None)
+            return None
+        generation = head.generation
+        cache.set(generation_key, generation)
+
+    changes = tokens.get(changes_key)
+    if changes is None:
+        # Unknown, so anything could have changed
+        changes = uuid.uuid4().hex
+        cache.set(changes_key, changes)
+
+    snapshot = state["snapshot"] if state else None
+    if snapshot is None or snapshot.generation != generation:
+        snapshot = _load_published(db_table, generation) or snapshot
+        if snapshot is None:
+            return None
+        state = None
+
+    if state and state["changes"] == changes:
+        delta = state["delta"]
+    else:
+        delta = _load_delta(db_table, snapshot)
+
+    state = _loaded[db_table] = {
+        "snapshot": snapshot,
+        "delta": delta,
+        "changes": changes,
+        "checked": time.time(),
+        "index": SnapshotIndex(snapshot, delta) if delta is not None else None,
+    }
+    return state["index"]
@@ -0,0 +1,186 @@
+"""
+    Instrumentation of searching and indexing, off unless SEARCH_STATS_CALLBACK is set to
+    a callable (or the dotted path of one). It is called with a Stats after each search,
+    search_with_cursor, index, unindex and indexed chunk:
+
+        def report_search_stats(stats):
+            logging.info("%s took %s, %s", stats.operation, stats.timings, stats.counters)
+
+    Stats.timings are {phase: seconds}, exclusive of any phases nested inside them:
+
+        search: "counts" (fetching GlobalOccuranceCounts), "postings" (reading the index),
+            "ranking" and "fetch" (fetching the ranked instances)
+        indexing: "fetch", "analysis", "index_write" and "counts"
+
+    Stats.counters include "terms", "candidates" (postings read while ranking), "results",
+    "changed_terms", "transaction_retries", "rpcs" and "datastore_rpcs".
+"""
+
+import functools
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_by_path
+
+from google.appengine.api import apiproxy_stub_map
+
+STATS_CALLBACK = getattr(settings, "SEARCH_STATS_CALLBACK", None)
+
+_local = threading.local()
+
+
+class Stats(object):
+    def __init__(self, operation, **info):
+        self.operation = operation
+        self.info = info
+        self.timings = {}
+        self.counters = {}
+        self._phases = []
+        self._lock = threading.Lock()
+
+    def incr(self, counter, count=1):
+        # Worker threads count towards the Stats of the thread which started them
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + count
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+
+class _Phase(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.nested = 0.0
+        self.started = time.time()
+        self.stats._phases.append(self)
+
+    def __exit__(self, *args):
+        elapsed = time.time() - self.started
+        self.stats._phases.pop()
+        self.stats.timings[self.name] = self.stats.timings.get(self.name, 0.0) + elapsed - self.nested
+        if self.stats._phases:
+            self.stats._phases[-1].nested += elapsed
+
+
+class _NullStats(object):
+    """ Used when stats aren't being collected, so instrumentation costs next to nothing """
+    def incr(self, counter, count=1):
+        pass
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_NULL_STATS = _NULL_PHASE = _NullStats()
+
+
+class _WorkerStats(object):
+    """
+        The Stats of a thread as seen by the worker threads it starts. Counters are
+        shared, phases are timed by the starting thread alone.
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def incr(self, counter, count=1):
+        self.stats.incr(counter, count)
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+
+def _count_rpc(service, call, request, response):
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        stats.incr("rpcs")
+        if service == "datastore_v3":
+            stats.incr("datastore_rpcs")
+
+
+_callback = None
+
+def _get_callback():
+    global _callback
+    if _callback is None and STATS_CALLBACK:
+        _callback = import_by_path(STATS_CALLBACK) if isinstance(STATS_CALLBACK, basestring) else STATS_CALLBACK
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append("simple_search_stats", _count_rpc)
+    return _callback
+
+
+class _Collect(object):
+    def __init__(self, callback, operation, info):
+        self.callback = callback
+        self.stats = Stats(operation, **info)
+
+    def __enter__(self):
+        _local.stats = self.stats
+        self.phase = self.stats.phase("total")
+        self.phase.__enter__()
+        return self.stats
+
+    def __exit__(self, *args):
+        self.phase.__exit__()
+        # Everything which wasn't in another phase
+        self.stats.timings.pop("total", None)
+        self.stats.timings["other"] = time.time() - self.phase.started - self.phase.nested
+        _local.stats = None
+        try:
+            self.callback(self.stats)
+        except Exception:
+            logging.exception("The search stats callback failed")
+
+
+def collect(operation, **info):
+    """
+        Collects the stats of an operation within a with block, reporting them to the
+        callback at the end. Nested operations are counted as part of the outer one.
+    """
+    callback = _get_callback()
+    if callback is None or getattr(_local, "stats", None) is not None:
+        return _NULL_STATS
+    return _Collect(callback, operation, info)
+
+
+def instrument(operation):
+    """
+        Decorates a function to collect the stats of each call. The first argument of the
+        function (a model, an instance or a model label) is recorded as the "model" info.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _get_callback() is None:
+                return func(*args, **kwargs)
+
+            model = args[0] if args else None
+            model = getattr(getattr(model, "_meta", None), "db_table", model)
+            with collect(operation, model=model):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current():
+    """ The Stats being collected on this thread, if any """
+    return getattr(_local, "stats", None) or _NULL_STATS
+
+
+def capture():
+    """ Returns the stats being collected on this thread, for attach() in the threads it starts """
+    collecting = getattr(_local, "stats", None)
+    return collecting.stats if isinstance(collecting, _WorkerStats) else collecting
+
+
+def attach(captured):
+    """ Makes the current (worker) thread count its RPCs and counters towards the captured stats """
+    _local.stats = _WorkerStats(captured) if captured is not None else None
@@ -8,13 +8,35 @@ Replace this with more appropriate tests for your application.
 
 import unittest
 from django.db import models
+from django.db.models.query import QuerySet
 
+from djangae.db import transaction
 from djangae.test import TestCase
 
+from . import cache as search_cache
+from . import models as search_models
+from . import ranking
+from . import snapshots
+from . import stats as search_stats
+from .analysis import Analyzer, ENGLISH_STOPWORDS
+from .backends import PostingListBackend
+from .benchmarks import ZipfianCorpus, _get_benchmark_model, run_benchmark
+from .jobs import recount_occurances, reindex_job_id, reindex_model, sweep_orphans
 from .models import (
     GlobalOccuranceCount,
     Index,
+    IndexTombstone,
+    JobCheckpoint,
+    PartialTerm,
+    PendingCounts,
+    PostingBlock,
+    _indexed_fields_changed,
+    _rank,
+    _run_in_transaction,
+    get_occurance_counts,
     index_instance,
+    parse_terms,
+    search_with_cursor,
     unindex_instance,
     search
 )
@@ -26,6 +48,71 @@ class SampleModel(models.Model):
     def __unicode__(self):
         return u"{} - {}".format(self.field1, self.field2)
 
+class SearchableModel(models.Model):
+    field1 = models.CharField(max_length=1024)
+    field2 = models.CharField(max_length=1024)
+
+    class Search:
+        fields = [
+            "field1"
+        ]
+
+class FilterableModel(models.Model):
+    field1 = models.CharField(max_length=1024)
+    status = models.CharField(max_length=20)
+    rating = models.IntegerField(default=0)
+
+    class Search:
+        fields = [
+            "field1"
+        ]
+        filters = [
+            "status"
+        ]
+
+class StopwordModel(models.Model):
+    field1 = models.CharField(max_length=1024)
+
+    class Search:
+        fields = [
+            "field1"
+        ]
+        analyzer = Analyzer(stopwords=ENGLISH_STOPWORDS, min_length=2)
+
+class PositionalModel(models.Model):
+    field1 = models.CharField(max_length=1024)
+
+    class Search:
+        fields = [
+            "field1"
+        ]
+        positional = True
+
+class CachedModel(search_cache.BasicCachedModel):
+    email = models.CharField(max_length=100, unique=True)
+
+class SnapshotModel(models.Model):
+    field1 = models.CharField(max_length=1024)
+
+    class Search:
+        fields = [
+            "field1"
+        ]
+        snapshot = True
+
+class Author(models.Model):
+    name = models.CharField(max_length=1024)
+
+    class Search:
+        fields = [
+            "name",
+            "book__title"
+        ]
+
+class Book(models.Model):
+    title = models.CharField(max_length=1024)
+    author = models.ForeignKey(Author)
+
 class SearchTests(TestCase):
     def test_field_indexing(self):
         instance1 = SampleModel.objects.create(
@@ -158,6 +245,759 @@ class SearchTests(TestCase):
         self.assertEqual(1, goc.count)
         self.assertEqual(2, Index.objects.count())
 
+    def test_repeated_terms_are_counted_once_per_instance(self):
+        instance1 = SampleModel.objects.create(field1="banana banana apple", field2="banana")
+        index_instance(instance1, ["field1", "field2"], defer_index=False)
+
+        self.assertEqual(1, Index.objects.filter(iexact="banana").count())
+        self.assertEqual(3, Index.objects.get(iexact="banana").occurances)
+        self.assertEqual(3, GlobalOccuranceCount.objects.get(pk="banana").count)
+        self.assertEqual(1, GlobalOccuranceCount.objects.get(pk="banana banana").count)
+
+        unindex_instance(instance1)
+
+        self.assertEqual(0, Index.objects.count())
+        self.assertEqual(0, GlobalOccuranceCount.objects.get(pk="banana").count)
+
+    def test_sharded_counters(self):
+        original_shards = search_models.COUNTER_SHARDS
+        search_models.COUNTER_SHARDS = 4
+        try:
+            instances = [ SampleModel.objects.create(field1="banana") for i in xrange(10) ]
+            for instance in instances:
+                index_instance(instance, ["field1"], defer_index=False)
+
+            self.assertEqual({"banana": 10}, get_occurance_counts(["banana", "cherry"]))
+
+            unindex_instance(instances[0])
+            self.assertEqual({"banana": 9}, get_occurance_counts(["banana"]))
+            self.assertItemsEqual(instances[1:], search(SampleModel, "banana"))
+        finally:
+            search_models.COUNTER_SHARDS = original_shards
+
+    def test_reindexing_only_writes_the_difference(self):
+        instance1 = SampleModel.objects.create(field1="banana apple")
+        index_instance(instance1, ["field1"], defer_index=False)
+
+        banana = Index.objects.get(iexact="banana")
+
+        instance1.field1 = "banana cherry cherry"
+        instance1.save()
+        index_instance(instance1, ["field1"], defer_index=False)
+
+        # Unchanged terms are left alone
+        self.assertEqual(banana.pk, Index.objects.get(iexact="banana").pk)
+        self.assertEqual(0, Index.objects.filter(iexact="apple").count())
+        self.assertEqual(0, Index.objects.filter(iexact="banana apple").count())
+        self.assertEqual(2, Index.objects.get(iexact="cherry").occurances)
+
+        self.assertEqual(1, GlobalOccuranceCount.objects.get(pk="banana").count)
+        self.assertEqual(0, GlobalOccuranceCount.objects.get(pk="apple").count)
+        self.assertEqual(2, GlobalOccuranceCount.objects.get(pk="cherry").count)
+
+    def test_saves_which_dont_touch_indexed_fields_are_ignored(self):
+        instance1 = SearchableModel.objects.create(field1="banana", field2="apple")
+        instance1 = SearchableModel.objects.get(pk=instance1.pk)
+
+        self.assertFalse(_indexed_fields_changed(instance1, ["field1"]))
+
+        instance1.field2 = "cherry"
+        self.assertFalse(_indexed_fields_changed(instance1, ["field1"]))
+
+        instance1.field1 = "cherry"
+        self.assertTrue(_indexed_fields_changed(instance1, ["field1"]))
+        self.assertFalse(_indexed_fields_changed(instance1, ["field1"], update_fields=["field2"]))
+        self.assertTrue(_indexed_fields_changed(instance1, ["field1"], update_fields=["field1"]))
+
+    def test_top_k_ranking_matches_full_ranking(self):
+        postings = {
+            "rare": set(xrange(0, 200, 20)),
+            "uncommon": set(xrange(0, 1000, 7)),
+            "common": set(xrange(0, 1000, 2)),
+            "the": set(xrange(1000)),
+        }
+        weights = dict((term, len(pks)) for term, pks in postings.items())
+
+        fully_read = []
+        def fetch_postings(term):
+            fully_read.append(term)
+            return postings[term]
+
+        def fetch_postings_for(term, pks):
+            return postings[term] & pks
+
+        expected = ranking.rank(weights, fetch_postings, fetch_postings_for)
+        self.assertEqual(1000, len(expected))
+
+        fully_read = []
+        self.assertEqual(expected[:10], ranking.rank(weights, fetch_postings, fetch_postings_for, limit=10))
+
+        # The most common term was only checked against the candidates
+        self.assertNotIn("the", fully_read)
+
+    def test_search_pages_are_ranked_consistently(self):
+        instances = []
+        for i in xrange(6):
+            instance = SampleModel.objects.create(field1=" ".join(["banana"] + ["apple"] * (i % 2)))
+            index_instance(instance, ["field1"], defer_index=False)
+            instances.append(instance)
+
+        everything = search(SampleModel, "banana apple", per_page=6, total_pages=1)
+        self.assertEqual(6, len(everything))
+
+        pages = [ search(SampleModel, "banana apple", per_page=2, current_page=page) for page in (1, 2, 3) ]
+        self.assertEqual(everything, pages[0] + pages[1] + pages[2])
+
+    def test_cached_results_are_invalidated_by_their_terms(self):
+        original_timeout = search_cache.RESULT_CACHE_TIMEOUT
+        search_cache.RESULT_CACHE_TIMEOUT = 60
+        try:
+            instance1 = SampleModel.objects.create(field1="banana")
+            instance2 = SampleModel.objects.create(field1="banana")
+            index_instance(instance1, ["field1"], defer_index=False)
+
+            self.assertItemsEqual([instance1], search(SampleModel, "banana"))
+
+            apple_generations = search_cache.get_term_generations(["apple"])
+            index_instance(instance2, ["field1"], defer_index=False)
+
+            # Indexing banana leaves apple searches alone
+            self.assertEqual(apple_generations, search_cache.get_term_generations(["apple"]))
+            self.assertItemsEqual([instance1, instance2], search(SampleModel, "banana"))
+
+            unindex_instance(instance1)
+            self.assertItemsEqual([instance2], search(SampleModel, "banana"))
+        finally:
+            search_cache.RESULT_CACHE_TIMEOUT = original_timeout
+
+    def test_reindexing_a_model_resumes_from_the_checkpoint(self):
+        instances = [ SearchableModel.objects.create(field1="banana") for i in xrange(5) ]
+        instances.sort(key=lambda x: x.pk)
+
+        JobCheckpoint.objects.create(pk=reindex_job_id(SearchableModel), cursor=unicode(instances[2].pk))
+
+        checkpoint = reindex_model(SearchableModel, chunk_size=2, defer=False)
+        self.assertTrue(checkpoint.finished)
+        self.assertEqual(2, checkpoint.instances)
+        self.assertEqual(2, checkpoint.terms)
+        self.assertItemsEqual(instances[3:], search(SearchableModel, "banana"))
+
+        checkpoint = reindex_model(SearchableModel, chunk_size=2, defer=False, restart=True)
+        self.assertEqual(5, checkpoint.instances)
+        self.assertItemsEqual(instances, search(SearchableModel, "banana"))
+        self.assertEqual({"banana": 5}, get_occurance_counts(["banana"]))
+
+    def test_posting_list_backend(self):
+        original_backend = search_models._index_backend
+        search_models._index_backend = PostingListBackend()
+        try:
+            instance1 = SampleModel.objects.create(field1="banana apple")
+            instance2 = SampleModel.objects.create(field1="banana")
+            index_instance(instance1, ["field1"], defer_index=False)
+            index_instance(instance2, ["field1"], defer_index=False)
+
+            self.assertEqual(0, Index.objects.count())
+            self.assertTrue(PostingBlock.objects.filter(term="banana").exists())
+            self.assertItemsEqual([instance1, instance2], search(SampleModel, "banana"))
+            self.assertItemsEqual([instance1], search(SampleModel, "apple"))
+
+            instance1.field1 = "cherry"
+            instance1.save()
+            index_instance(instance1, ["field1"], defer_index=False)
+
+            self.assertItemsEqual([instance2], search(SampleModel, "banana"))
+            self.assertEqual({"banana": 1, "apple": 0}, get_occurance_counts(["banana", "apple"]))
+            self.assertFalse(PostingBlock.objects.filter(term="apple").exists())
+
+            unindex_instance(instance2)
+            self.assertItemsEqual([], search(SampleModel, "banana"))
+        finally:
+            search_models._index_backend = original_backend
+
+    def test_full_posting_blocks_are_split(self):
+        original_backend = search_models._index_backend
+        search_models._index_backend = PostingListBackend()
+        original_blocks, original_block_size = search_models.POSTING_BLOCKS, search_models.POSTING_BLOCK_SIZE
+        search_models.POSTING_BLOCKS, search_models.POSTING_BLOCK_SIZE = 1, 2
+        try:
+            instances = [ SampleModel.objects.create(field1="banana") for i in xrange(5) ]
+            for instance in instances:
+                index_instance(instance, ["field1"], defer_index=False)
+
+            # The head only records the splits, no block holds more than 2 postings
+            self.assertTrue(PostingBlock.objects.filter(term="banana").count() > 2)
+            for posting_block in PostingBlock.objects.filter(term="banana"):
+                self.assertTrue(len(posting_block.get_postings()) <= 2)
+
+            self.assertItemsEqual(instances, search(SampleModel, "banana"))
+
+            unindex_instance(instances[0])
+            self.assertItemsEqual(instances[1:], search(SampleModel, "banana"))
+            self.assertEqual({"banana": 4}, get_occurance_counts(["banana"]))
+        finally:
+            search_models.POSTING_BLOCKS, search_models.POSTING_BLOCK_SIZE = original_blocks, original_block_size
+            search_models._index_backend = original_backend
+
+    def test_reindexing_migrates_index_rows_to_posting_lists(self):
+        instance1 = SampleModel.objects.create(field1="banana apple")
+        index_instance(instance1, ["field1"], defer_index=False)
+        self.assertEqual(3, Index.objects.count())
+
+        original_backend = search_models._index_backend
+        search_models._index_backend = PostingListBackend()
+        try:
+            index_instance(instance1, ["field1"], defer_index=False)
+
+            self.assertEqual(0, Index.objects.count())
+            self.assertItemsEqual([instance1], search(SampleModel, "banana apple"))
+
+            # The counters already included the rows, so they are unchanged
+            self.assertEqual({"banana": 1, "apple": 1}, get_occurance_counts(["banana", "apple"]))
+        finally:
+            search_models._index_backend = original_backend
+
+    def test_partial_matching(self):
+        original_partials = search_models.PARTIAL_MATCHES
+        search_models.PARTIAL_MATCHES = True
+        try:
+            instance1 = SampleModel.objects.create(field1="bananas")
+            instance2 = SampleModel.objects.create(field1="banana")
+            instance3 = SampleModel.objects.create(field1="bandana")
+            for instance in (instance1, instance2, instance3):
+                index_instance(instance, ["field1"], defer_index=False)
+
+            # Partials are recorded per word, not per instance
+            self.assertEqual(3, PartialTerm.objects.filter(term="bananas").count())
+            index_instance(instance1, ["field1"], defer_index=False)
+            self.assertEqual(3, PartialTerm.objects.filter(term="bananas").count())
+
+            # Exact matches beat partial ones, and longer partials beat shorter ones
+            self.assertEqual([instance2, instance1], search(SampleModel, "banana"))
+            self.assertEqual([instance2, instance1], search(SampleModel, "banan"))
+            self.assertItemsEqual([instance1, instance2, instance3], search(SampleModel, "band bana"))
+
+            original_limit = search_models.PARTIAL_EXPANSION_LIMIT
+            search_models.PARTIAL_EXPANSION_LIMIT = 1
+            try:
+                self.assertEqual(1, len(search(SampleModel, "bana")))
+            finally:
+                search_models.PARTIAL_EXPANSION_LIMIT = original_limit
+        finally:
+            search_models.PARTIAL_MATCHES = original_partials
+
+    def test_filtered_searches_return_full_pages(self):
+        instances = []
+        for i in xrange(20):
+            instance = FilterableModel.objects.create(field1="banana", status="draft" if i % 4 else "published", rating=i % 4)
+            index_instance(instance, ["field1"], defer_index=False)
+            instances.append(instance)
+
+        published = [ x for x in instances if x.status == "published" ]
+
+        # Filters on the Search filters narrow the candidates with the index, but still match exactly
+        self.assertEqual(len(published), Index.objects.filter(iexact="status:published").count())
+        self.assertItemsEqual(published, search(FilterableModel, "banana", status="published"))
+        self.assertItemsEqual([], search(FilterableModel, "banana", status="Published"))
+
+        # Instances which haven't been indexed with their filters yet are still found
+        drafts = [ x for x in instances if x.status == "draft" ]
+        Index.objects.filter(iexact="status:draft").delete()
+        GlobalOccuranceCount.objects.filter(pk="status:draft").delete()
+        self.assertItemsEqual(drafts, search(FilterableModel, "banana", per_page=20, status="draft"))
+        self.assertItemsEqual(published, search(FilterableModel, "banana status:published"))
+
+        # Other filters are applied to ranked candidates until the page is full
+        results = search(FilterableModel, "banana", per_page=2, total_pages=3, rating=0)
+        self.assertEqual(2, len(results))
+        self.assertTrue(all(x.rating == 0 for x in results))
+
+        page2 = search(FilterableModel, "banana", per_page=2, current_page=2, total_pages=3, rating=0)
+        self.assertEqual(2, len(page2))
+        self.assertFalse(set(results) & set(page2))
+
+    def test_cursor_pagination(self):
+        instances = []
+        for i in xrange(5):
+            instance = SampleModel.objects.create(field1="banana")
+            index_instance(instance, ["field1"], defer_index=False)
+            instances.append(instance)
+
+        page1, cursor = search_with_cursor(SampleModel, "banana", per_page=2)
+        self.assertEqual(2, len(page1))
+
+        # Pages come from the snapshot, so changes to the index don't shift them
+        new_instance = SampleModel.objects.create(field1="banana")
+        index_instance(new_instance, ["field1"], defer_index=False)
+
+        page2, cursor = search_with_cursor(SampleModel, "banana", per_page=2, cursor=cursor)
+        page3, cursor = search_with_cursor(SampleModel, "banana", per_page=2, cursor=cursor)
+
+        self.assertEqual(1, len(page3))
+        self.assertIsNone(cursor)
+        self.assertItemsEqual(instances, page1 + page2 + page3)
+
+        _, cursor = search_with_cursor(SampleModel, "banana", per_page=2)
+        self.assertRaises(ValueError, search_with_cursor, SampleModel, "apple", cursor=cursor)
+        self.assertRaises(ValueError, search_with_cursor, SampleModel, "banana", cursor=u"caf\xe9")
+
+    def test_analyzer(self):
+        analyzer = Analyzer(stopwords=ENGLISH_STOPWORDS, min_length=2)
+        self.assertEqual([u"cat", u"sat", u"mat"], analyzer.tokenize(u"The cat\tsat on the\nmat!"))
+
+        # Occurances are counted per word, not per substring
+        self.assertEqual(
+            {u"cat": 1, u"concatenate": 1, u"cat concatenate": 1},
+            Analyzer().get_term_occurances(u"cat, concatenate")
+        )
+
+        self.assertEqual(
+            [u"eat", u"fish chips", u"status:published"],
+            parse_terms(u'Eat, "fish & chips" status:Published')
+        )
+        self.assertEqual([u"foo", u"bar baz"], parse_terms(u'foo:"bar baz"'))
+        self.assertEqual([u"c"], parse_terms(u"C++ c#"))
+
+    def test_indexing_and_searching_share_the_analyzer(self):
+        instance1 = SampleModel.objects.create(field1="Bananas, apples.\nCherries")
+        index_instance(instance1, ["field1"], defer_index=False)
+
+        self.assertEqual(1, Index.objects.filter(iexact="apples cherries").count())
+        self.assertItemsEqual([instance1], search(SampleModel, "apples!"))
+        self.assertItemsEqual([instance1], search(SampleModel, '"apples, cherries"'))
+
+        instance2 = StopwordModel.objects.create(field1="the cat sat on the mat")
+        index_instance(instance2, ["field1"], defer_index=False)
+
+        self.assertEqual(0, Index.objects.filter(iexact="the").count())
+        self.assertEqual(1, Index.objects.filter(iexact="cat sat mat").count())
+        self.assertItemsEqual([instance2], search(StopwordModel, '"sat on the mat"'))
+
+    def test_positional_index(self):
+        instance1 = PositionalModel.objects.create(field1="a big fish swam past the little red boat")
+        instance2 = PositionalModel.objects.create(field1="fish are big")
+        index_instance(instance1, ["field1"], defer_index=False)
+        index_instance(instance2, ["field1"], defer_index=False)
+
+        # Only single words are indexed
+        self.assertEqual(0, Index.objects.filter(iexact="big fish").count())
+
+        self.assertItemsEqual([instance1], search(PositionalModel, '"big fish"'))
+        self.assertItemsEqual([], search(PositionalModel, '"fish big"'))
+        self.assertItemsEqual([instance1, instance2], search(PositionalModel, 'big fish'))
+
+        # Phrases aren't limited to the shingle size
+        self.assertItemsEqual([instance1], search(PositionalModel, '"swam past the little red"'))
+
+        # Words which only move invalidate cached phrase searches
+        timeout = search_cache.RESULT_CACHE_TIMEOUT
+        search_cache.RESULT_CACHE_TIMEOUT = 60
+        try:
+            self.assertItemsEqual([instance2], search(PositionalModel, '"fish are"'))
+            instance2.field1 = "are fish big"
+            instance2.save()
+            index_instance(instance2, ["field1"], defer_index=False)
+            self.assertItemsEqual([], search(PositionalModel, '"fish are"'))
+        finally:
+            search_cache.RESULT_CACHE_TIMEOUT = timeout
+
+    def test_cross_join_indexing(self):
+        author1 = Author.objects.create(name="isaac")
+        author2 = Author.objects.create(name="arthur")
+        book = Book.objects.create(title="foundation", author=author1)
+        self.process_task_queues()
+
+        self.assertItemsEqual([author1], search(Author, "foundation"))
+
+        # Saving the book reindexes its author
+        book.title = "robots"
+        book.save()
+        self.process_task_queues()
+
+        self.assertItemsEqual([], search(Author, "foundation"))
+        self.assertItemsEqual([author1], search(Author, "robots"))
+
+        # Changes to several of an author's books reindex it once
+        other_book = Book.objects.create(title="empire", author=author1)
+        self.process_task_queues()
+        debounce = search_models.INDEX_DEBOUNCE
+        search_models.INDEX_DEBOUNCE = 3600
+        try:
+            for i in xrange(2):
+                for related in (book, other_book):
+                    related.title += " again"
+                    related.save()
+            self.assertNumTasksEquals(1, search_models.QUEUE_FOR_INDEXING)
+            self.process_task_queues()
+        finally:
+            search_models.INDEX_DEBOUNCE = debounce
+        other_book.delete()
+        self.process_task_queues()
+
+        # Moving it reindexes both its old and new author
+        book.author = author2
+        book.save()
+        self.process_task_queues()
+
+        self.assertItemsEqual([author2], search(Author, "robots"))
+
+        book.delete()
+        self.process_task_queues()
+
+        self.assertItemsEqual([], search(Author, "robots"))
+
+    def test_snapshot_search(self):
+        instance1 = SnapshotModel.objects.create(field1="banana apple")
+        instance2 = SnapshotModel.objects.create(field1="banana cherry")
+        index_instance(instance1, ["field1"], defer_index=False)
+        index_instance(instance2, ["field1"], defer_index=False)
+
+        snapshot = snapshots.publish_snapshot(SnapshotModel)
+        self.assertEqual({instance1.pk: 1, instance2.pk: 1}, snapshot.get_postings(u"banana"))
+
+        check_interval = snapshots.CHECK_INTERVAL
+        snapshots.CHECK_INTERVAL = 0
+        try:
+            # Searches are answered from the snapshot, not the Index
+            Index.objects.filter(iexact="cherry").delete()
+            self.assertItemsEqual([instance2], search(SnapshotModel, "cherry"))
+
+            # Instances indexed since the snapshot are merged in
+            instance3 = SnapshotModel.objects.create(field1="banana")
+            index_instance(instance3, ["field1"], defer_index=False)
+            unindex_instance(instance1)
+            self.assertItemsEqual([instance2, instance3], search(SnapshotModel, "banana"))
+        finally:
+            snapshots.CHECK_INTERVAL = check_interval
+
+    def test_benchmark(self):
+        corpus = ZipfianCorpus(vocabulary_size=100, seed=1)
+        words = corpus.text(10000).split(" ")
+        # The most common word is far more common than a rare one
+        self.assertGreater(words.count(corpus.vocabulary[0]), 10 * words.count(corpus.vocabulary[50]))
+        self.assertEqual(
+            list(ZipfianCorpus(vocabulary_size=100, seed=1).documents(3)),
+            list(ZipfianCorpus(vocabulary_size=100, seed=1).documents(3))
+        )
+
+        results = run_benchmark(documents=10, body_length=20, vocabulary_size=100, queries=3)
+        self.assertGreater(results["indexing"]["instances_per_second"], 0)
+        self.assertGreater(results["indexing"]["datastore_rpcs_per_instance"], 0)
+        self.assertItemsEqual(["common", "multi_term", "phrase", "rare"], results["search"].keys())
+
+        # The corpus is cleaned up again
+        self.assertEqual(0, _get_benchmark_model().objects.count())
+        self.assertEqual(0, Index.objects.filter(instance_db_table=_get_benchmark_model()._meta.db_table).count())
+
+    def test_stats_callback(self):
+        reported = []
+
+        original_callback = search_stats.STATS_CALLBACK
+        search_stats.STATS_CALLBACK = reported.append
+        search_stats._callback = None
+        try:
+            instance1 = SampleModel.objects.create(field1="banana apple")
+            del reported[:]
+            index_instance(instance1, ["field1"], defer_index=False)
+            search(SampleModel, "banana apple")
+
+            # The RPCs of worker threads are counted too
+            search(SampleModel, "banana apple")
+            max_concurrent_fetches = search_models.MAX_CONCURRENT_FETCHES
+            search_models.MAX_CONCURRENT_FETCHES = 1
+            try:
+                search(SampleModel, "banana apple")
+            finally:
+                search_models.MAX_CONCURRENT_FETCHES = max_concurrent_fetches
+        finally:
+            search_stats.STATS_CALLBACK = original_callback
+            search_stats._callback = None
+
+        index_stats, search_result_stats, threaded_stats, serial_stats = reported
+        self.assertEqual(serial_stats.counters["datastore_rpcs"], threaded_stats.counters["datastore_rpcs"])
+        self.assertEqual("index", index_stats.operation)
+        self.assertEqual(3, index_stats.counters["terms"])
+        self.assertTrue(set(["fetch", "analysis", "index_write", "counts"]) <= set(index_stats.timings))
+
+        self.assertEqual("search", search_result_stats.operation)
+        self.assertEqual(SampleModel._meta.db_table, search_result_stats.info["model"])
+        self.assertEqual(2, search_result_stats.counters["candidates"])
+        self.assertEqual(1, search_result_stats.counters["results"])
+        self.assertGreater(search_result_stats.counters["datastore_rpcs"], 0)
+        self.assertTrue(set(["counts", "postings", "ranking", "fetch"]) <= set(search_result_stats.timings))
+
+        # Nothing is collected without a callback
+        self.assertIs(search_stats._NULL_STATS, search_stats.current())
+
+    def test_index_tasks_are_coalesced(self):
+        debounce = search_models.INDEX_DEBOUNCE
+        search_models.INDEX_DEBOUNCE = 3600
+        try:
+            instance1 = SearchableModel.objects.create(field1="banana")
+            for word in ("apple", "cherry"):
+                instance1.field1 = word
+                instance1.save()
+
+            # One task per instance, which indexes its latest state
+            self.assertNumTasksEquals(1, search_models.QUEUE_FOR_INDEXING)
+            self.process_task_queues()
+
+            self.assertItemsEqual([], search(SearchableModel, "banana"))
+            self.assertItemsEqual([instance1], search(SearchableModel, "cherry"))
+
+            # The task of this window has already run, so a save still needs a new one
+            instance1.field1 = "apple"
+            instance1.save()
+            self.process_task_queues()
+        finally:
+            search_models.INDEX_DEBOUNCE = debounce
+
+        self.assertItemsEqual([instance1], search(SearchableModel, "apple"))
+
+    def test_concurrent_fetches(self):
+        self.assertEqual([1, 4, 9], search_models._run_concurrently([ lambda i=i: i * i for i in (1, 2, 3) ]))
+
+        def fail():
+            raise ValueError()
+        self.assertRaises(ValueError, search_models._run_concurrently, [ lambda: 1, fail ])
+
+        for i in xrange(10):
+            instance = SampleModel.objects.create(field1="banana " * (i + 1))
+            index_instance(instance, ["field1"], defer_index=False)
+
+        fetch_batch_size = search_models.FETCH_BATCH_SIZE
+        max_concurrent_fetches = search_models.MAX_CONCURRENT_FETCHES
+        try:
+            search_models.FETCH_BATCH_SIZE = 3
+            concurrent = search(SampleModel, "banana")
+
+            search_models.MAX_CONCURRENT_FETCHES = 1
+            self.assertEqual(concurrent, search(SampleModel, "banana"))
+        finally:
+            search_models.FETCH_BATCH_SIZE = fetch_batch_size
+            search_models.MAX_CONCURRENT_FETCHES = max_concurrent_fetches
+
+        self.assertEqual(10, len(concurrent))
+
+    def test_local_cache(self):
+        local_cache = search_cache.LocalCache(max_size=2, ttl=60)
+        local_cache.set_many({"a": 1, "b": 2})
+        local_cache.get_many(["a"])
+        local_cache.set_many({"c": 3})
+        # "b" was the least recently used
+        self.assertEqual({"a": 1, "c": 3}, local_cache.get_many(["a", "b", "c"]))
+
+        local_cache.set_many({"d": 4}, timeout=-1)
+        self.assertEqual({}, local_cache.get_many(["d"]))
+
+    def test_caching_queryset(self):
+        instances = [ CachedModel.objects.create(email="%s@example.com" % i) for i in xrange(3) ]
+        pks = [ instance.pk for instance in instances ]
+
+        # Deleting behind the cache's back shows what is served from the cache
+        QuerySet(CachedModel).filter(pk=pks[0]).delete()
+        self.assertEqual(instances[0], CachedModel.objects.get(email="0@example.com"))
+        self.assertEqual(instances[::-1], list(CachedModel.objects.filter(pk__in=pks[::-1])))
+
+        # Misses are fetched and then cached
+        search_cache.tiered_delete_many(instances[1]._get_cache_keys())
+        self.assertEqual(instances, list(CachedModel.objects.filter(pk__in=pks)))
+        self.assertTrue(search_cache.tiered_get_many(instances[1]._get_cache_keys()))
+
+        # Deleted instances are tombstoned in every tier
+        instances[2].delete()
+        self.assertEqual(instances[:2], list(CachedModel.objects.filter(pk__in=pks)))
+
+        # A generator of pks isn't used up before the lookup
+        self.assertEqual(instances[:2], list(CachedModel.objects.filter(pk__in=(pk for pk in pks))))
+
+        # Hits in the local tier, delete markers included, don't go to memcache
+        original_cache = search_cache.cache
+        search_cache.cache = None
+        try:
+            self.assertEqual(instances[1], CachedModel.objects.get(pk=pks[1]))
+            self.assertEqual(instances[:2], list(CachedModel.objects.filter(pk__in=pks)))
+        finally:
+            search_cache.cache = original_cache
+
+        # A delete in another process hides what this process' local tier still holds,
+        # once the local tier's own (absent) marker has expired
+        search_cache.local_cache.set_many(dict((key, instances[1]) for key in instances[1]._get_cache_keys()))
+        search_cache.local_cache.delete_many([ search_cache._deleted_key(instances[1].pk) ])
+        search_cache.cache.set(search_cache._deleted_key(instances[1].pk), True)
+        QuerySet(CachedModel).filter(pk=pks[1]).delete()
+        self.assertRaises(CachedModel.DoesNotExist, CachedModel.objects.get, email="1@example.com")
+
+        # Filling the cache on a read doesn't overwrite what a save stored meanwhile
+        search_cache.tiered_add_many({ "test_key": 1 })
+        search_cache.tiered_add_many({ "test_key": 2 })
+        self.assertEqual({ "test_key": 1 }, search_cache.tiered_get_many([ "test_key" ]))
+
+    def test_search_multiple_models(self):
+        sample = SampleModel.objects.create(field1="banana apple")
+        searchable = SearchableModel.objects.create(field1="banana")
+        index_instance(sample, ["field1"], defer_index=False)
+        index_instance(searchable, ["field1"], defer_index=False)
+
+        self.assertEqual([sample, searchable], search([SampleModel, SearchableModel], "banana apple"))
+        self.assertEqual([searchable], search([SampleModel, SearchableModel], "banana apple", per_page=1, current_page=2))
+
+        SearchableModel.Search.boost = 10
+        try:
+            self.assertEqual([searchable, sample], search([SampleModel, SearchableModel], "banana apple"))
+        finally:
+            del SearchableModel.Search.boost
+
+        self.assertRaises(ValueError, search, [SampleModel, SearchableModel], "banana", field1="banana")
+
+        # A lookup in the search string is searched for as words, even if one of the models can filter on it
+        self.assertEqual([searchable], search([SearchableModel, FilterableModel], "banana status:published"))
+
+    def test_recounting_corrects_drifted_counters(self):
+        for text in ("banana apple", "banana cherry", "banana", "banana", "banana"):
+            index_instance(SampleModel.objects.create(field1=text), ["field1"], defer_index=False)
+
+        GlobalOccuranceCount.objects.filter(pk="banana").update(count=7)
+        GlobalOccuranceCount.objects.filter(pk="apple").delete()
+        GlobalOccuranceCount.objects.create(pk="ghost", count=3)
+
+        # Small batches so that terms carry on from one batch into the next, and "banana"
+        # is summed over several batches
+        checkpoints = recount_occurances(shards=2, batch_size=2, defer=False)
+        self.assertTrue(all(checkpoint.finished and checkpoint.term is None for checkpoint in checkpoints))
+        self.assertEqual(3, sum(checkpoint.corrected for checkpoint in checkpoints))
+        self.assertEqual(
+            {"banana": 5, "apple": 1, "cherry": 1, "banana apple": 1, "ghost": 0},
+            get_occurance_counts(["banana", "apple", "cherry", "banana apple", "ghost"])
+        )
+
+        counter = GlobalOccuranceCount.objects.get(pk="cherry")
+        GlobalOccuranceCount.objects.filter(pk="cherry").update(count=0)
+        counter.update()
+        self.assertEqual(1, counter.count)
+        self.assertEqual(1, GlobalOccuranceCount.objects.get(pk="cherry").count)
+
+    def test_deletes_are_tombstoned_and_unindexed_later(self):
+        instance1 = SearchableModel.objects.create(field1="banana")
+        instance2 = SearchableModel.objects.create(field1="banana")
+        self.process_task_queues()
+
+        instance1.delete()
+
+        # Still indexed, but left out of the ranking
+        self.assertEqual(2, Index.objects.filter(iexact="banana").count())
+        self.assertEqual(1, IndexTombstone.objects.count())
+        self.assertEqual([instance2.pk], [ pk for score, pk in _rank(SearchableModel._meta.db_table, ["banana"], 10) ])
+        self.assertEqual([instance2], search(SearchableModel, "banana"))
+
+        self.process_task_queues()
+
+        self.assertEqual(1, Index.objects.filter(iexact="banana").count())
+        self.assertEqual(0, IndexTombstone.objects.count())
+        self.assertEqual({"banana": 1}, get_occurance_counts(["banana"]))
+
+        # A tombstone is only cleared once its instance is really gone
+        IndexTombstone.objects.create(
+            pk=IndexTombstone.key_for(SearchableModel._meta.db_table, instance2.pk),
+            instance_db_table=SearchableModel._meta.db_table, instance_pk=instance2.pk
+        )
+        search_models._unindex_by_key(search_models._model_label(SearchableModel), instance2.pk)
+        self.assertEqual(1, IndexTombstone.objects.count())
+        self.assertEqual(1, Index.objects.filter(iexact="banana").count())
+        self.assertNumTasksEquals(1, search_models.QUEUE_FOR_INDEXING)
+
+    def test_tombstones_are_capped_per_table(self):
+        for db_table in ("table_a", "table_b"):
+            for pk in (1, 2):
+                IndexTombstone.objects.create(pk=IndexTombstone.key_for(db_table, pk), instance_db_table=db_table, instance_pk=pk)
+
+        original_max = search_models.MAX_TOMBSTONES
+        search_models.MAX_TOMBSTONES = 1
+        try:
+            tombstoned = search_models._get_tombstoned_pks(["table_a", "table_b"])
+        finally:
+            search_models.MAX_TOMBSTONES = original_max
+        self.assertEqual([1, 1], [ len(tombstoned["table_a"]), len(tombstoned["table_b"]) ])
+
+    def test_sweeping_unindexes_orphans(self):
+        instance1 = SampleModel.objects.create(field1="banana apple")
+        instance2 = SampleModel.objects.create(field1="banana")
+        index_instance(instance1, ["field1"], defer_index=False)
+        index_instance(instance2, ["field1"], defer_index=False)
+
+        # SampleModel has no Search class, so nothing cleans up after the delete
+        instance1.delete()
+
+        checkpoint = sweep_orphans(batch_size=2, defer=False)
+        self.assertTrue(checkpoint.finished)
+        self.assertEqual(1, checkpoint.corrected)
+        self.assertEqual([instance2.pk], list(Index.objects.values_list("instance_pk", flat=True)))
+        self.assertEqual({"banana": 1, "apple": 0}, get_occurance_counts(["banana", "apple"]))
+
+    def test_transaction_collisions_are_retried(self):
+        attempts = []
+
+        def collide_once():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise transaction.TransactionFailedError()
+            return "done"
+
+        original_delay = search_models.TRANSACTION_RETRY_DELAY
+        search_models.TRANSACTION_RETRY_DELAY = 0
+        try:
+            self.assertEqual("done", _run_in_transaction(collide_once))
+        finally:
+            search_models.TRANSACTION_RETRY_DELAY = original_delay
+        self.assertEqual(2, len(attempts))
+
+    def test_interrupted_counter_updates_are_finished(self):
+        instance1 = SampleModel.objects.create(field1="banana apple")
+
+        saves = []
+        save_many = search_models._save_many
+        def fail_after_first_save(instances):
+            if saves:
+                raise ValueError()
+            saves.append(instances)
+            save_many(instances)
+
+        max_groups = search_models.MAX_GROUPS_PER_TRANSACTION
+        search_models.MAX_GROUPS_PER_TRANSACTION = 2 #One term per group, with the PendingCounts
+        search_models._save_many = fail_after_first_save
+        try:
+            self.assertRaises(ValueError, index_instance, instance1, ["field1"], defer_index=False)
+        finally:
+            search_models._save_many = save_many
+            search_models.MAX_GROUPS_PER_TRANSACTION = max_groups
+
+        # The index was written, but only one of the counters
+        self.assertEqual(3, Index.objects.filter(instance_pk=instance1.pk).count())
+        self.assertEqual(1, len(get_occurance_counts(["banana", "apple", "banana apple"])))
+        self.assertEqual(1, PendingCounts.objects.count())
+
+        # There's nothing left to diff, but the rest of the counts are applied
+        index_instance(instance1, ["field1"], defer_index=False)
+        self.assertEqual(
+            {"banana": 1, "apple": 1, "banana apple": 1}, get_occurance_counts(["banana", "apple", "banana apple"])
+        )
+        self.assertEqual(0, PendingCounts.objects.count())
+
+        # Each write has its own record, so another write's pending counts aren't overwritten
+        other = PendingCounts(
+            pk=PendingCounts.key_for(SampleModel._meta.db_table, instance1.pk, "other"),
+            instance_db_table=SampleModel._meta.db_table, instance_pk=instance1.pk
+        )
+        other.set_deltas({"cherry": 1})
+        other.save()
+        instance1.field1 = "banana"
+        instance1.save()
+        index_instance(instance1, ["field1"], defer_index=False)
+        self.assertEqual(
+            {"banana": 1, "apple": 0, "banana apple": 0, "cherry": 1},
+            get_occurance_counts(["banana", "apple", "banana apple", "cherry"])
+        )
+        self.assertEqual(0, PendingCounts.objects.count())
+
     def test_non_ascii_characters_in_search_string(self):
         """
         Validates that using a search string with characters outside the ASCII